@@ -0,0 +1,364 @@
+import argparse
+import concurrent.futures
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import dmaftServerDB
+
+#Contract checks for the storage backends (see STORAGE BACKENDS in dmaftServerDB.py).
+#The same checks run against every engine, each on a fresh database in a temporary directory, through borrowDB()
+#exactly as the server uses it. They cover what callers rely on: return shapes, case-insensitive IDs, error types,
+#paging, expiry, and that a sharded layout behaves like a single file.
+#Exits with status 1 if any check fails on any engine.
+#   python3 backendContract.py [--backends sqlite memory sharded] [--shards 3] [--only tokens mailbox]
+
+
+class ContractFailure(AssertionError):
+    pass
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise ContractFailure(message)
+
+
+def expectRaises(exceptionType, function, message: str):
+    try:
+        function()
+    except exceptionType:
+        return
+    except Exception as e:
+        raise ContractFailure(message + " (raised " + type(e).__name__ + " instead)")
+    raise ContractFailure(message + " (nothing was raised)")
+
+
+#Runs one operation on a borrowed connection.
+def call(name: str, **kwargs):
+    with dmaftServerDB.borrowDB() as connection:
+        return getattr(dmaftServerDB, name)(connection=connection, **kwargs)
+
+
+#Shared across engines; key generation is the slowest part of setting up.
+publicKeys = [rsa.generate_private_key(public_exponent=65537, key_size=1024).public_key() for i in range(3)]
+
+def registerUsers(count: int):
+    userIDs = call('registerUsers', publicKeys=[publicKeys[i % len(publicKeys)] for i in range(count)])
+    expect(userIDs is not None and len(userIDs) == count, "registerUsers should return one UserID per public key")
+    return userIDs
+
+def setProfile(userID: str, userName: str):
+    expect(call('updateUserProfileData', userID=userID, userName=userName, userBio='bio', userStatus='status', userPic=b'pic'), "updateUserProfileData should succeed for " + userID)
+
+
+#CHECKS
+def checkOperations():
+    with dmaftServerDB.borrowDB() as connection:
+        if isinstance(connection, sqlite3.Connection):
+            return
+        missing = [name for name in dmaftServerDB.getBackendOperations() if not callable(getattr(connection, name, None))]
+    expect(len(missing) == 0, "The backend's connection is missing operations: " + ', '.join(missing))
+
+
+def checkUsers():
+    userIDs = registerUsers(10)
+    expect(len(set(userIDs)) == 10 and all(userID == userID.upper() for userID in userIDs), "New UserIDs should be distinct and upper-case")
+    expect(call('registerUsers', publicKeys=[]) == [], "Registering nobody should return an empty list")
+    for i, userID in enumerate(userIDs):
+        expect(call('doesUserExist', userID=userID.lower()), "doesUserExist should ignore case")
+        expect(call('verifyPublicKey', userID=userID, publicKey=publicKeys[i % len(publicKeys)]), "verifyPublicKey should accept the registered key")
+        expect(not call('verifyPublicKey', userID=userID, publicKey=publicKeys[(i + 1) % len(publicKeys)]), "verifyPublicKey should reject another key")
+        expect([row[0] for row in call('searchUserByID', userID=userID)] == [userID], "searchUserByID should find the user")
+    expect(not call('doesUserExist', userID='NO-SUCH-USER'), "doesUserExist should be False for unknown users")
+    expect(call('searchUserByID', userID='NO-SUCH-USER') == [], "searchUserByID should return no rows for unknown users")
+
+    userID = call('registerUser', publicKey=publicKeys[0], acceptID=lambda candidate: candidate.startswith('A'))
+    expect(userID is not None and userID.startswith('A'), "registerUser should only hand out IDs acceptID allows")
+
+
+def checkProfiles():
+    userIDs = registerUsers(6)
+    setProfile(userIDs[0], 'profile zero')
+    setProfile(userIDs[0], 'profile zero again')
+    expect(not call('updateUserProfileData', userID='NO-SUCH-USER', userName='x', userBio='', userStatus='', userPic=b''), "Updating an unknown user should fail")
+
+    summaries = call('getProfileSummaries', userIDs=[userID.lower() for userID in userIDs] + ['NO-SUCH-USER'])
+    expect(summaries is not None and sorted(row[0] for row in summaries) == sorted(userIDs), "getProfileSummaries should return every known user, ignoring case, and leave out unknown ones")
+    versions = {row[0]: row[2] for row in summaries}
+    expect(versions[userIDs[0]] == versions[userIDs[1]] + 2, "ProfileVersion should go up once per update")
+
+    profiles = {row[0]: row for row in call('getProfiles', userIDs=userIDs[:2] + ['NO-SUCH-USER'])}
+    expect(sorted(profiles) == sorted(userIDs[:2]), "getProfiles should return exactly the known users")
+    expect(profiles[userIDs[0]][1:5] == ('profile zero again', 'status', 'bio', b'pic'), "getProfiles should return the latest profile")
+    expect(call('getProfileSummaries', userIDs=[]) == [], "No users should give no summaries")
+
+
+def checkSearch():
+    userIDs = registerUsers(23)
+    for i, userID in enumerate(userIDs[:20]):
+        setProfile(userID, 'Contract' + str(i).zfill(2))
+    for i, userID in enumerate(userIDs[20:]):
+        setProfile(userID, 'xcontract' + str(i))
+
+    found = []
+    cursor = None
+    pages = 0
+    while True:
+        page = call('searchUsersByNamePage', userName='contract', limit=4, cursor=cursor)
+        expect(page is not None, "searchUsersByNamePage should succeed")
+        results, cursor = page
+        expect(len(results) <= 4, "A page should hold at most limit results")
+        found += results
+        pages += 1
+        expect(pages < 50, "Paging should end")
+        if cursor is None:
+            break
+    expect(sorted(row[0] for row in found) == sorted(userIDs), "Paging should return every match exactly once")
+    prefixNames = [row[1] for row in found if row[1].lower().startswith('contract')]
+    expect(len(prefixNames) == 20, "Prefix matches should all be found")
+
+    expect(len(call('searchUsersByName', userName='CONTRACT', limit=5)) == 5, "searchUsersByName should ignore case and honour limit")
+    expect(call('searchUsersByNamePage', userName='', cursor=None) == ([], None), "An empty term should match nothing")
+    expectRaises(ValueError, lambda: call('searchUsersByNamePage', userName='contract', cursor='not a cursor'), "An invalid cursor should raise ValueError")
+
+
+def checkChallenges():
+    userIDs = registerUsers(1)
+    rows = call('addChallenges', challenges=[b'one', b'two'], publicKeys=[b'key1', b'key2'], userIDs=[userIDs[0], None])
+    expect(rows is not None and len(rows) == 2, "addChallenges should return one row per challenge")
+    challengeID = rows[0][0]
+    expect(len(call('getChallenge', challengeID=challengeID)) == 1, "getChallenge should find a new challenge")
+    expect(call('deleteChallengesWithUUID', challengeID=challengeID), "deleteChallengesWithUUID should succeed")
+    expect(call('getChallenge', challengeID=challengeID) == [], "A deleted challenge should be gone")
+    expect(call('addChallenges', challenges=[], publicKeys=[], userIDs=[]) == [], "Adding no challenges should return an empty list")
+    expectRaises(ValueError, lambda: call('addChallenges', challenges=[b'x'], publicKeys=[], userIDs=[None]), "Mismatched challenge lists should raise ValueError")
+
+
+def checkTokens():
+    userIDs = registerUsers(4)
+    expectRaises(ValueError, lambda: call('createToken', userID='NO-SUCH-USER'), "createToken should raise ValueError for unknown users")
+
+    tokens = [call('createToken', userID=userID) for userID in userIDs]
+    tokens.append(call('createToken', userID=userIDs[0]))
+    #Go to the database rather than the in-memory token cache.
+    dmaftServerDB.tokenCache.clear()
+    for token in tokens:
+        expect(call('validateToken', tokenID=token['TokenId'], tokenSecret=token['TokenSecret']) == token['UserId'], "validateToken should return the token's user")
+        expect(call('validateToken', tokenID=token['TokenId'], tokenSecret=b'wrong') is None, "validateToken should reject a wrong secret")
+        expect(len(call('getToken', tokenID=token['TokenId'])) == 1, "getToken should find the token")
+    expect(call('validateToken', tokenID='NO-SUCH-TOKEN', tokenSecret=b'x') is None, "Unknown tokens should not validate")
+
+    expect(call('deleteTokensWithID', tokenID=tokens[1]['TokenId']), "deleteTokensWithID should succeed")
+    expect(call('validateToken', tokenID=tokens[1]['TokenId'], tokenSecret=tokens[1]['TokenSecret']) is None, "A deleted token should not validate")
+    expect(call('deleteTokensWithUserID', userID=userIDs[0]), "deleteTokensWithUserID should succeed")
+    dmaftServerDB.tokenCache.clear()
+    for token in [tokens[0], tokens[-1]]:
+        expect(call('getToken', tokenID=token['TokenId']) == [], "Every token of a signed-out user should be gone")
+    expect(call('validateToken', tokenID=tokens[2]['TokenId'], tokenSecret=tokens[2]['TokenSecret']) == userIDs[2], "Other users' tokens should be untouched")
+
+
+def checkConversations():
+    userIDs = registerUsers(5)
+    expectRaises(ValueError, lambda: call('createNewConversation', userIDs=userIDs[:2] + ['NO-SUCH-USER']), "createNewConversation should raise ValueError for unknown members")
+
+    conversationID = call('createNewConversation', userIDs=[userID.lower() for userID in userIDs[:4]])
+    expect(conversationID is not None, "createNewConversation should return the new ID")
+    expect(call('doesConversationExist', conversationID=conversationID.lower()), "doesConversationExist should ignore case")
+    expect(len(call('getConversationByID', conversationID=conversationID)) == 1, "getConversationByID should find it")
+    expect(sorted(call('getConversationMembers', conversationID=conversationID)) == sorted(userIDs[:4]), "Members should be stored upper-cased")
+    expect(call('isUserInConversation', conversationID=conversationID, userID=userIDs[0].lower()), "isUserInConversation should ignore case")
+    expect(not call('isUserInConversation', conversationID=conversationID, userID=userIDs[4]), "Non-members should not be in the conversation")
+    expect(call('getConversationsForUser', userID=userIDs[1]) == [conversationID], "getConversationsForUser should list it")
+    expect(sorted(call('getConversationMembersForUser', userID=userIDs[1])[conversationID]) == sorted(userIDs[:4]), "getConversationMembersForUser should list every member")
+
+    remaining = call('removeUserFromConversation', conversationID=conversationID, userID=userIDs[3])
+    expect(sorted(remaining) == sorted(userIDs[:3]), "removeUserFromConversation should return the remaining members")
+    expect(call('removeUserFromConversation', conversationID='NO-SUCH-CONVERSATION', userID=userIDs[0]) is None, "Leaving an unknown conversation should return None")
+
+    storedID = dmaftServerDB.newID()
+    for attempt in range(2):
+        expect(call('storeConversation', conversationID=storedID.lower(), userIDs=userIDs[3:]), "storeConversation should succeed, including a second time")
+    expect(sorted(call('getConversationMembers', conversationID=storedID)) == sorted(userIDs[3:]), "A stored conversation should keep its ID and members")
+    expect(call('createNewConversation', userIDs=userIDs[:1] + ['NOT-CHECKED'], checkUsers=False) is not None, "checkUsers=False should skip the member check")
+
+
+def checkBlobs():
+    userIDs = registerUsers(4)
+    conversationID = call('createNewConversation', userIDs=userIDs[1:3])
+    sha256 = 'ab' * 32
+    expect(not call('canUserReadBlob', sha256=sha256, userID=userIDs[0]), "Nobody should be able to read a blob nobody uploaded")
+    expect(call('addBlobOwner', sha256=sha256.upper(), userID=userIDs[0].lower()), "addBlobOwner should succeed")
+    expect(call('addBlobOwner', sha256=sha256, userID=userIDs[0]), "Recording the same owner again should succeed")
+    expect(call('isBlobOwner', sha256=sha256, userID=userIDs[0]), "isBlobOwner should ignore case")
+    expect(not call('isBlobOwner', sha256=sha256, userID=userIDs[1]), "Only uploaders should own the blob")
+    expect(call('canUserReadBlob', sha256=sha256, userID=userIDs[0].lower()), "The uploader should be able to read the blob")
+    expect(not call('canUserReadBlob', sha256=sha256, userID=userIDs[1]), "Members of conversations it wasn't sent to should not read the blob")
+
+    expect(call('addBlobToConversation', sha256=sha256, conversationID=conversationID.lower()), "addBlobToConversation should succeed")
+    expect(call('canUserReadBlob', sha256=sha256, userID=userIDs[2].lower()), "Members of a conversation it was sent to should read the blob")
+    expect(not call('canUserReadBlob', sha256=sha256, userID=userIDs[3]), "Non-members should not read the blob")
+    expect(not call('isBlobOwner', sha256=sha256, userID=userIDs[2]), "Receiving a blob should not make a member its owner")
+    call('removeUserFromConversation', conversationID=conversationID, userID=userIDs[2])
+    expect(not call('canUserReadBlob', sha256=sha256, userID=userIDs[2]), "Leaving the conversation should end access to its blobs")
+
+
+def checkMailbox():
+    userIDs = registerUsers(12)
+    conversationID = call('createNewConversation', userIDs=userIDs[:10])
+    expireTime = int(time.time()) + 3600
+    expectRaises(ValueError, lambda: call('addToMailboxBatch', conversationID=conversationID, expireTime=expireTime, recipientIDs=userIDs[9:11], msgDict={}), "Non-members should raise ValueError")
+    expectRaises(ValueError, lambda: call('addToMailboxBatch', conversationID=conversationID, expireTime=int(time.time()) - 10, recipientIDs=userIDs[:1], msgDict={}), "A past expire time should raise ValueError")
+    expectRaises(ValueError, lambda: call('addToMailbox', conversationID='NO-SUCH-CONVERSATION', expireTime=expireTime, recipientID=userIDs[0], msgDict={}), "An unknown conversation should raise ValueError")
+    expect(call('addToMailboxBatch', conversationID=conversationID, expireTime=expireTime, recipientIDs=[], msgDict={}), "An empty batch should succeed")
+
+    before = call('getMailboxStats')
+    for i in range(5):
+        expect(call('addToMailboxBatch', conversationID=conversationID, expireTime=expireTime, recipientIDs=userIDs[:10], msgDict={'Body':'x' * 1000, 'Sequence':i}), "addToMailboxBatch should succeed")
+    expect(call('addToMailbox', conversationID='SYSTEM', expireTime=expireTime, recipientID=userIDs[11], msgDict={'Body':'system'}), "SYSTEM messages should skip the member check")
+    after = call('getMailboxStats')
+    expect(after['Messages'] - before['Messages'] == 51, "getMailboxStats should count every queued row")
+    expect(after['Bytes'] - before['Bytes'] < 50 * 1000, "A batch's message body should be stored once per file, not once per recipient")
+
+    for userID in userIDs[:10]:
+        rows = call('getMsgsForUser', userID=userID)
+        expect(len(rows) == 5 and all(row[4] == userID for row in rows), "getMsgsForUser should return the user's rows")
+
+        pageRowIDs = []
+        afterRowID = 0
+        while True:
+            page = call('getMailboxPage', userID=userID, afterRowID=afterRowID, maxRows=2)
+            expect(page is not None and len(page) <= 2, "getMailboxPage should honour maxRows")
+            if len(page) == 0:
+                break
+            pageRowIDs += [row[0] for row in page]
+            afterRowID = page[-1][0]
+        expect(pageRowIDs == [row[0] for row in rows], "Paging should return every row once, in arrival order")
+        expect(pageRowIDs == sorted(pageRowIDs), "Mailbox ROWIDs should grow in arrival order")
+        expect([json.loads(rows[i][5])['Sequence'] for i in range(5)] == list(range(5)), "Rows should come back in the order they were added")
+
+    firstRows = call('getMsgsForUser', userID=userIDs[0])
+    expect(call('deleteMsgsFromMailbox', rowIDs=[row[0] for row in firstRows[:3]]), "deleteMsgsFromMailbox should succeed")
+    expect(call('deleteMsgFromMailbox', rowID=firstRows[3][0]), "deleteMsgFromMailbox should succeed")
+    expect([row[0] for row in call('getMsgsForUser', userID=userIDs[0])] == [firstRows[4][0]], "Deleting rows should only remove those rows")
+    expect(len(call('getMsgsForUser', userID=userIDs[1])) == 5, "Other users' rows should be untouched")
+    expect(call('deleteAllMsgsForUser', userID=userIDs[1]), "deleteAllMsgsForUser should succeed")
+    expect(call('getMsgsForUser', userID=userIDs[1]) == [], "deleteAllMsgsForUser should empty the mailbox")
+
+    expect(call('claimMailboxDrain', userID=userIDs[2], owner='one', leaseSeconds=60) is True, "An unclaimed mailbox should be claimable")
+    expect(call('claimMailboxDrain', userID=userIDs[2].lower(), owner='two', leaseSeconds=60) is False, "A claimed mailbox shouldn't be claimable by someone else, ignoring case")
+    expect(call('claimMailboxDrain', userID=userIDs[2], owner='one', leaseSeconds=60) is True, "The owner should be able to renew its claim")
+    expect(call('claimMailboxDrain', userID=userIDs[3], owner='two', leaseSeconds=60) is True, "Claims should be per user")
+    expect(call('releaseMailboxDrain', userID=userIDs[2], owner='two'), "Releasing a claim you don't hold should succeed")
+    expect(call('claimMailboxDrain', userID=userIDs[2], owner='two', leaseSeconds=60) is False, "...and leave the claim alone")
+    expect(call('releaseMailboxDrain', userID=userIDs[2], owner='one'), "releaseMailboxDrain should succeed")
+    expect(call('claimMailboxDrain', userID=userIDs[2], owner='two', leaseSeconds=-1) is True, "A released mailbox should be claimable")
+    expect(call('claimMailboxDrain', userID=userIDs[2], owner='one', leaseSeconds=60) is True, "A lapsed claim should be claimable by someone else")
+
+
+def checkExpiry():
+    userIDs = registerUsers(6)
+    conversationID = call('createNewConversation', userIDs=userIDs)
+    soon = int(time.time()) + 1
+    expect(call('addToMailboxBatch', conversationID=conversationID, expireTime=soon, recipientIDs=userIDs, msgDict={'Body':'expiring'}), "addToMailboxBatch should succeed")
+    expect(call('addToMailboxBatch', conversationID=conversationID, expireTime=soon + 3600, recipientIDs=userIDs, msgDict={'Body':'kept'}), "addToMailboxBatch should succeed")
+    time.sleep(2.1)
+
+    for userID in userIDs:
+        expect(len(call('getMsgsForUser', userID=userID)) == 1, "Expired rows should never be returned, swept or not")
+    expect(call('deleteExpiredRows', tableName='tblMailbox') >= len(userIDs), "deleteExpiredRows should report the rows it deleted")
+    expect(call('deleteExpiredRows', tableName='tblMailbox') == 0, "A second sweep should find nothing")
+    expect(call('purgeOldMailboxItems') and call('pruneTokens') and call('pruneChallenges'), "The prune operations should succeed")
+    expect(call('deleteExpiredRows', tableName='tblChallenges') == 0 and call('deleteExpiredRows', tableName='tblTokens') == 0, "Sweeping the other tables should succeed")
+    expectRaises(ValueError, lambda: call('deleteExpiredRows', tableName='tblRegisteredUsers'), "Tables without expiry should raise ValueError")
+    for userID in userIDs:
+        expect(len(call('getMsgsForUser', userID=userID)) == 1, "Sweeping should keep unexpired rows")
+
+
+def checkConcurrentWrites():
+    userIDs = registerUsers(8)
+    conversationID = call('createNewConversation', userIDs=userIDs[:6])
+    expireTime = int(time.time()) + 3600
+
+    #Writes from many threads at once, some of which fail, as handlers send them.
+    def write(i: int):
+        if i % 10 == 9:
+            try:
+                call('addToMailboxBatch', conversationID=conversationID, expireTime=expireTime, recipientIDs=userIDs[5:7], msgDict={'Sequence':i})
+                return 'accepted'
+            except ValueError:
+                return 'rejected'
+        if i % 10 == 8:
+            token = call('createToken', userID=userIDs[i % len(userIDs)])
+            return 'token' if token is not None and call('validateToken', tokenID=token['TokenId'], tokenSecret=token['TokenSecret']) == token['UserId'] else 'bad token'
+        return 'queued' if call('addToMailboxBatch', conversationID=conversationID, expireTime=expireTime, recipientIDs=userIDs[:6], msgDict={'Sequence':i}) else 'failed'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        outcomes = list(executor.map(write, range(200)))
+    expect(outcomes.count('rejected') == 20, "Writes to non-members should be rejected on their own")
+    expect(outcomes.count('token') == 20, "Concurrently created tokens should validate straight away")
+    expect(outcomes.count('queued') == 160, "Every other concurrent write should succeed")
+    for userID in userIDs[:6]:
+        rows = call('getMsgsForUser', userID=userID)
+        expect(len(rows) == 160, "Every accepted write should be stored, and no rejected one")
+        rowIDs = [row[0] for row in rows]
+        expect(rowIDs == sorted(rowIDs) and len(set(rowIDs)) == len(rowIDs), "Concurrent writes should still get distinct ROWIDs in arrival order")
+
+
+checks = {
+    'operations':checkOperations,
+    'users':checkUsers,
+    'profiles':checkProfiles,
+    'search':checkSearch,
+    'challenges':checkChallenges,
+    'tokens':checkTokens,
+    'conversations':checkConversations,
+    'blobs':checkBlobs,
+    'mailbox':checkMailbox,
+    'expiry':checkExpiry,
+    'concurrency':checkConcurrentWrites,
+}
+
+
+#Runs the checks against one engine on a fresh database. Returns {check name: None if it passed, or the failure}.
+def runContract(backend: str, shards: int, only: list[str] = None):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='dmaft-contract-') as directory:
+        dmaftServerDB.configureBackend(backend=backend, path=directory + '/contract.db', shards=shards)
+        dmaftServerDB.tokenCache.clear()
+        try:
+            for name, check in checks.items():
+                if only and name not in only:
+                    continue
+                try:
+                    check()
+                    results[name] = None
+                except ContractFailure as e:
+                    results[name] = str(e)
+                except Exception:
+                    results[name] = traceback.format_exc().strip()
+        finally:
+            dmaftServerDB.configureBackend(backend='memory').closeAll()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the storage backend contract against every engine.')
+    parser.add_argument('--backends', nargs='+', choices=dmaftServerDB.backendNames, default=dmaftServerDB.backendNames)
+    parser.add_argument('--shards', type=int, default=3, help='Shard files for the sharded backend.')
+    parser.add_argument('--only', nargs='+', choices=list(checks.keys()), help='Only run these checks.')
+    args = parser.parse_args()
+
+    failures = 0
+    for backend in args.backends:
+        for name, failure in runContract(backend, args.shards, args.only).items():
+            print(f"{backend:<8} {name:<14} {'ok' if failure is None else 'FAILED'}")
+            if failure is not None:
+                failures += 1
+                print('    ' + failure.replace('\n', '\n    '))
+    print(f"{failures} failure(s)")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+#Runs loadTest.py against throwaway clusters of different sizes and compares their SENDMESSAGE throughput.
+#Each run uses the same users, conversations and messages (same --seed), spread over the nodes the way loadTest
+#spreads them: user i registers on node i mod N, so most conversations span several nodes and every message
+#exercises cross-node forwarding.
+#All the nodes run on this machine, so the numbers only show scaling if it has a core or more to spare per node;
+#on fewer cores they show the cost of the forwarding instead.
+
+serverDir = os.path.dirname(os.path.abspath(__file__))
+
+
+#Runs one loadTest.py and returns its JSON results.
+def runLoadTest(nodeCount: int, loadTestArgs: list[str]):
+    with tempfile.NamedTemporaryFile(suffix='.json') as output:
+        command = [sys.executable, os.path.join(serverDir, 'loadTest.py'), '--nodes', str(nodeCount), '--output', output.name] + loadTestArgs
+        subprocess.run(command, cwd=serverDir, check=True, stdout=subprocess.DEVNULL)
+        with open(output.name) as outputFile:
+            return json.load(outputFile)
+
+
+def printReport(runs: dict):
+    baseline = runs.get(min(runs))['MessagesPerSecond'] if len(runs) > 0 else None
+    print(f"{'nodes':>5} {'msgs/s':>9} {'speedup':>8} {'send p50 ms':>12} {'send p99 ms':>12} {'live p99 ms':>12} {'live':>11} {'failures':>9}")
+    for nodeCount, results in runs.items():
+        send = results['Commands'].get('SENDMESSAGE', {})
+        live = results['LiveDelivery']
+        speedup = '-' if not baseline or results['MessagesPerSecond'] is None else f"{results['MessagesPerSecond'] / baseline:.2f}x"
+        liveCount = str(live['Count']) + '/' + str(live['Expected'])
+        print(f"{nodeCount:>5} {results['MessagesPerSecond'] or 0:>9.1f} {speedup:>8} {send.get('P50Ms') or 0:>12.1f} {send.get('P99Ms') or 0:>12.1f} {live['P99Ms'] or 0:>12.1f} {liveCount:>11} {results['Failures']:>9}")
+    print(f"({os.cpu_count()} CPU cores on this machine)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare loadTest.py throughput across cluster sizes.', epilog='Any other arguments are passed to loadTest.py.')
+    parser.add_argument('--node-counts', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--output', help='Also write every run\'s JSON results to this file.')
+    args, loadTestArgs = parser.parse_known_args()
+
+    runs = {}
+    for nodeCount in args.node_counts:
+        print(f"Running {nodeCount} node(s)...", file=sys.stderr)
+        runs[nodeCount] = runLoadTest(nodeCount, loadTestArgs)
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            json.dump(runs, outputFile, indent=2)
+    printReport(runs)
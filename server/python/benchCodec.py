@@ -0,0 +1,121 @@
+import argparse
+import base64
+import copy
+import json
+import os
+import secrets
+import sys
+import time
+
+import codec
+import msgFormats
+
+#Measures encode/decode throughput for every message format in msgFormats.py, for each codec available here
+#plus the plain stdlib json module the server used before codec.py.
+#Image/Video/File messages are benchmarked with a real payload: base64 text for JSON, raw bytes for binary codecs.
+
+
+class StdlibJSONCodec:
+    name = 'stdlib-json'
+    isText = True
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+#Returns {name: message dict} for every *Format dict in msgFormats, with values made JSON-safe.
+def getSampleMessages(payloadBytes: int):
+    samples = {}
+    for name in dir(msgFormats):
+        value = getattr(msgFormats, name)
+        if not name.endswith('Format') or type(value) != dict:
+            continue
+        samples[name] = json.loads(json.dumps(value, default=lambda obj: str(obj)))
+
+    payload = os.urandom(payloadBytes)
+    for name in ['sendMessageMsgFormat', 'incomingMessageMsgFormat']:
+        if name in samples:
+            message = dict(samples[name], MessageType='Image', MessageData=base64.b64encode(payload).decode('ascii'))
+            samples[name.replace('Format', 'ImageFormat')] = message
+    return samples
+
+
+#Returns (encodes per second, decodes per second, encoded size in bytes).
+def timeCodec(messageCodec, message: dict, iterations: int):
+    if not messageCodec.isText:
+        message = codec.unpackMessageData(copy.deepcopy(message))
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        frame = messageCodec.encode(message)
+    encodeSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        messageCodec.decode(frame)
+    decodeSeconds = time.perf_counter() - start
+
+    return iterations / encodeSeconds, iterations / decodeSeconds, len(frame)
+
+
+#Checks that every codec round-trips a message carrying a 2048-bit integer, like an RSA modulus sent as a number.
+#Binary codecs may hand it back as a decimal string; either way int() must give the same value.
+#Returns a list of failure descriptions.
+def checkBigIntegers():
+    modulus = secrets.randbits(2048) | (1 << 2047)
+    message = {'Command':'AUTHENTICATE', 'UserPublicKeyMod':modulus, 'UserPublicKeyExp':65537, 'Nested':[{'N':-modulus}]}
+    failures = []
+    for messageCodec in codec.availableCodecs.values():
+        try:
+            decoded = messageCodec.decode(messageCodec.encode(message))
+            if int(decoded['UserPublicKeyMod']) != modulus or int(decoded['Nested'][0]['N']) != -modulus or decoded['UserPublicKeyExp'] != 65537:
+                failures.append(messageCodec.name + ": the integers came back changed")
+        except Exception as e:
+            failures.append(messageCodec.name + ": " + type(e).__name__ + ": " + str(e))
+    return failures
+
+
+def runBenchmark(iterations: int, payloadBytes: int):
+    codecs = [StdlibJSONCodec()] + list(codec.availableCodecs.values())
+    results = []
+    for name, message in sorted(getSampleMessages(payloadBytes).items()):
+        #Fewer rounds for the big payloads so the run doesn't take forever.
+        rounds = iterations if 'Image' not in name else max(1, iterations // 100)
+        for messageCodec in codecs:
+            encodesPerSec, decodesPerSec, size = timeCodec(messageCodec, message, rounds)
+            results.append({
+                'Message':name,
+                'Codec':messageCodec.name,
+                'EncodesPerSec':encodesPerSec,
+                'DecodesPerSec':decodesPerSec,
+                'Bytes':size,
+            })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark wire codec throughput for each msgFormats message type.')
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--payload-bytes', type=int, default=256 * 1024, help='Size of the Image payload.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    if codec.orjson is None:
+        print("orjson isn't installed; the json codec is using the stdlib.")
+    if codec.msgpack is None:
+        sys.exit("msgpack isn't installed, so there is no binary codec to benchmark; pip install -r requirements.txt")
+
+    failures = checkBigIntegers()
+    if failures:
+        sys.exit("A codec failed the 2048-bit integer round trip:\n  " + '\n  '.join(failures))
+
+    results = runBenchmark(args.iterations, args.payload_bytes)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'Message':<36} {'Codec':<12} {'encode/s':>12} {'decode/s':>12} {'bytes':>10}")
+        for row in results:
+            print(f"{row['Message']:<36} {row['Codec']:<12} {row['EncodesPerSec']:>12.0f} {row['DecodesPerSec']:>12.0f} {row['Bytes']:>10}")
@@ -0,0 +1,72 @@
+import argparse
+import time
+import uuid
+
+import clients
+
+#Measures the per-frame registry cost in tlsServer.listen (one getClientFromSocket call)
+#plus a user lookup, bind and removal, at increasing numbers of connected sockets.
+#The cost per operation should stay flat as the connection count grows.
+
+class FakeSocket:
+    def __init__(self, socketID: int):
+        self.id = socketID
+
+
+def buildRegistry(connectionCount: int):
+    registry = clients.ConnectionList()
+    sockets = []
+    users = []
+    for i in range(connectionCount):
+        socket = FakeSocket(i)
+        userID = str(uuid.uuid4()).upper()
+        registry.addSocket(socket)
+        registry.setUserOnSocket(socket, userID)
+        sockets.append(socket)
+        users.append(userID)
+    return registry, sockets, users
+
+
+def timePerOp(func, items: list, iterations: int):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(items[i % len(items)])
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def runBenchmark(connectionCounts: list[int], iterations: int):
+    results = []
+    for count in connectionCounts:
+        registry, sockets, users = buildRegistry(count)
+
+        frameNs = timePerOp(registry.getClientFromSocket, sockets, iterations)
+        userNs = timePerOp(registry.getClientsFromUser, users, iterations)
+        bindNs = timePerOp(lambda socket: registry.setUserOnSocket(socket, users[socket.id]), sockets, iterations)
+
+        churnSockets = [FakeSocket(count + i) for i in range(iterations)]
+        start = time.perf_counter()
+        for socket in churnSockets:
+            registry.addSocket(socket)
+            registry.setUserOnSocket(socket, users[socket.id % count])
+            registry.deleteSocket(socket)
+        churnNs = (time.perf_counter() - start) / iterations * 1e9
+
+        results.append({
+            'Connections':count,
+            'FrameLookupNs':frameNs,
+            'UserLookupNs':userNs,
+            'BindNs':bindNs,
+            'AddBindRemoveNs':churnNs,
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark clients.ConnectionList lookups at increasing connection counts.')
+    parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'Connections':>12} {'frame ns':>10} {'user ns':>10} {'bind ns':>10} {'churn ns':>10}")
+    for row in runBenchmark(args.counts, args.iterations):
+        print(f"{row['Connections']:>12} {row['FrameLookupNs']:>10.0f} {row['UserLookupNs']:>10.0f} {row['BindNs']:>10.0f} {row['AddBindRemoveNs']:>10.0f}")
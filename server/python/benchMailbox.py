@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+import dmaftServerDB
+
+#Compares the old mailbox layout (a full copy of the message per offline recipient) with the shared-body layout
+#(one tblMailboxBodies row plus a small pointer per recipient) for one big conversation.
+#Every run uses fresh temporary databases, so the real master.db is never touched.
+
+
+def openTempDB(path: str):
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL;')
+    connection.execute('PRAGMA synchronous=NORMAL;')
+    dmaftServerDB.migrateDB(connection=connection)
+    return connection
+
+
+#Creates one conversation with memberCount members and returns (conversationID, memberIDs).
+def seedConversation(connection: sqlite3.Connection, memberCount: int):
+    memberIDs = [str(uuid.uuid4()).upper() for i in range(memberCount)]
+    conversationID = str(uuid.uuid4()).upper()
+    with connection:
+        connection.executemany('INSERT INTO tblRegisteredUsers (UserID, UserPublicKeySHA2_512) VALUES (?,?);', [(userID, os.urandom(64)) for userID in memberIDs])
+        connection.execute('INSERT INTO tblConversations (ConversationID, Participants) VALUES (?,?);', (conversationID, json.dumps(memberIDs)))
+        connection.executemany('INSERT INTO tblConversationMembers (ConversationID, UserID) VALUES (?,?);', [(conversationID, userID) for userID in memberIDs])
+    return conversationID, memberIDs
+
+
+#What addToMailboxBatch did before shared bodies: the serialized message is written into every recipient's row.
+def addToMailboxCopies(connection: sqlite3.Connection, conversationID: str, recipientIDs: list[str], msgDict: dict):
+    currentTime = int(time.time())
+    msgData = json.dumps(msgDict)
+    rows = [(conversationID, currentTime, currentTime + 604800, recipientID, msgData) for recipientID in recipientIDs]
+    with connection:
+        connection.executemany('INSERT INTO tblMailbox (ConversationID, ArriveTimestamp, ExpireTimestamp, Recipient, Message) VALUES (?,?,?,?,?);', rows)
+
+
+def addToMailboxShared(connection: sqlite3.Connection, conversationID: str, recipientIDs: list[str], msgDict: dict):
+    dmaftServerDB.addToMailboxBatch(connection=connection, conversationID=conversationID, expireTime=int(time.time()) + 604800, recipientIDs=recipientIDs, msgDict=msgDict)
+
+
+#Bytes used by the database once the WAL has been folded back in.
+def getDBBytes(connection: sqlite3.Connection):
+    connection.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    pageCount = connection.execute('PRAGMA page_count;').fetchone()[0]
+    freePages = connection.execute('PRAGMA freelist_count;').fetchone()[0]
+    pageSize = connection.execute('PRAGMA page_size;').fetchone()[0]
+    return (pageCount - freePages) * pageSize
+
+
+#Writes messageCount messages to every member's mailbox with addFunc and drains one member's mailbox.
+#Returns the write time per message, the drain time and the database growth.
+def runLayout(directory: str, name: str, addFunc, memberCount: int, messageCount: int, payloadBytes: int):
+    connection = openTempDB(os.path.join(directory, name + '.db'))
+    conversationID, memberIDs = seedConversation(connection, memberCount)
+    baseBytes = getDBBytes(connection)
+    msgDict = {
+        'Command':'INCOMINGMESSAGE',
+        'OriginalReceiptTimestamp':int(time.time()),
+        'SenderId':memberIDs[0],
+        'ConversationId':conversationID,
+        'MessageType':'Text',
+        'MessageData':'x' * payloadBytes,
+        'MessageId':'',
+    }
+
+    start = time.perf_counter()
+    for i in range(messageCount):
+        msgDict['MessageId'] = str(i)
+        addFunc(connection, conversationID, memberIDs, msgDict)
+    writeSeconds = time.perf_counter() - start
+    storedBytes = getDBBytes(connection) - baseBytes
+
+    start = time.perf_counter()
+    afterRowID = 0
+    drained = 0
+    while True:
+        page = dmaftServerDB.getMailboxPage(connection=connection, userID=memberIDs[-1], afterRowID=afterRowID)
+        if not page:
+            break
+        drained += len(page)
+        afterRowID = page[-1][0]
+    drainSeconds = time.perf_counter() - start
+    connection.close()
+
+    if drained != messageCount:
+        raise RuntimeError("benchMailbox: Drained " + str(drained) + " messages, expected " + str(messageCount))
+    return {
+        'WriteMsPerMessage':writeSeconds / messageCount * 1000,
+        'DrainMs':drainSeconds * 1000,
+        'StoredBytes':storedBytes,
+    }
+
+
+def runBenchmark(memberCount: int, messageCount: int, payloadSizes: list[int]):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for payloadBytes in payloadSizes:
+            copies = runLayout(directory, 'copies' + str(payloadBytes), addToMailboxCopies, memberCount, messageCount, payloadBytes)
+            shared = runLayout(directory, 'shared' + str(payloadBytes), addToMailboxShared, memberCount, messageCount, payloadBytes)
+            results.append({
+                'Members':memberCount,
+                'Messages':messageCount,
+                'PayloadBytes':payloadBytes,
+                'Copies':copies,
+                'Shared':shared,
+                'StorageRatio':copies['StoredBytes'] / max(1, shared['StoredBytes']),
+                'WriteSpeedup':copies['WriteMsPerMessage'] / shared['WriteMsPerMessage'],
+            })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark per-recipient mailbox copies against shared mailbox bodies.')
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--payload-bytes', type=int, nargs='+', default=[200, 20000, 200000])
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    results = runBenchmark(args.members, args.messages, args.payload_bytes)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'payload':>9} {'copies MB':>10} {'shared MB':>10} {'ratio':>7} {'copies ms/msg':>14} {'shared ms/msg':>14} {'speedup':>8}")
+        for row in results:
+            print(f"{row['PayloadBytes']:>9} {row['Copies']['StoredBytes'] / 1e6:>10.2f} {row['Shared']['StoredBytes'] / 1e6:>10.2f} {row['StorageRatio']:>7.1f}"
+                  f" {row['Copies']['WriteMsPerMessage']:>14.2f} {row['Shared']['WriteMsPerMessage']:>14.2f} {row['WriteSpeedup']:>8.1f}")
@@ -0,0 +1,397 @@
+import argparse
+import inspect
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import crypto
+import dmaftServerDB
+
+#Benchmarks for every dmaftServerDB operation at realistic table sizes.
+#Each scale gets a fresh temporary database seeded with that many users, conversations, tokens, challenges and mailbox rows,
+#so the real master.db is never touched. Every operation is timed call by call (mean, p50 and p99 microseconds), and a few
+#extra calls run under tracemalloc first to record the peak Python memory a single call allocates.
+#tracemalloc only sees Python allocations; SQLite's own page cache and sort buffers aren't included.
+#
+#Results are JSON (--json / --output) and can be compared against an earlier run with --baseline,
+#which lists every operation whose p50 got slower by more than --threshold and exits with status 1 if there are any.
+
+#Not storage operations: setup, schema and connection helpers.
+notBenchmarked = {'executeQuery', 'initTable', 'getAllTables', 'getAllTableSchemas', 'closeDB', 'migrateDB', 'insertWithNewIDs'}
+
+
+def openTempDB(directory: str, name: str):
+    connection = sqlite3.connect(os.path.join(directory, name))
+    connection.execute('PRAGMA journal_mode=WAL;')
+    connection.execute('PRAGMA synchronous=NORMAL;')
+    dmaftServerDB.migrateDB(connection=connection)
+    return connection
+
+
+#Syllables for generating varied user names, so prefix and substring searches match realistic fractions of the table.
+nameSyllables = ['an', 'be', 'ca', 'do', 'el', 'fi', 'go', 'ha', 'is', 'jo', 'ka', 'li', 'mo', 'na', 'or', 'pe', 'qu', 'ra', 'si', 'tu']
+
+def makeUserName(i: int):
+    name = ''
+    for digit in range(4):
+        name += nameSyllables[i % len(nameSyllables)]
+        i //= len(nameSyllables)
+    return name.capitalize() + str(i)
+
+
+def makeTokenSecret(i: int):
+    return i.to_bytes(32, 'big')
+
+
+def makeMailboxMessage(conversationID: str, senderID: str, i: int):
+    return json.dumps({
+        'Command':'INCOMINGMESSAGE',
+        'OriginalReceiptTimestamp':int(time.time()),
+        'SenderId':senderID,
+        'ConversationId':conversationID,
+        'MessageType':'Text',
+        'MessageData':'benchmark message ' + str(i) + ' ' + 'x' * 120,
+        'MessageId':str(i),
+    })
+
+
+#Fills the database with count users (with searchable names), count two-member conversations, one token per user,
+#count // 10 challenges and count mailbox rows sharing a body per ten recipients.
+#Returns the generated IDs.
+def seedDatabase(connection: sqlite3.Connection, count: int, batchSize: int = 50000):
+    seed = {'UserIDs':[], 'ConversationIDs':[], 'TokenIDs':[], 'ChallengeIDs':[]}
+    now = int(time.time())
+    userIDs = [str(uuid.uuid4()).upper() for i in range(count)]
+    seed['UserIDs'] = userIDs
+
+    for start in range(0, count, batchSize):
+        users = []
+        searchRows = []
+        conversations = []
+        members = []
+        tokens = []
+        challenges = []
+        bodies = []
+        mailbox = []
+        for i in range(start, min(count, start + batchSize)):
+            userID = userIDs[i]
+            partnerID = userIDs[(i + 1) % count]
+            conversationID = str(uuid.uuid4()).upper()
+            tokenID = str(uuid.uuid4()).upper()
+            users.append((userID, os.urandom(64), makeUserName(i), i + 1))
+            searchRows.append((i + 1, makeUserName(i), userID))
+            conversations.append((conversationID, json.dumps([userID, partnerID])))
+            members.extend([(conversationID, userID), (conversationID, partnerID)])
+            tokens.append((tokenID, crypto.getSHA256(makeTokenSecret(i)), userID, now + 86400))
+            seed['ConversationIDs'].append(conversationID)
+            seed['TokenIDs'].append(tokenID)
+
+            if i % 10 == 0:
+                challengeID = str(uuid.uuid4()).upper()
+                challenges.append((challengeID, os.urandom(32), os.urandom(294), userID, now + 300))
+                seed['ChallengeIDs'].append(challengeID)
+                bodies.append((i // 10 + 1, min(10, count - i), makeMailboxMessage(conversationID, userID, i).encode('utf-8')))
+            mailbox.append((conversationID, now, now + 604800, partnerID, '', i // 10 + 1))
+
+        with connection:
+            connection.executemany('INSERT INTO tblRegisteredUsers (UserID, UserPublicKeySHA2_512, UserName, SearchRowID) VALUES (?,?,?,?);', users)
+            connection.executemany('INSERT INTO tblUserSearch (rowid, UserName, UserID) VALUES (?,?,?);', searchRows)
+            connection.executemany('INSERT INTO tblConversations (ConversationID, Participants) VALUES (?,?);', conversations)
+            connection.executemany('INSERT OR IGNORE INTO tblConversationMembers (ConversationID, UserID) VALUES (?,?);', members)
+            connection.executemany('INSERT INTO tblTokens (TokenID, TokenHash, User, ExpireTimestamp) VALUES (?,?,?,?);', tokens)
+            connection.executemany('INSERT INTO tblChallenges (ChallengeID, Challenge, UserPublicKey, User, ExpireTimestamp) VALUES (?,?,?,?,?);', challenges)
+            connection.executemany('INSERT INTO tblMailboxBodies (BodyID, RefCount, Message) VALUES (?,?,?);', bodies)
+            connection.executemany('INSERT INTO tblMailbox (ConversationID, ArriveTimestamp, ExpireTimestamp, Recipient, Message, BodyID) VALUES (?,?,?,?,?,?);', mailbox)
+    connection.execute('ANALYZE;')
+    return seed
+
+
+#One benchmarked operation.
+#makeArgs(n) returns the arguments for n calls; call(arg) runs the operation once.
+#Read-only operations may return fewer arguments, which are then reused in turn. Operations that change the
+#database return n distinct arguments (preparing any rows they need, untimed), so every call does real work.
+#Sweeps that act on whatever has expired use prepare instead, which runs untimed before each call.
+class Case:
+    def __init__(self, name: str, function: str, makeArgs, call, *, prepare = None, writes: bool = False, scans: bool = False):
+        self.name = name
+        self.function = function
+        self.makeArgs = makeArgs
+        self.call = call
+        self.prepare = prepare
+        self.writes = writes
+        self.scans = scans #O(table) by design (sweeps, stats): run far fewer times
+
+
+def defineCases(connection: sqlite3.Connection, seed: dict, rng: random.Random):
+    userIDs = seed['UserIDs']
+    half = len(userIDs) // 2
+    #Reads sample the first half of everything, writes consume the second half, so deletes don't turn reads into misses.
+    readUsers = userIDs[:half]
+    readIndexes = list(range(half))
+    msgDict = json.loads(makeMailboxMessage(seed['ConversationIDs'][0], userIDs[0], 0))
+    publicKey = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()
+    searchPrefixes = [first + second for first in nameSyllables for second in nameSyllables]
+    searchSubstrings = [term[1:] + 'a' for term in searchPrefixes]
+    #A ten-member group conversation for batch deliveries; every recipient has to be a member.
+    groupMembers = rng.sample(readUsers, min(10, half))
+    groupID = dmaftServerDB.createNewConversation(connection=connection, userIDs=groupMembers)
+
+    def sample(items: list, n: int):
+        return [rng.choice(items) for i in range(min(n, 1000))]
+
+    def lower(items: list):
+        return [item.lower() for item in items]
+
+    def missing(n: int):
+        return [str(uuid.uuid4()) for i in range(min(n, 1000))]
+
+    #makeArgs for a write that uses up seeded rows: transform(i) for up to n indexes into the second half of the seed.
+    #Each such case gets an equal, separate slice of it, so at small scales they get fewer calls rather than running out.
+    writeSlices = []
+    def fromWriteRows(transform):
+        slot = len(writeSlices)
+        writeSlices.append(slot)
+        def makeArgs(n: int):
+            share = (len(userIDs) - half) // len(writeSlices)
+            if share == 0:
+                raise RuntimeError("benchServerDB: Too few seeded rows to give every write its own; use a larger scale.")
+            start = half + slot * share
+            return [transform(i) for i in range(start, start + min(n, share))]
+        makeArgs.usesSeedRows = True
+        return makeArgs
+
+    def newChallenges(n: int):
+        ids = dmaftServerDB.addChallenges(connection=connection, challenges=[os.urandom(32)] * n, publicKeys=[os.urandom(294)] * n, userIDs=[None] * n)
+        return [row[0] for row in ids]
+
+    def newMailboxRows(n: int):
+        start = connection.execute('SELECT COALESCE(MAX(ROWID), 0) FROM tblMailbox;').fetchone()[0]
+        recipients = [groupMembers[i % len(groupMembers)] for i in range(n)]
+        dmaftServerDB.addToMailboxBatch(connection=connection, conversationID=groupID, expireTime=int(time.time()) + 604800, recipientIDs=recipients, msgDict=msgDict)
+        return [row[0] for row in connection.execute('SELECT ROWID FROM tblMailbox WHERE ROWID > ? ORDER BY ROWID;', [start])]
+
+    #Expires the newest rows of a table, so each sweep has something to delete.
+    def expireRows(tableName: str, n: int = 100):
+        with connection:
+            connection.execute('UPDATE ' + tableName + ' SET ExpireTimestamp = 0 WHERE ROWID IN (SELECT ROWID FROM ' + tableName + ' ORDER BY ROWID DESC LIMIT ?);', [n])
+
+    db = dmaftServerDB
+    return [
+        #USERS
+        Case('doesUserExistHit', 'doesUserExist', lambda n: lower(sample(readUsers, n)), lambda userID: db.doesUserExist(connection=connection, userID=userID)),
+        Case('doesUserExistMiss', 'doesUserExist', missing, lambda userID: db.doesUserExist(connection=connection, userID=userID)),
+        Case('verifyPublicKey', 'verifyPublicKey', lambda n: sample(readUsers, n), lambda userID: db.verifyPublicKey(connection=connection, userID=userID, publicKey=publicKey)),
+        Case('searchUserByID', 'searchUserByID', lambda n: sample(readUsers, n), lambda userID: db.searchUserByID(connection=connection, userID=userID)),
+        Case('getProfileSummaries50', 'getProfileSummaries', lambda n: [rng.sample(readUsers, min(50, half)) for i in range(min(n, 100))], lambda ids: db.getProfileSummaries(connection=connection, userIDs=ids)),
+        Case('getProfiles50', 'getProfiles', lambda n: [rng.sample(readUsers, min(50, half)) for i in range(min(n, 100))], lambda ids: db.getProfiles(connection=connection, userIDs=ids)),
+        Case('searchUsersByNamePrefix', 'searchUsersByName', lambda n: searchPrefixes, lambda term: db.searchUsersByName(connection=connection, userName=term)),
+        Case('searchUsersByNameSubstring', 'searchUsersByNamePage', lambda n: searchSubstrings, lambda term: db.searchUsersByNamePage(connection=connection, userName=term)),
+        Case('registerUser', 'registerUser', lambda n: [publicKey] * n, lambda key: db.registerUser(connection=connection, publicKey=key), writes=True),
+        Case('registerUsers10', 'registerUsers', lambda n: [[publicKey] * 10] * n, lambda keys: db.registerUsers(connection=connection, publicKeys=keys), writes=True),
+        Case('updateUserProfileData', 'updateUserProfileData', fromWriteRows(lambda i: userIDs[i]),
+             lambda userID: db.updateUserProfileData(connection=connection, userID=userID, userName='Renamed' + userID[:8], userBio='bio', userStatus='status', userPic=b'p' * 2048), writes=True),
+
+        #CHALLENGES
+        Case('addChallenges', 'addChallenges', lambda n: [None] * n, lambda unused: db.addChallenges(connection=connection, challenges=[os.urandom(32)], publicKeys=[os.urandom(294)], userIDs=[None]), writes=True),
+        Case('getChallenge', 'getChallenge', lambda n: sample(seed['ChallengeIDs'], n), lambda challengeID: db.getChallenge(connection=connection, challengeID=challengeID)),
+        Case('deleteChallengesWithUUID', 'deleteChallengesWithUUID', newChallenges, lambda challengeID: db.deleteChallengesWithUUID(connection=connection, challengeID=challengeID), writes=True),
+        Case('pruneChallenges', 'pruneChallenges', lambda n: [None], lambda unused: db.pruneChallenges(connection=connection), prepare=lambda: expireRows('tblChallenges'), writes=True, scans=True),
+
+        #TOKENS
+        Case('createToken', 'createToken', fromWriteRows(lambda i: userIDs[i]), lambda userID: db.createToken(connection=connection, userID=userID), writes=True),
+        Case('getToken', 'getToken', lambda n: [seed['TokenIDs'][i] for i in sample(readIndexes, n)], lambda tokenID: db.getToken(connection=connection, tokenID=tokenID)),
+        Case('validateToken', 'validateToken', lambda n: sample(readIndexes, n), lambda i: db.validateToken(connection=connection, tokenID=seed['TokenIDs'][i], tokenSecret=makeTokenSecret(i))),
+        Case('deleteTokensWithID', 'deleteTokensWithID', fromWriteRows(lambda i: seed['TokenIDs'][i]), lambda tokenID: db.deleteTokensWithID(connection=connection, tokenID=tokenID), writes=True),
+        Case('deleteTokensWithUserID', 'deleteTokensWithUserID', fromWriteRows(lambda i: userIDs[i]), lambda userID: db.deleteTokensWithUserID(connection=connection, userID=userID), writes=True),
+        Case('pruneTokens', 'pruneTokens', lambda n: [None], lambda unused: db.pruneTokens(connection=connection), prepare=lambda: expireRows('tblTokens'), writes=True, scans=True),
+
+        #CONVERSATIONS
+        Case('createNewConversation3', 'createNewConversation', lambda n: [rng.sample(readUsers, min(3, half)) for i in range(n)], lambda ids: db.createNewConversation(connection=connection, userIDs=ids), writes=True),
+        Case('storeConversation3', 'storeConversation', lambda n: [(str(uuid.uuid4()).upper(), rng.sample(readUsers, min(3, half))) for i in range(n)],
+             lambda args: db.storeConversation(connection=connection, conversationID=args[0], userIDs=args[1]), writes=True),
+        Case('getConversationByID', 'getConversationByID', lambda n: sample(seed['ConversationIDs'][:half], n), lambda conversationID: db.getConversationByID(connection=connection, conversationID=conversationID)),
+        Case('doesConversationExistHit', 'doesConversationExist', lambda n: lower(sample(seed['ConversationIDs'][:half], n)), lambda conversationID: db.doesConversationExist(connection=connection, conversationID=conversationID)),
+        Case('doesConversationExistMiss', 'doesConversationExist', missing, lambda conversationID: db.doesConversationExist(connection=connection, conversationID=conversationID)),
+        Case('getConversationMembers', 'getConversationMembers', lambda n: sample(seed['ConversationIDs'][:half], n), lambda conversationID: db.getConversationMembers(connection=connection, conversationID=conversationID)),
+        Case('isUserInConversation', 'isUserInConversation', lambda n: sample(readIndexes, n), lambda i: db.isUserInConversation(connection=connection, conversationID=seed['ConversationIDs'][i], userID=userIDs[i])),
+        Case('getConversationsForUser', 'getConversationsForUser', lambda n: sample(readUsers, n), lambda userID: db.getConversationsForUser(connection=connection, userID=userID)),
+        Case('getConversationMembersForUser', 'getConversationMembersForUser', lambda n: sample(readUsers, n), lambda userID: db.getConversationMembersForUser(connection=connection, userID=userID)),
+        Case('removeUserFromConversation', 'removeUserFromConversation', fromWriteRows(lambda i: i), lambda i: db.removeUserFromConversation(connection=connection, conversationID=seed['ConversationIDs'][i], userID=userIDs[i]), writes=True),
+
+        #MAILBOX
+        Case('addToMailbox', 'addToMailbox', lambda n: sample(readIndexes, n),
+             lambda i: db.addToMailbox(connection=connection, conversationID=seed['ConversationIDs'][i], expireTime=int(time.time()) + 604800, recipientID=userIDs[(i + 1) % len(userIDs)], msgDict=msgDict), writes=True),
+        Case('addToMailboxBatch10', 'addToMailboxBatch', lambda n: [None],
+             lambda unused: db.addToMailboxBatch(connection=connection, conversationID=groupID, expireTime=int(time.time()) + 604800, recipientIDs=groupMembers, msgDict=msgDict), writes=True),
+        Case('getMsgsForUser', 'getMsgsForUser', lambda n: sample(readUsers, n), lambda userID: db.getMsgsForUser(connection=connection, userID=userID)),
+        Case('getMailboxPage', 'getMailboxPage', lambda n: sample(readUsers, n), lambda userID: db.getMailboxPage(connection=connection, userID=userID)),
+        Case('deleteMsgFromMailbox', 'deleteMsgFromMailbox', newMailboxRows, lambda rowID: db.deleteMsgFromMailbox(connection=connection, rowID=rowID), writes=True),
+        Case('deleteMsgsFromMailbox10', 'deleteMsgsFromMailbox', lambda n: [rows[i:i + 10] for rows in [newMailboxRows(n * 10)] for i in range(0, n * 10, 10)],
+             lambda rowIDs: db.deleteMsgsFromMailbox(connection=connection, rowIDs=rowIDs), writes=True),
+        Case('deleteAllMsgsForUser', 'deleteAllMsgsForUser', fromWriteRows(lambda i: userIDs[(i + 1) % len(userIDs)]), lambda userID: db.deleteAllMsgsForUser(connection=connection, userID=userID), writes=True),
+        Case('purgeOldMailboxItems', 'purgeOldMailboxItems', lambda n: [None], lambda unused: db.purgeOldMailboxItems(connection=connection), prepare=lambda: expireRows('tblMailbox'), writes=True, scans=True),
+        Case('deleteExpiredRows', 'deleteExpiredRows', lambda n: [None], lambda unused: db.deleteExpiredRows(connection=connection, tableName='tblMailbox'), prepare=lambda: expireRows('tblMailbox'), writes=True, scans=True),
+        Case('getMailboxStats', 'getMailboxStats', lambda n: [None], lambda unused: db.getMailboxStats(connection=connection), scans=True),
+    ]
+
+
+#Public dmaftServerDB functions that take a connection but have no Case, so new operations don't go unmeasured.
+def findUnbenchmarked(cases: list):
+    covered = {case.function for case in cases}
+    missingFunctions = []
+    for name, func in inspect.getmembers(dmaftServerDB, inspect.isfunction):
+        func = inspect.unwrap(func)
+        if name.startswith('_') or name in notBenchmarked or name in covered or func.__module__ != dmaftServerDB.__name__:
+            continue
+        if 'connection' in inspect.signature(func).parameters:
+            missingFunctions.append(name)
+    return missingFunctions
+
+
+def percentile(ordered: list, fraction: float):
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+#Runs one case: memorySamples calls under tracemalloc (peak bytes allocated by a single call), then iterations timed calls.
+def runCase(case: Case, iterations: int, memorySamples: int):
+    args = case.makeArgs(memorySamples + iterations)
+    argIndex = 0
+    #A write that ran short of seeded rows (see fromWriteRows) makes fewer calls rather than repeat any.
+    if getattr(case.makeArgs, 'usesSeedRows', False) and len(args) < memorySamples + iterations:
+        memorySamples = min(memorySamples, len(args) // 10)
+        iterations = len(args) - memorySamples
+
+    tracemalloc.start()
+    peakBytes = 0
+    for i in range(memorySamples):
+        if case.prepare is not None:
+            case.prepare()
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        case.call(args[argIndex % len(args)])
+        argIndex += 1
+        peakBytes = max(peakBytes, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    durations = []
+    for i in range(iterations):
+        arg = args[argIndex % len(args)]
+        argIndex += 1
+        if case.prepare is not None:
+            case.prepare()
+        start = time.perf_counter()
+        case.call(arg)
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    return {
+        'Function':case.function,
+        'Calls':len(durations),
+        'MeanUs':sum(durations) / len(durations) * 1e6,
+        'P50Us':percentile(durations, 0.50) * 1e6,
+        'P99Us':percentile(durations, 0.99) * 1e6,
+        'PeakKiB':peakBytes / 1024,
+    }
+
+
+def runSuite(scales: list[int], iterations: int, writeIterations: int, memorySamples: int, only: list[str] = None, seedValue: int = 1):
+    results = []
+    unbenchmarked = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in scales:
+            connection = openTempDB(directory, 'bench' + str(scale) + '.db')
+            start = time.perf_counter()
+            seed = seedDatabase(connection, scale)
+            seedSeconds = time.perf_counter() - start
+
+            cases = defineCases(connection, seed, random.Random(seedValue))
+            unbenchmarked = findUnbenchmarked(cases)
+            operations = {}
+            for case in cases:
+                if only and case.name not in only and case.function not in only:
+                    continue
+                count = writeIterations if case.writes else iterations
+                if case.scans:
+                    count = max(1, count // 20)
+                operations[case.name] = runCase(case, count, min(memorySamples, count))
+            connection.close()
+            results.append({'Rows':scale, 'SeedSeconds':seedSeconds, 'Operations':operations})
+
+    return {
+        'Meta':{
+            'Python':platform.python_version(),
+            'SQLite':sqlite3.sqlite_version,
+            'Platform':platform.platform(),
+            'Iterations':iterations,
+            'WriteIterations':writeIterations,
+            'MemorySamples':memorySamples,
+            'Timestamp':int(time.time()),
+        },
+        'Results':results,
+        'Unbenchmarked':unbenchmarked,
+    }
+
+
+#Returns [(rows, operation, baseline p50, current p50, ratio)] for every operation that got slower than threshold times its baseline p50.
+def compareToBaseline(current: dict, baseline: dict, threshold: float):
+    baselineRows = {row['Rows']: row['Operations'] for row in baseline.get('Results', [])}
+    regressions = []
+    for row in current['Results']:
+        before = baselineRows.get(row['Rows'], {})
+        for name, stats in row['Operations'].items():
+            if name not in before or before[name]['P50Us'] <= 0:
+                continue
+            ratio = stats['P50Us'] / before[name]['P50Us']
+            if ratio > threshold:
+                regressions.append((row['Rows'], name, before[name]['P50Us'], stats['P50Us'], ratio))
+    return regressions
+
+
+def printReport(report: dict):
+    for row in report['Results']:
+        print(f"{row['Rows']} rows (seeded in {row['SeedSeconds']:.1f}s)")
+        print(f"  {'operation':<30} {'calls':>6} {'mean us':>10} {'p50 us':>10} {'p99 us':>10} {'peak KiB':>9}")
+        for name, stats in row['Operations'].items():
+            print(f"  {name:<30} {stats['Calls']:>6} {stats['MeanUs']:>10.1f} {stats['P50Us']:>10.1f} {stats['P99Us']:>10.1f} {stats['PeakKiB']:>9.1f}")
+    if report['Unbenchmarked']:
+        print("Not benchmarked:", ', '.join(report['Unbenchmarked']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark every dmaftServerDB operation at increasing table sizes.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000, 1000000], help='Users, tokens, conversations and mailbox rows to seed.')
+    parser.add_argument('--iterations', type=int, default=2000, help='Timed calls per read operation.')
+    parser.add_argument('--write-iterations', type=int, default=200, help='Timed calls per write operation.')
+    parser.add_argument('--memory-samples', type=int, default=20, help='Calls per operation run under tracemalloc.')
+    parser.add_argument('--only', nargs='+', help='Only run these operations (case or function names).')
+    parser.add_argument('--baseline', help='JSON from an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=1.5, help='Flag operations whose p50 grew by more than this factor.')
+    parser.add_argument('--output', help='Also write the JSON results to this file (e.g. to use as a baseline).')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    report = runSuite(args.scales, args.iterations, args.write_iterations, args.memory_samples, args.only)
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        printReport(report)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baselineFile:
+            regressions = compareToBaseline(report, json.load(baselineFile), args.threshold)
+        for rows, name, before, after, ratio in regressions:
+            print(f"REGRESSION {name} at {rows} rows: p50 {before:.1f}us -> {after:.1f}us ({ratio:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,167 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import dmaftServerDB
+import serverConfig
+
+#Compares write throughput with and without the group-commit write queue (see WRITE QUEUE in dmaftServerDB.py).
+#Handler threads write what SENDMESSAGE writes for offline members, one addToMailboxBatch per message, all at once,
+#through borrowDB() on a fresh database in a temporary directory. Each mode runs for the same number of messages:
+#   direct         every write commits on its own handler thread, at the pool's synchronous=NORMAL (the old behaviour).
+#   direct-full    the same, but synchronous=FULL, so each write is on disk when it returns, as with the queue.
+#   queued         writes go through the writer thread, which commits them in batches at synchronous=FULL.
+#direct-full is the fair baseline for queued: both return only once the write is on disk. direct shows what that costs.
+#Run-to-run noise is large on a busy machine, so --repeat runs the modes in turn several times and reports medians.
+
+modes = ['direct', 'direct-full', 'queued']
+
+
+def seed(userCount: int, recipientCount: int):
+    publicKey = rsa.generate_private_key(public_exponent=65537, key_size=1024).public_key()
+    with dmaftServerDB.borrowDB() as connection:
+        userIDs = dmaftServerDB.registerUsers(connection=connection, publicKeys=[publicKey] * userCount)
+        conversations = []
+        for start in range(0, userCount - recipientCount + 1, recipientCount):
+            members = userIDs[start:start + recipientCount]
+            conversations.append((dmaftServerDB.createNewConversation(connection=connection, userIDs=members), members))
+    return conversations
+
+
+#Sets synchronous=FULL on every connection the pool will hand out.
+def makePoolDurable(pool: dmaftServerDB.ConnectionPool):
+    connections = [pool.acquire() for i in range(pool.size)]
+    for connection in connections:
+        connection.execute('PRAGMA synchronous=FULL;')
+    for connection in connections:
+        pool.release(connection)
+
+
+#Returns (batches committed, writes in them) so far, from dmaft_db_write_batch_size.
+def getBatchTotals():
+    state = dmaftServerDB.writeBatchSizes.values.get((), None)
+    if state is None:
+        return 0, 0
+    return sum(state[:-1]), state[-1]
+
+
+def runMode(mode: str, *, threads: int, messages: int, users: int, recipients: int, bodyBytes: int, batchSize: int, batchWaitMs: int):
+    with tempfile.TemporaryDirectory(prefix='dmaft-bench-writes-') as directory:
+        backend = dmaftServerDB.configureBackend(
+            backend='sqlite',
+            path=os.path.join(directory, 'bench.db'),
+            size=threads,
+            writeBatchSize=batchSize if mode == 'queued' else 0,
+            writeBatchWaitMs=batchWaitMs,
+            )
+        try:
+            conversations = seed(users, recipients)
+            if mode == 'direct-full':
+                makePoolDurable(backend)
+
+            body = 'x' * bodyBytes
+            expireTime = int(time.time()) + 3600
+            latencies = []
+            latenciesLock = threading.Lock()
+            failures = [0]
+            def sendMessage(i: int):
+                conversationID, members = conversations[i % len(conversations)]
+                start = time.perf_counter()
+                with dmaftServerDB.borrowDB() as connection:
+                    stored = dmaftServerDB.addToMailboxBatch(connection=connection, conversationID=conversationID, expireTime=expireTime, recipientIDs=members, msgDict={'Sequence':i, 'Body':body})
+                elapsed = time.perf_counter() - start
+                with latenciesLock:
+                    latencies.append(elapsed)
+                    if not stored:
+                        failures[0] += 1
+
+            batchesBefore, writesBefore = getBatchTotals()
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(sendMessage, range(messages)))
+            seconds = time.perf_counter() - start
+            batchesAfter, writesAfter = getBatchTotals()
+
+            with dmaftServerDB.borrowDB() as connection:
+                stored = dmaftServerDB.getMailboxStats(connection=connection)['Messages']
+        finally:
+            dmaftServerDB.configureBackend(backend='memory', writeBatchSize=0).closeAll()
+
+    latencies.sort()
+    batches = batchesAfter - batchesBefore
+    return {
+        'Mode':mode,
+        'Messages':messages,
+        'Seconds':seconds,
+        'MessagesPerSecond':messages / seconds,
+        'P50Ms':statistics.median(latencies) * 1000,
+        'P99Ms':latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'MeanBatch':(writesAfter - writesBefore) / batches if batches > 0 else None,
+        'Failures':failures[0],
+        'RowsStored':stored,
+        'RowsExpected':messages * recipients,
+    }
+
+
+#Folds repeated runs of each mode into one summary with the median rate and latencies, and the totals.
+def summarize(runs: list):
+    summaries = []
+    for mode in dict.fromkeys(run['Mode'] for run in runs):
+        modeRuns = [run for run in runs if run['Mode'] == mode]
+        batches = [run['MeanBatch'] for run in modeRuns if run['MeanBatch'] is not None]
+        summaries.append({
+            'Mode':mode,
+            'Runs':len(modeRuns),
+            'MessagesPerSecond':statistics.median(run['MessagesPerSecond'] for run in modeRuns),
+            'MinMessagesPerSecond':min(run['MessagesPerSecond'] for run in modeRuns),
+            'MaxMessagesPerSecond':max(run['MessagesPerSecond'] for run in modeRuns),
+            'P50Ms':statistics.median(run['P50Ms'] for run in modeRuns),
+            'P99Ms':statistics.median(run['P99Ms'] for run in modeRuns),
+            'MeanBatch':statistics.median(batches) if batches else None,
+            'Failures':sum(run['Failures'] for run in modeRuns),
+            'RowsStored':sum(run['RowsStored'] for run in modeRuns),
+            'RowsExpected':sum(run['RowsExpected'] for run in modeRuns),
+        })
+    return summaries
+
+
+def printReport(summaries: list):
+    rates = {summary['Mode']: summary['MessagesPerSecond'] for summary in summaries}
+    def ratio(summary, baseline):
+        return f"{summary['MessagesPerSecond'] / rates[baseline]:>8.2f}x" if baseline in rates else f"{'-':>9}"
+    print(f"{'mode':<12} {'runs':>4} {'msgs/s':>9} {'range':>15} {'vs direct':>9} {'vs full':>9} {'p50 ms':>8} {'p99 ms':>8} {'batch':>6} {'rows':>15} {'failures':>9}")
+    for summary in summaries:
+        spread = f"{summary['MinMessagesPerSecond']:.0f}-{summary['MaxMessagesPerSecond']:.0f}"
+        rows = str(summary['RowsStored']) + '/' + str(summary['RowsExpected'])
+        batch = '-' if summary['MeanBatch'] is None else f"{summary['MeanBatch']:.1f}"
+        print(f"{summary['Mode']:<12} {summary['Runs']:>4} {summary['MessagesPerSecond']:>9.1f} {spread:>15} {ratio(summary, 'direct')} {ratio(summary, 'direct-full')} {summary['P50Ms']:>8.2f} {summary['P99Ms']:>8.2f} {batch:>6} {rows:>15} {summary['Failures']:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare concurrent mailbox write throughput with and without the write queue.')
+    parser.add_argument('--modes', nargs='+', choices=modes, default=modes)
+    parser.add_argument('--threads', type=int, default=serverConfig.WORKER_THREADS, help='Concurrent writers, like the server\'s worker threads.')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--recipients', type=int, default=10, help='Offline members each message is queued for.')
+    parser.add_argument('--body-bytes', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=serverConfig.DB_WRITE_BATCH_SIZE or 256)
+    parser.add_argument('--batch-wait-ms', type=int, default=serverConfig.DB_WRITE_BATCH_WAIT_MS)
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each mode; the report shows medians.')
+    parser.add_argument('--output', help='Also write every run\'s results as JSON to this file.')
+    args = parser.parse_args()
+
+    runs = []
+    for mode in args.modes * args.repeat:
+        runs.append(runMode(mode, threads=args.threads, messages=args.messages, users=args.users, recipients=args.recipients, bodyBytes=args.body_bytes, batchSize=args.batch_size, batchWaitMs=args.batch_wait_ms))
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            json.dump(runs, outputFile, indent=2)
+    printReport(summarize(runs))
@@ -0,0 +1,229 @@
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import threading
+import time
+
+import serverConfig
+
+#Content-addressed attachment storage on local disk.
+#A finished blob lives at <BLOB_DIR>/<first two hex digits>/<full SHA-256 hex>, so the same file uploaded twice
+#(or sent to many recipients) is stored once. Messages only carry a BlobRef pointing at it:
+#   {'Sha256': '<64 hex digits>', 'Size': <bytes>}
+#Uploads arrive in chunks and are appended to <BLOB_DIR>/uploads/<UserId>-<Sha256>.part, so an interrupted upload
+#resumes from the size of its partial file. Once the last chunk is in, the file is hashed and moved into place.
+#Downloads are served chunk by chunk from a memory map, so a large blob is never read into memory whole.
+#
+#Knowing a blob's hash is not enough to use it. A user owns a blob once they have uploaded all of it and it hashed
+#correctly, even if it was already stored; the caller records that (dmaftServerDB.addBlobOwner) and checks who may
+#download it (dmaftServerDB.canUserReadBlob).
+
+_sha256Pattern = re.compile(r'^[0-9a-f]{64}$')
+
+#Each partial upload has its own lock, so a chunk's size check and append can't interleave with another socket's
+#for the same upload, while other uploads (and the final hashing) carry on in parallel.
+#Within a process that's a threading lock; the partial file is also flock()ed, because with SERVER_WORKERS above 1
+#the same user's sockets can be in different processes.
+#(upper-cased UserId, Sha256) -> [lock, number of threads using it]
+_uploadLocks = {}
+_uploadLocksLock = threading.Lock()
+
+
+class BlobError(ValueError):
+    def __init__(self, errorCode: str, reason: str, nextOffset: int = None):
+        super().__init__(reason)
+        self.errorCode = errorCode
+        self.reason = reason
+        self.nextOffset = nextOffset
+
+
+def isValidSha256(sha256: str):
+    return type(sha256) == str and _sha256Pattern.match(sha256) is not None
+
+
+def getBlobPath(sha256: str):
+    return os.path.join(serverConfig.BLOB_DIR, sha256[:2], sha256)
+
+
+def _getUploadPath(userID: str, sha256: str):
+    return os.path.join(serverConfig.BLOB_DIR, 'uploads', str(userID).upper() + '-' + sha256 + '.part')
+
+
+#Locks the upload and yields its partial file, open for appending.
+#create=False raises FileNotFoundError instead of starting a partial file that doesn't exist.
+@contextlib.contextmanager
+def _lockUpload(userID: str, sha256: str, create: bool = True):
+    key = (str(userID).upper(), sha256)
+    with _uploadLocksLock:
+        entry = _uploadLocks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            with _openLockedPartial(_getUploadPath(userID, sha256), create) as partial:
+                yield partial
+    finally:
+        with _uploadLocksLock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _uploadLocks[key]
+
+
+#The process holding the flock may finish the upload (moving the file into place) or purge it, so once we have the
+#lock we check the path still names the file we locked, and start over on the new one if not.
+@contextlib.contextmanager
+def _openLockedPartial(path: str, create: bool):
+    if create:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    while True:
+        partial = os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | (os.O_CREAT if create else 0), 0o666), 'ab')
+        try:
+            fcntl.flock(partial.fileno(), fcntl.LOCK_EX)
+            try:
+                current = os.path.samestat(os.fstat(partial.fileno()), os.stat(path))
+            except FileNotFoundError:
+                current = False
+        except:
+            partial.close()
+            raise
+        if current:
+            break
+        partial.close()
+
+    #Closing the file releases the flock.
+    with partial:
+        yield partial
+
+
+def makeBlobRef(sha256: str, size: int):
+    return {'Sha256':sha256, 'Size':size}
+
+
+#Returns the blob's size in bytes, or None if it isn't stored.
+def getBlobSize(sha256: str):
+    if not isValidSha256(sha256):
+        return None
+    try:
+        return os.path.getsize(getBlobPath(sha256))
+    except OSError:
+        return None
+
+
+#Checks that a BlobRef from a client names a stored blob of the size it claims.
+def isValidBlobRef(blobRef):
+    if type(blobRef) != dict:
+        return False
+    size = getBlobSize(blobRef.get('Sha256'))
+    return size is not None and blobRef.get('Size') == size
+
+
+#Appends one chunk to an upload and returns (nextOffset, blobRef). blobRef is None until the upload is complete.
+#offset must equal the number of bytes already received, so a client that lost track can ask again and resume.
+#owned says the user already owns the blob (see above): if it's stored, there's nothing left for them to send.
+#Raises BlobError if the request is invalid, the offset is wrong, or the finished file doesn't match its hash.
+def appendChunk(*, userID: str, sha256: str, size: int, offset: int, chunk: bytes, owned: bool = False):
+    if not isValidSha256(sha256):
+        raise BlobError('BadRequest', 'Sha256 must be 64 lower-case hex digits.')
+    if type(size) != int or size < 0 or size > serverConfig.BLOB_MAX_BYTES:
+        raise BlobError('BlobTooLarge', 'Attachments may be at most ' + str(serverConfig.BLOB_MAX_BYTES) + ' bytes.')
+    if len(chunk) > serverConfig.BLOB_CHUNK_BYTES:
+        raise BlobError('BadRequest', 'Chunks may be at most ' + str(serverConfig.BLOB_CHUNK_BYTES) + ' bytes.')
+
+    if owned and getBlobSize(sha256) == size:
+        return size, makeBlobRef(sha256, size)
+
+    with _lockUpload(userID, sha256) as partial:
+        uploadPath = _getUploadPath(userID, sha256)
+        received = os.fstat(partial.fileno()).st_size
+        if offset != received:
+            raise BlobError('InvalidOffset', 'Expected the chunk at offset ' + str(received) + '.', nextOffset=received)
+        if received + len(chunk) > size:
+            raise BlobError('BadRequest', 'The chunk runs past the declared size of the attachment.', nextOffset=received)
+
+        partial.write(chunk)
+        partial.flush()
+        received += len(chunk)
+
+        if received < size:
+            return received, None
+
+        #Last chunk: check the contents really hash to what the client claimed before publishing them.
+        if _hashFile(uploadPath) != sha256:
+            os.remove(uploadPath)
+            raise BlobError('BlobHashMismatch', 'The uploaded data does not match its SHA-256. Please upload it again.', nextOffset=0)
+
+        #If someone else stored it meanwhile, the contents are the same, so replacing it is harmless.
+        blobPath = getBlobPath(sha256)
+        os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+        os.replace(uploadPath, blobPath)
+        return size, makeBlobRef(sha256, size)
+
+
+def _hashFile(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as blobFile:
+        for block in iter(lambda: blobFile.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+#Stores a whole blob at once (scripts and tests). Returns its BlobRef.
+def putBytes(data: bytes):
+    sha256 = hashlib.sha256(data).hexdigest()
+    if getBlobSize(sha256) != len(data):
+        blobPath = getBlobPath(sha256)
+        os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+        tempPath = blobPath + '.' + str(os.getpid()) + '.tmp'
+        with open(tempPath, 'wb') as blobFile:
+            blobFile.write(data)
+        os.replace(tempPath, blobPath)
+    return makeBlobRef(sha256, len(data))
+
+
+#Returns up to length bytes of the blob starting at offset (capped at BLOB_CHUNK_BYTES).
+#Only the requested range is copied out of the memory map.
+#Raises BlobError if the blob doesn't exist or the offset is out of range.
+def readChunk(*, sha256: str, offset: int, length: int = None):
+    size = getBlobSize(sha256)
+    if size is None:
+        raise BlobError('InvalidBlobRef', 'The requested attachment does not exist.')
+    if type(offset) != int or offset < 0 or offset > size:
+        raise BlobError('InvalidOffset', 'The offset is outside of the attachment.')
+
+    if length is None or length > serverConfig.BLOB_CHUNK_BYTES:
+        length = serverConfig.BLOB_CHUNK_BYTES
+    end = min(size, offset + max(0, length))
+    if end == offset:
+        return b''
+
+    with open(getBlobPath(sha256), 'rb') as blobFile:
+        with mmap.mmap(blobFile.fileno(), 0, access=mmap.ACCESS_READ) as blobMap:
+            return blobMap[offset:end]
+
+
+#Deletes partial uploads nobody has added to in BLOB_UPLOAD_EXPIRY seconds.
+#Returns the number of files removed.
+def purgeStaleUploads(maxAge: int = None):
+    maxAge = serverConfig.BLOB_UPLOAD_EXPIRY if maxAge is None else maxAge
+    uploadDir = os.path.join(serverConfig.BLOB_DIR, 'uploads')
+    cutoff = time.time() - maxAge
+    purged = 0
+    try:
+        entries = list(os.scandir(uploadDir))
+    except FileNotFoundError:
+        return 0
+
+    for entry in entries:
+        if not entry.name.endswith('.part'):
+            continue
+        userID, dash, sha256 = entry.name[:-len('.part')].rpartition('-')
+        try:
+            with _lockUpload(userID, sha256, create=False) as partial:
+                if os.fstat(partial.fileno()).st_mtime < cutoff:
+                    os.remove(entry.path)
+                    purged += 1
+        except FileNotFoundError:
+            pass
+    return purged
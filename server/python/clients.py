@@ -2,84 +2,497 @@ import websockets
 import websockets.asyncio
 import websockets.asyncio.server
 import asyncio
-import copy
+import functools
+import threading
 
+import codec
+import metrics
+import serverConfig
+import serverLog
+
+log = serverLog.getLogger('clients')
+
+fanOutSockets = metrics.histogram('dmaft_fanout_sockets', 'Sockets a single outgoing message was queued on.', buckets=metrics.sizeBuckets)
+slowReaderDisconnects = metrics.counter('dmaft_outbox_disconnects_total', 'Sockets closed because the client fell behind on reading.')
+
+#Every socket gets an Outbox: a bounded queue of encoded frames drained by one writer task.
+#Queueing a frame returns a future that resolves to True once the frame has been handed to the socket, or False if it never will be
+#(the socket closed, or the client fell too far behind and was disconnected: a frame that takes OUTBOX_SEND_TIMEOUT to send).
+#A client that can't keep up is disconnected rather than left to grow server memory; anything it missed goes to its mailbox.
+#All methods must be called on the event loop that owns the socket.
+class Outbox:
+    def __init__(self, socket: websockets.asyncio.server.ServerConnection, *, onClosed = None, maxFrames: int = None, sendTimeout: float = None):
+        self.socket = socket
+        self.onClosed = onClosed
+        self.maxFrames = serverConfig.OUTBOX_MAX_FRAMES if maxFrames is None else maxFrames
+        self.sendTimeout = serverConfig.OUTBOX_SEND_TIMEOUT if sendTimeout is None else sendTimeout
+        self.queue = asyncio.Queue(maxsize=self.maxFrames)
+        self.writer = None
+        self.closed = False
+
+    #Queues an already-encoded frame and returns a future for its delivery.
+    #text says whether it goes out as a text frame (JSON) or a binary one.
+    def enqueue(self, frame: bytes, text: bool = True):
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            future.set_result(False)
+            return future
+
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._writeFrames())
+        try:
+            self.queue.put_nowait((frame, text, future))
+        except asyncio.QueueFull:
+            future.set_result(False)
+            self.close(reason='Client is reading too slowly')
+        return future
+
+    async def _writeFrames(self):
+        while True:
+            frame, text, future = await self.queue.get()
+            try:
+                #Frames are encoded once by the caller; text=True sends the UTF-8 bytes as a text frame without re-encoding.
+                await asyncio.wait_for(self.socket.send(frame, text=text), self.sendTimeout)
+            except asyncio.CancelledError:
+                #close() was called mid-send; the frame in hand is failed like the queued ones.
+                _resolve(future, False)
+                raise
+            except asyncio.TimeoutError:
+                _resolve(future, False)
+                self.close(reason='Client is reading too slowly')
+                return
+            except websockets.exceptions.ConnectionClosed:
+                _resolve(future, False)
+                self.close()
+                return
+            except Exception as e:
+                log.warning("Outbox: Failed to send a frame on socket ID %s: %s", self.socket.id, e)
+                _resolve(future, False)
+                continue
+            _resolve(future, True)
+
+    #Stops the writer and fails every queued frame.
+    #If a reason is given the socket is closed too (1013: try again later), so the client reconnects and drains its mailbox.
+    def close(self, reason: str = None):
+        if self.closed:
+            return
+        self.closed = True
+
+        while not self.queue.empty():
+            frame, text, future = self.queue.get_nowait()
+            _resolve(future, False)
+
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+        if reason is not None:
+            log.info("Outbox: Disconnecting socket ID %s: %s", self.socket.id, reason)
+            slowReaderDisconnects.inc()
+            asyncio.create_task(self.socket.close(code=1013, reason=reason))
+
+        if self.onClosed is not None:
+            self.onClosed(self.socket)
+
+
+def _resolve(future: asyncio.Future, result: bool):
+    if not future.done():
+        future.set_result(result)
+
+
+#Keeps track of every open websocket and the user (if any) authenticated on it.
+#Connections are indexed two ways so that every lookup is constant time:
+#   socketIndex: websocket -> {'UserId':..., 'Socket':...}
+#   userIndex: upper-cased UserID -> set of websockets
+#   topicIndex: upper-cased ConversationID -> {'Members': set of upper-cased UserIDs, 'Sockets': set of websockets}
+#   memberTopics: upper-cased UserID -> set of upper-cased ConversationIDs of the live topics the user is a member of
+#A conversation only has a topic while at least one of its members is online; its member set is loaded from the
+#database when a member authenticates, and kept up to date by the conversation handlers after that.
+#Live messages are routed from the topic without touching the database.
+#Broadcasts only wait for their frames to be queued, never for the sockets to send them, so a client that isn't reading
+#can't hold up a request handler. A frame that is dropped after being queued (the socket closed, or it fell behind and
+#was disconnected) is handed to onUndelivered, which tlsServer sets to put it in the user's mailbox.
+#Request handlers run on worker threads (see workers.py), so the indexes are guarded by a lock
+#and sends always go through the sockets' Outboxes on the event loop that owns them.
+#When the server runs as several processes, peers is this process's peerLink.PeerLink: users going online or
+#offline and topic changes are announced through it, and broadcasts also reach users connected to other processes.
 class ConnectionList:
     def __init__(self):
-        self.clients = []
+        self.socketIndex = {}
+        self.userIndex = {}
+        self.topicIndex = {}
+        self.memberTopics = {}
+        self.lock = threading.RLock()
+        self.loop = None
+        self.peers = None
+        self.onUndelivered = None #Called on the loop as onUndelivered(userIDs, msgData, mailbox) for frames dropped after being queued.
 
+    #Returns a list with the matching client entry, or an empty list if the socket isn't registered.
     def getClientFromSocket(self, socket: websockets.asyncio.server.ServerConnection):
-        return list(filter(lambda client: client['Socket'] == socket, self.clients))
-        #Credit to here for this method: https://stackoverflow.com/a/25373204
-    
+        client = self.socketIndex.get(socket)
+        if client is None:
+            return []
+        return [client]
+
     def getClientsFromUser(self, userID: str):
-        return list(filter(lambda client: str(client['UserId']).upper() == userID.upper(), self.clients))
+        with self.lock:
+            sockets = self.userIndex.get(str(userID).upper())
+            if not sockets:
+                return []
+            return [self.socketIndex[socket] for socket in sockets]
 
     def deleteSocket(self, socket: websockets.asyncio.server.ServerConnection):
-        for client in self.clients:
-            if client['Socket'] == socket:
-                self.clients.remove(client)
+        with self.lock:
+            client = self.socketIndex.pop(socket, None)
+            if client is not None:
+                self._unbindUser(socket, client['UserId'])
+                self._unsubscribeSocket(socket, client)
+        if client is not None:
+            self._callOnLoop(client['Outbox'].close)
 
+    #Should be called from the event loop thread; the loop is remembered so worker threads can schedule sends on it.
     def addSocket(self, socket: websockets.asyncio.server.ServerConnection):
-        self.clients.append({'UserId':None,'Socket':socket})
-    
-    def setUserOnSocket(self, socket: websockets.asyncio.server.ServerConnection, userID: str):
-        for client in self.clients:
-            if client['Socket'] == socket:
-                client['UserId'] = userID
-            
+        if self.loop is None:
+            try:
+                self.loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+        with self.lock:
+            if socket in self.socketIndex:
+                return
+            self.socketIndex[socket] = {'UserId':None,'Socket':socket,'Outbox':Outbox(socket, onClosed=self.deleteSocket),'Topics':set(),'Codec':codec.jsonCodec}
+
+    #conversations, if given, is {ConversationID: [member UserIDs]} for every conversation the user belongs to
+    #(see dmaftServerDB.getConversationMembersForUser); the socket is subscribed to all of them.
+    def setUserOnSocket(self, socket: websockets.asyncio.server.ServerConnection, userID: str, conversations: dict = None):
+        with self.lock:
+            client = self.socketIndex.get(socket)
+            if client is None:
+                return
+            self._unbindUser(socket, client['UserId'])
+            self._unsubscribeSocket(socket, client)
+            client['UserId'] = userID
+            if userID is not None:
+                userKey = str(userID).upper()
+                if userKey not in self.userIndex:
+                    self.userIndex[userKey] = set()
+                    self._announcePresence(userKey, True)
+                self.userIndex[userKey].add(socket)
+                for conversationID, members in (conversations or {}).items():
+                    topic = self._getTopic(conversationID, members)
+                    if userKey in topic['Members']:
+                        topic['Sockets'].add(socket)
+                        client['Topics'].add(str(conversationID).upper())
+                #conversations was read before the lock was taken, so a conversation created since then (whose addTopic
+                #didn't see this socket yet) is only in the live topics.
+                for key in self.memberTopics.get(userKey, ()):
+                    self.topicIndex[key]['Sockets'].add(socket)
+                    client['Topics'].add(key)
+
+    #Returns the codec negotiated on the socket (JSON if none was).
+    def getCodecForSocket(self, socket: websockets.asyncio.server.ServerConnection):
+        client = self.socketIndex.get(socket)
+        if client is None:
+            return codec.jsonCodec
+        return client['Codec']
+
+    def setCodecOnSocket(self, socket: websockets.asyncio.server.ServerConnection, socketCodec):
+        with self.lock:
+            client = self.socketIndex.get(socket)
+            if client is not None:
+                client['Codec'] = socketCodec
+
     def isUserConnected(self, userID: str):
-        return len(self.getClientsFromUser(userID)) > 0
+        return len(self.userIndex.get(str(userID).upper(), ())) > 0
+
+    #True if the user has a socket open here or, when running as several processes, on another one.
+    def isUserOnline(self, userID: str):
+        return self.isUserConnected(userID) or (self.peers is not None and self.peers.isUserOnline(userID))
+
+    #Returns the upper-cased UserIDs with at least one authenticated socket here.
+    def getOnlineUsers(self):
+        with self.lock:
+            return list(self.userIndex.keys())
+
+    #Returns a copy of the conversation's member set, or None if none of its members are online (the caller must ask the database).
+    def getTopicMembers(self, conversationID: str):
+        with self.lock:
+            topic = self.topicIndex.get(str(conversationID).upper())
+            if topic is None:
+                return None
+            return set(topic['Members'])
+
+    #Registers a newly created conversation and subscribes its members' open sockets.
+    #announce=False applies a change another process has already announced.
+    def addTopic(self, conversationID: str, members: list[str], announce: bool = True):
+        with self.lock:
+            if announce and self.peers is not None:
+                self.peers.announceTopic(conversationID, members)
+            sockets = set()
+            for member in members:
+                sockets.update(self.userIndex.get(str(member).upper(), ()))
+            if len(sockets) == 0:
+                return
+            topic = self._getTopic(conversationID, members)
+            for socket in sockets:
+                topic['Sockets'].add(socket)
+                self.socketIndex[socket]['Topics'].add(str(conversationID).upper())
+
+    #Removes a member who left the conversation and unsubscribes their sockets from it.
+    def removeTopicMember(self, conversationID: str, userID: str, announce: bool = True):
+        key = str(conversationID).upper()
+        with self.lock:
+            if announce and self.peers is not None:
+                self.peers.announceTopicMemberRemoved(conversationID, userID)
+            topic = self.topicIndex.get(key)
+            if topic is None:
+                return
+            topic['Members'].discard(str(userID).upper())
+            self._forgetMemberTopic(str(userID).upper(), key)
+            for socket in self.userIndex.get(str(userID).upper(), ()):
+                topic['Sockets'].discard(socket)
+                self.socketIndex[socket]['Topics'].discard(key)
+            if len(topic['Sockets']) == 0:
+                self._deleteTopic(key)
+
+    #Returns the topic for the conversation, creating it with the given member list if it isn't live yet.
+    def _getTopic(self, conversationID: str, members: list[str]):
+        key = str(conversationID).upper()
+        topic = self.topicIndex.get(key)
+        if topic is None:
+            topic = {'Members':set(str(member).upper() for member in members), 'Sockets':set()}
+            self.topicIndex[key] = topic
+            for member in topic['Members']:
+                self.memberTopics.setdefault(member, set()).add(key)
+        return topic
+
+    def _deleteTopic(self, key: str):
+        topic = self.topicIndex.pop(key)
+        for member in topic['Members']:
+            self._forgetMemberTopic(member, key)
+
+    def _forgetMemberTopic(self, userKey: str, key: str):
+        keys = self.memberTopics.get(userKey)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.memberTopics[userKey]
 
+    #Drops the socket from all of its topics, discarding topics nobody online is subscribed to any more.
+    def _unsubscribeSocket(self, socket: websockets.asyncio.server.ServerConnection, client: dict):
+        for key in client['Topics']:
+            topic = self.topicIndex.get(key)
+            if topic is None:
+                continue
+            topic['Sockets'].discard(socket)
+            if len(topic['Sockets']) == 0:
+                self._deleteTopic(key)
+        client['Topics'] = set()
 
-    #Returns True if successful and False if failed.
-    #If the connection was closed earlier, it will be removed from the ConnectionList.
-    #If the connection wasn't previously present, it will be added.
-    async def sendMsgToSocket(self, socket: websockets.asyncio.server.ServerConnection, msgData: bytes):
-        print("Executing sendMsgToSocket on socket ID", socket.id)
-        if len(self.getClientFromSocket(socket)) == 0:
-            print("The provided websocket is missing! Adding it...")
-            self.addSocket(socket)
+    #Returns {'Sockets', 'Users', 'Topics', 'QueuedFrames'} for the metrics gauges. Safe to call from any thread.
+    def getStats(self):
+        with self.lock:
+            outboxes = [client['Outbox'] for client in self.socketIndex.values()]
+            stats = {'Sockets':len(self.socketIndex), 'Users':len(self.userIndex), 'Topics':len(self.topicIndex)}
+        stats['QueuedFrames'] = sum(outbox.queue.qsize() for outbox in outboxes)
+        return stats
+
+    #Starts a coroutine on the event loop that owns the sockets, whether we're on that loop or on a worker thread.
+    def schedule(self, coroutine):
+        try:
+            runningLoop = asyncio.get_running_loop()
+        except RuntimeError:
+            runningLoop = None
+
+        if runningLoop is not None and (self.loop is None or runningLoop is self.loop):
+            return asyncio.create_task(coroutine)
+        if self.loop is None:
+            coroutine.close()
+            raise RuntimeError("clients.ConnectionList.schedule(): No event loop has been attached to this ConnectionList yet!")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def _isOnLoop(self):
         try:
-            print("sendMsgToSocket(): About to send message", msgData)
-            await socket.send(msgData)
-            print("Successfully sent the message!")
-            return True
-        except websockets.exceptions.ConnectionClosed as closed:
-            print("The socket is closed, removing...")
-            self.deleteSocket(socket)
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
             return False
+
+    def _callOnLoop(self, func):
+        if self.loop is None or self._isOnLoop():
+            func()
+        else:
+            self.loop.call_soon_threadsafe(func)
+
+    #Removes the socket from its user's socket set, dropping the set once it's empty.
+    def _unbindUser(self, socket: websockets.asyncio.server.ServerConnection, userID: str):
+        if userID is None:
+            return
+        key = str(userID).upper()
+        sockets = self.userIndex.get(key)
+        if sockets is None:
+            return
+        sockets.discard(socket)
+        if len(sockets) == 0:
+            del self.userIndex[key]
+            self._announcePresence(key, False)
+
+    #Must be called with the lock held, so other processes hear about changes in the order they happened.
+    def _announcePresence(self, userKey: str, online: bool):
+        if self.peers is not None:
+            self.peers.announcePresence(userKey, online)
+
+
+    #Queues the message on every socket of every listed user.
+    #The message is encoded once per codec and the same frame is shared by all recipients using that codec.
+    #Must be awaited on the event loop that owns the sockets.
+    #Returns the set of users (as given in userList) with at least one socket that took the message.
+    #mailbox, if given, is {'ConversationId', 'ExpireTime'}: a user whose sockets all drop the frame later on is passed to
+    #onUndelivered with it. Only this process's sockets are used; see fanOutEverywhere.
+    async def fanOut(self, userList: list[str], msgData, mailbox: dict = None):
+        return self._queueFrame(self._getUserTargets(userList), msgData, mailbox)
+
+    #Same as fanOut, but waits until the message has actually been sent. Sockets that haven't sent it within
+    #OUTBOX_SEND_TIMEOUT seconds are treated as slow readers and disconnected.
+    #Returns the set of users it was sent to.
+    async def fanOutAndFlush(self, userList: list[str], msgData):
+        pending = self._enqueueFrame(self._getUserTargets(userList), msgData)
+        if len(pending) == 0:
+            return set()
+        done, notDone = await asyncio.wait(pending.keys(), timeout=serverConfig.OUTBOX_SEND_TIMEOUT)
+        for future in notDone:
+            pending[future][1].close(reason='Client is reading too slowly')
+        return {pending[future][0] for future in pending if future.done() and future.result()}
+
+    def _getUserTargets(self, userList: list[str]):
+        targets = []
+        for user in dict.fromkeys(userList):
+            for client in self.getClientsFromUser(user):
+                targets.append((user, client))
+        return targets
+
+    #Same as fanOut, but sends to every socket subscribed to the conversation's topic (skipping excludeUserID's sockets).
+    #Returns the set of upper-cased UserIDs it was queued for.
+    async def fanOutToTopic(self, conversationID: str, msgData, excludeUserID: str = None, mailbox: dict = None):
+        excludeKey = None if excludeUserID is None else str(excludeUserID).upper()
+        targets = []
+        with self.lock:
+            topic = self.topicIndex.get(str(conversationID).upper())
+            for socket in (topic['Sockets'] if topic is not None else ()):
+                client = self.socketIndex[socket]
+                userKey = str(client['UserId']).upper()
+                if userKey != excludeKey:
+                    targets.append((userKey, client))
+        return self._queueFrame(targets, msgData, mailbox)
+
+    #Same as fanOut, plus forwarding to the other processes any of the users are connected to.
+    async def fanOutEverywhere(self, userList: list[str], msgData, mailbox: dict = None):
+        delivered = await self.fanOut(userList, msgData, mailbox)
+        if self.peers is not None:
+            delivered |= await self.peers.deliver(userList, msgData, mailbox)
+        return delivered
+
+    #Same as fanOutToTopic, plus forwarding to the other processes any of the topic's members are connected to.
+    async def fanOutToTopicEverywhere(self, conversationID: str, members: set, msgData, excludeUserID: str = None, mailbox: dict = None):
+        delivered = await self.fanOutToTopic(conversationID, msgData, excludeUserID, mailbox)
+        if self.peers is not None:
+            delivered |= await self.peers.deliver(list(members), msgData, mailbox)
+        return delivered
+
+    #targets is a list of (user, client entry). Returns {delivery future: (user, Outbox)}.
+    def _enqueueFrame(self, targets: list, msgData):
+        frames = {}
+        pending = {}
+        for user, client in targets:
+            socketCodec = client['Codec']
+            if socketCodec.name not in frames:
+                frames[socketCodec.name] = codec.encodeFrame(msgData, socketCodec)
+            future = client['Outbox'].enqueue(frames[socketCodec.name], text=socketCodec.isText)
+            pending[future] = (user, client['Outbox'])
+        if len(pending) > 0:
+            fanOutSockets.observe(len(pending))
+        return pending
+
+    #Queues the frame without waiting for it to be sent. Returns the set of users with at least one socket that took it,
+    #and (given a mailbox) watches each of them in case every one of their sockets drops it later.
+    def _queueFrame(self, targets: list, msgData, mailbox: dict = None):
+        queued = {}
+        for future, (user, outbox) in self._enqueueFrame(targets, msgData).items():
+            if not future.done() or future.result():
+                queued.setdefault(user, []).append(future)
+        if mailbox is not None:
+            for user, futures in queued.items():
+                asyncio.gather(*futures).add_done_callback(functools.partial(self._checkDropped, user, msgData, mailbox))
+        return set(queued)
+
+    def _checkDropped(self, user: str, msgData, mailbox: dict, results: asyncio.Future):
+        if any(results.result()) or self.onUndelivered is None:
+            return
+        try:
+            self.onUndelivered([user], msgData, mailbox)
         except Exception as e:
-            print("Exception raised:",e)
-            return False
-    
-    def sendMsgToUser(self, userID: str, msgData: bytes):
-        successStatus = False
-        clients = self.getClientsFromUser(userID)
-        if len(clients) == 0:
-            print("clients.sendMsgToUser(): Found no websocket connections for user", userID)
+            log.error("ConnectionList: Failed to mailbox a dropped message for user %s: %s", user, e)
+
+    #Runs a fan-out coroutine from a worker thread and blocks until it finishes, returning the delivered users.
+    #Returns None if it couldn't be waited on: there's no loop yet, we're on the loop itself (e.g. when no worker pool
+    #is running), in which case it's only queued, or the fan-out failed.
+    def _runFanOut(self, coroutine):
+        if self.loop is None:
+            coroutine.close()
+            return None
+
+        if self._isOnLoop():
+            self.schedule(coroutine)
+            return None
+
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        except Exception as e:
+            log.error("ConnectionList._runFanOut(): Fan-out failed: %s", e)
+            return None
+
+    #Queues the message for the user without waiting for it to be sent.
+    #Returns True if the user had at least one open socket to queue it on.
+    def sendMsgToUser(self, userID: str, msgData):
+        if not self.isUserConnected(userID):
+            log.debug("sendMsgToUser(): Found no websocket connections for user %s", userID)
             return False
-    
-        for client in clients:
-            try:
-                print("Creating task to send message to user ", userID, "on socket ID", str(client['Socket'].id))
-                task = asyncio.create_task(self.sendMsgToSocket(client['Socket'], msgData))
-                successStatus = True
-            except:
-                print("Client found with missing socket! Removing...")
-                self.clients.remove(client)
-
-        return successStatus
-
-    def broadcastToUsers(self, userList: list[str], msgData: bytes):
-        usersRemaining = copy.deepcopy(userList)
-        successStatus = False
-        print("ConnectionList.broadcastToUsers(): Received user list", userList)
-        for user in userList:
-            print("ConnectionList.broadcastToUsers(): Contents of userList is", userList)
-            print("ConnectionList.broadcastToUsers(): Attempting to send message to user", user)
-            if self.sendMsgToUser(user, msgData):
-                usersRemaining.remove(user)
-                print("Successfully delivered message to user " + user)
-        
-        return usersRemaining
\ No newline at end of file
+        self.schedule(self.fanOut([userID], msgData))
+        return True
+
+    #Sends the message to every socket the user has open and waits until the sends finish.
+    #Must be awaited on the event loop that owns the sockets.
+    #Returns True if at least one socket sent the message and False otherwise.
+    async def deliverToUser(self, userID: str, msgData):
+        return userID in await self.fanOutAndFlush([userID], msgData)
+
+    #Same as deliverToUser, plus queuing the message on the user's sockets in other processes (which mailbox it again if
+    #those sockets drop it; see fanOut for mailbox). Returns True if a socket here sent it or another process queued it.
+    async def deliverToUserEverywhere(self, userID: str, msgData, mailbox: dict = None):
+        sent = await self.deliverToUser(userID, msgData)
+        if self.peers is not None and len(await self.peers.deliver([userID], msgData, mailbox)) > 0:
+            sent = True
+        return sent
+
+    #Sends the message to every listed user and returns the users it could NOT be queued for, so the caller can mailbox them.
+    #Called from the worker threads, where it blocks until the frames are queued (not sent).
+    #mailbox is {'ConversationId', 'ExpireTime'} for onUndelivered, should a queued frame be dropped later.
+    #If it can't wait (see _runFanOut), every user with an open socket is counted as delivered.
+    def broadcastToUsers(self, userList: list[str], msgData, mailbox: dict = None):
+        delivered = self._runFanOut(self.fanOutEverywhere(userList, msgData, mailbox))
+        if delivered is None:
+            return [user for user in userList if self.loop is None or not self.isUserOnline(user)]
+        return [user for user in userList if user not in delivered]
+
+    #Sends the message to everyone subscribed to the conversation's topic except excludeUserID.
+    #Returns the (upper-cased) members it could NOT be queued for, so the caller can mailbox them,
+    #or None if the conversation has no live topic and the caller has to look the members up itself.
+    def broadcastToTopic(self, conversationID: str, msgData, excludeUserID: str = None, mailbox: dict = None):
+        members = self.getTopicMembers(conversationID)
+        if members is None:
+            return None
+        if excludeUserID is not None:
+            members.discard(str(excludeUserID).upper())
+
+        delivered = self._runFanOut(self.fanOutToTopicEverywhere(conversationID, members, msgData, excludeUserID, mailbox))
+        if delivered is None:
+            return [member for member in members if self.loop is None or not self.isUserOnline(member)]
+        return [member for member in members if member not in delivered]
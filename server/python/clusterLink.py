@@ -0,0 +1,359 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import pickle
+import struct
+
+import hashRing
+import metrics
+import serverConfig
+import serverLog
+
+#Links between the nodes of a cluster: separate servers, each with its own database, that split the users between them.
+#Every UserID belongs to one node, picked by consistent hashing (see hashRing.py). A user always connects to the node
+#that owns them; that node holds their account, tokens and mailbox. New accounts get IDs that hash to the node they
+#register on. Conversations are copied to the node of every member, so any node can check who's in them.
+#Messages for members owned by another node are forwarded to it, and it delivers them live or keeps them in its mailbox.
+#
+#The nodes are listed in a static JSON file (CLUSTER_CONFIG):
+#   {'Secret': '<shared secret>', 'VirtualNodes': 64,
+#    'Nodes': [{'Name': 'a', 'ClusterHost': '10.0.0.1', 'ClusterPort': 9700, 'Url': 'wss://a.example.com:8765'}, ...]}
+#CLUSTER_NODE names this node; CLUSTER_SECRET, if set, replaces the file's Secret. Url is where clients are sent
+#(WrongNode errors) when they reach a node that doesn't own them.
+#Attachments aren't copied between nodes, so BLOB_DIR has to be storage every node can read.
+#
+#Nodes talk over TCP. A connection starts with a handshake in which both sides prove they know the shared secret
+#(HMAC-SHA256 over fresh nonces from each side), and every frame after it carries an HMAC under a key derived from
+#those nonces and the frame's sequence number, so frames can't be forged, replayed or reordered.
+#A frame is only unpickled after its HMAC checks out.
+#Each node sends its requests on its own outgoing connections and answers other nodes' requests on their incoming ones.
+#Incoming requests run on a thread pool of their own: they never call other nodes themselves, so two nodes waiting
+#on each other with all their request threads busy can still answer each other.
+
+log = serverLog.getLogger('cluster')
+
+clusterCallSeconds = metrics.histogram('dmaft_cluster_call_seconds', 'Time for a request to another cluster node to be answered, by request type.', ('type',))
+clusterCallErrors = metrics.counter('dmaft_cluster_call_errors_total', 'Requests to another cluster node that failed or timed out, by request type.', ('type',))
+
+#The running node's link, set by ClusterLink.start(). None when the server isn't part of a cluster.
+activeCluster = None
+
+_header = struct.Struct('>I')
+_sequence = struct.Struct('>Q')
+_nonceBytes = 32
+_macBytes = 32
+#Frames bigger than this mean the stream is out of step (or someone is probing the port); the connection is dropped.
+_maxFrameBytes = 256 * 1024 * 1024
+#Seconds to wait for the other side of a handshake.
+_handshakeTimeout = 10
+
+
+class ClusterError(RuntimeError):
+    pass
+
+
+class ClusterNode:
+    def __init__(self, name: str, clusterHost: str, clusterPort: int, url: str):
+        self.name = name
+        self.clusterHost = clusterHost
+        self.clusterPort = clusterPort
+        self.url = url
+
+
+class ClusterConfig:
+    def __init__(self, *, nodes: list[ClusterNode], nodeName: str, secret: bytes, virtualNodes: int = hashRing.defaultVirtualNodes):
+        self.nodes = {node.name: node for node in nodes}
+        if nodeName not in self.nodes:
+            raise ValueError("clusterLink.ClusterConfig(): This node (" + repr(nodeName) + ") isn't in the cluster's node list!")
+        if len(secret) < 16:
+            raise ValueError("clusterLink.ClusterConfig(): The cluster secret must be at least 16 bytes long!")
+        self.nodeName = nodeName
+        self.secret = secret
+        self.ring = hashRing.HashRing(sorted(self.nodes.keys()), virtualNodes)
+
+
+#Reads the node list from a CLUSTER_CONFIG file. nodeName and secret default to CLUSTER_NODE and CLUSTER_SECRET.
+def loadClusterConfig(path: str, nodeName: str = None, secret: str = None):
+    with open(path) as configFile:
+        data = json.load(configFile)
+    nodeName = serverConfig.CLUSTER_NODE if nodeName is None else nodeName
+    secret = serverConfig.CLUSTER_SECRET if secret is None else secret
+    if secret == '':
+        secret = data.get('Secret', '')
+    try:
+        nodes = [ClusterNode(str(node['Name']), str(node['ClusterHost']), int(node['ClusterPort']), str(node['Url'])) for node in data['Nodes']]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("clusterLink.loadClusterConfig(): Every node in " + path + " needs a Name, ClusterHost, ClusterPort and Url.") from e
+    return ClusterConfig(nodes=nodes, nodeName=nodeName, secret=secret.encode('utf-8'), virtualNodes=int(data.get('VirtualNodes', hashRing.defaultVirtualNodes)))
+
+
+#True if this node owns the user, or if there is no cluster.
+def isLocalUser(userID: str):
+    return activeCluster is None or activeCluster.ownsUser(userID)
+
+
+def _mac(key: bytes, *parts: bytes):
+    return hmac.new(key, b''.join(parts), hashlib.sha256).digest()
+
+
+#One authenticated connection. Each direction numbers its frames, and the number is part of the HMAC.
+class _Channel:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, sessionKey: bytes, isClient: bool):
+        self.reader = reader
+        self.writer = writer
+        self.sessionKey = sessionKey
+        self.sendLabel = b'C' if isClient else b'S'
+        self.receiveLabel = b'S' if isClient else b'C'
+        self.sent = 0
+        self.received = 0
+
+    def send(self, message: dict):
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        mac = _mac(self.sessionKey, self.sendLabel, _sequence.pack(self.sent), payload)
+        self.sent += 1
+        self.writer.write(_header.pack(len(payload)) + mac + payload)
+
+    async def receive(self):
+        size = _header.unpack(await self.reader.readexactly(_header.size))[0]
+        if size > _maxFrameBytes:
+            raise ClusterError("Frame of " + str(size) + " bytes is over the limit")
+        mac = await self.reader.readexactly(_macBytes)
+        payload = await self.reader.readexactly(size)
+        if not hmac.compare_digest(mac, _mac(self.sessionKey, self.receiveLabel, _sequence.pack(self.received), payload)):
+            raise ClusterError("Frame failed authentication")
+        self.received += 1
+        return pickle.loads(payload)
+
+    def close(self):
+        self.writer.close()
+
+
+class _RemoteNode:
+    def __init__(self, node: ClusterNode):
+        self.node = node
+        self.channel = None
+        self.pending = {} #RequestId -> future for the reply
+        self.connecting = None #asyncio.Lock, created on the loop
+
+
+#This node's end of the cluster.
+#handlers maps request types to blocking functions taking the request dict and returning the reply dict;
+#they run on this module's own thread pool when another node sends that request.
+class ClusterLink:
+    def __init__(self, config: ClusterConfig, handlers: dict, *, threads: int = None):
+        self.config = config
+        self.nodeName = config.nodeName
+        self.handlers = handlers
+        self.threads = serverConfig.CLUSTER_THREADS if threads is None else threads
+        self.remotes = {name: _RemoteNode(node) for name, node in config.nodes.items() if name != config.nodeName}
+        self.requestIDs = itertools.count()
+        self.server = None
+        self.loop = None
+        self.executor = None
+        self.inbound = set()
+
+    async def start(self, *, reusePort: bool = False):
+        global activeCluster
+        self.loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='dmaft-cluster')
+        for remote in self.remotes.values():
+            remote.connecting = asyncio.Lock()
+        node = self.config.nodes[self.nodeName]
+        self.server = await asyncio.start_server(self._serveInbound, node.clusterHost, node.clusterPort, reuse_port=reusePort)
+        activeCluster = self
+        log.info("Node %s: Listening for %d other cluster nodes on %s:%d", self.nodeName, len(self.remotes), node.clusterHost, node.clusterPort)
+
+    async def stop(self):
+        global activeCluster
+        if activeCluster is self:
+            activeCluster = None
+        for remote in self.remotes.values():
+            self._dropChannel(remote, ClusterError("Shutting down"))
+        if self.server is not None:
+            self.server.close()
+            for channel in list(self.inbound):
+                channel.close()
+            self.server = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+    #ROUTING
+    def getOwner(self, userID: str):
+        return self.config.ring.getNode(userID)
+
+    def ownsUser(self, userID: str):
+        return self.getOwner(userID) == self.nodeName
+
+    def getNodeUrl(self, nodeName: str):
+        return self.config.nodes[nodeName].url
+
+    #Returns {nodeName: [userIDs]} for the users owned by other nodes, and the list of users owned here.
+    def splitByOwner(self, userIDs: list[str]):
+        groups = self.config.ring.groupByNode(userIDs)
+        return {name: users for name, users in groups.items() if name != self.nodeName}, groups.get(self.nodeName, [])
+
+    #Every node other than this one, in a stable order.
+    def getOtherNodes(self):
+        return sorted(self.remotes.keys())
+
+
+    #CALLS
+    #Sends request to another node and returns its reply. Raises ClusterError if it can't be reached or doesn't answer in time.
+    async def call(self, nodeName: str, request: dict, timeout: float = None):
+        remote = self.remotes.get(nodeName)
+        if remote is None:
+            raise ClusterError("Unknown cluster node " + repr(nodeName))
+        timeout = serverConfig.CLUSTER_CALL_TIMEOUT if timeout is None else timeout
+        requestType = str(request.get('Type'))
+        with clusterCallSeconds.time(requestType):
+            try:
+                channel = await asyncio.wait_for(self._getChannel(remote), timeout)
+                requestID = next(self.requestIDs)
+                future = self.loop.create_future()
+                remote.pending[requestID] = future
+                try:
+                    channel.send(dict(request, RequestId=requestID))
+                    reply = await asyncio.wait_for(future, timeout)
+                finally:
+                    remote.pending.pop(requestID, None)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ClusterError) as e:
+                clusterCallErrors.inc(requestType)
+                raise ClusterError("Request " + requestType + " to node " + nodeName + " failed: " + (str(e) or type(e).__name__)) from e
+
+        if reply.get('Error') is not None:
+            clusterCallErrors.inc(requestType)
+            raise ClusterError("Node " + nodeName + " couldn't handle " + requestType + ": " + reply['Error'])
+        return reply['Reply']
+
+    #Sends each node its request at the same time. Returns {nodeName: reply or the ClusterError it raised}.
+    async def callMany(self, requests: dict, timeout: float = None):
+        names = list(requests.keys())
+        results = await asyncio.gather(*[self.call(name, requests[name], timeout) for name in names], return_exceptions=True)
+        return dict(zip(names, results))
+
+    #Blocking versions for request handlers on worker threads. They must not be called on the event loop itself.
+    def callFromThread(self, nodeName: str, request: dict, timeout: float = None):
+        return self._runFromThread(self.call(nodeName, request, timeout))
+
+    def callManyFromThread(self, requests: dict, timeout: float = None):
+        if len(requests) == 0:
+            return {}
+        return self._runFromThread(self.callMany(requests, timeout))
+
+    def _runFromThread(self, coroutine):
+        try:
+            onLoop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            onLoop = False
+        if onLoop:
+            coroutine.close()
+            raise RuntimeError("clusterLink.ClusterLink: Blocking calls can't be made from the event loop!")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+    #OUTGOING CONNECTIONS
+    async def _getChannel(self, remote: _RemoteNode):
+        if remote.channel is not None:
+            return remote.channel
+        async with remote.connecting:
+            if remote.channel is None:
+                remote.channel = await self._connect(remote.node)
+                asyncio.create_task(self._readReplies(remote, remote.channel))
+                log.info("Node %s: Linked to node %s", self.nodeName, remote.node.name)
+            return remote.channel
+
+    async def _connect(self, node: ClusterNode):
+        reader, writer = await asyncio.open_connection(node.clusterHost, node.clusterPort)
+        try:
+            serverNonce = await asyncio.wait_for(reader.readexactly(_nonceBytes), _handshakeTimeout)
+            clientNonce = os.urandom(_nonceBytes)
+            name = self.nodeName.encode('utf-8')
+            proof = _mac(self.config.secret, b'dmaft-cluster-hello', serverNonce, clientNonce, name)
+            writer.write(_header.pack(len(name)) + clientNonce + proof + name)
+            answer = await asyncio.wait_for(reader.readexactly(_macBytes), _handshakeTimeout)
+            if not hmac.compare_digest(answer, _mac(self.config.secret, b'dmaft-cluster-welcome', clientNonce, serverNonce)):
+                raise ClusterError("Node " + node.name + " failed to prove it knows the cluster secret")
+        except BaseException:
+            writer.close()
+            raise
+        sessionKey = _mac(self.config.secret, b'dmaft-cluster-session', serverNonce, clientNonce)
+        return _Channel(reader, writer, sessionKey, isClient=True)
+
+    async def _readReplies(self, remote: _RemoteNode, channel: _Channel):
+        error = None
+        try:
+            while True:
+                reply = await channel.receive()
+                future = remote.pending.get(reply.get('RequestId'))
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, ClusterError) as e:
+            error = e
+            log.warning("Node %s: Lost the link to node %s: %s", self.nodeName, remote.node.name, e)
+        except asyncio.CancelledError:
+            error = ClusterError("Shutting down")
+        finally:
+            if remote.channel is channel:
+                self._dropChannel(remote, error or ClusterError("Connection closed"))
+
+    def _dropChannel(self, remote: _RemoteNode, error: Exception):
+        if remote.channel is not None:
+            remote.channel.close()
+            remote.channel = None
+        for future in remote.pending.values():
+            if not future.done():
+                future.set_exception(ClusterError(str(error)))
+
+
+    #INCOMING CONNECTIONS
+    async def _serveInbound(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channel = None
+        peerName = None
+        try:
+            serverNonce = os.urandom(_nonceBytes)
+            writer.write(serverNonce)
+            nameLength = _header.unpack(await asyncio.wait_for(reader.readexactly(_header.size), _handshakeTimeout))[0]
+            if nameLength > 1024:
+                raise ClusterError("Handshake name is too long")
+            hello = await asyncio.wait_for(reader.readexactly(_nonceBytes + _macBytes + nameLength), _handshakeTimeout)
+            clientNonce, proof, name = hello[:_nonceBytes], hello[_nonceBytes:_nonceBytes + _macBytes], hello[_nonceBytes + _macBytes:]
+            if not hmac.compare_digest(proof, _mac(self.config.secret, b'dmaft-cluster-hello', serverNonce, clientNonce, name)):
+                raise ClusterError("Handshake from " + str(writer.get_extra_info('peername')) + " failed authentication")
+            peerName = name.decode('utf-8', errors='replace')
+            writer.write(_mac(self.config.secret, b'dmaft-cluster-welcome', clientNonce, serverNonce))
+            channel = _Channel(reader, writer, _mac(self.config.secret, b'dmaft-cluster-session', serverNonce, clientNonce), isClient=False)
+            self.inbound.add(channel)
+
+            while True:
+                request = await channel.receive()
+                asyncio.create_task(self._answer(channel, request, peerName))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError):
+            pass
+        except ClusterError as e:
+            log.warning("Node %s: Dropping cluster connection from %s: %s", self.nodeName, peerName or writer.get_extra_info('peername'), e)
+        except asyncio.CancelledError:
+            pass #shutting down; asyncio's stream callback would report the cancellation as an error
+        finally:
+            if channel is not None:
+                self.inbound.discard(channel)
+            writer.close()
+
+    async def _answer(self, channel: _Channel, request: dict, peerName: str):
+        reply = {'RequestId':request.get('RequestId'), 'Reply':None, 'Error':None}
+        handler = self.handlers.get(request.get('Type'))
+        if handler is None:
+            reply['Error'] = 'Unknown request type ' + repr(request.get('Type'))
+        else:
+            try:
+                reply['Reply'] = await self.loop.run_in_executor(self.executor, handler, request)
+            except Exception as e:
+                log.exception("Node %s: Failed to handle %s from node %s", self.nodeName, request.get('Type'), peerName)
+                reply['Error'] = type(e).__name__ + ': ' + str(e)
+        if not channel.writer.is_closing():
+            channel.send(reply)
@@ -0,0 +1,141 @@
+import base64
+import binascii
+import json
+import re
+
+#Optional dependencies: orjson speeds up the JSON codec, msgpack enables the binary codec.
+#The server runs without either; it just falls back to the stdlib json module and only offers JSON.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#Wire codecs for client frames.
+#Every client starts on JSON. A client can ask for another codec by adding a 'Codecs' list (most preferred first)
+#to its PING or CONNECT request; the reply's 'Codec' key says which one the server picked, and the server uses it
+#for everything it sends afterwards.
+#Text frames are always JSON and binary frames are always the negotiated binary codec,
+#so a frame that crosses the switch-over can still be decoded by its type.
+#
+#Binary payloads (MessageData for Image/Video/File messages) are kept as raw bytes inside the server.
+#The JSON codec sends them as base64 strings, same as before; binary codecs carry the bytes as-is.
+
+binaryMessageTypes = ['Image', 'Video', 'File']
+
+#orjson silently turns integers that don't fit in 64 bits into floats, which would mangle RSA public keys sent as numbers.
+#Any frame with a run of 20+ digits is decoded by the stdlib instead.
+_bigIntegerPattern = re.compile(r'[0-9]{20}')
+_bigIntegerBytesPattern = re.compile(rb'[0-9]{20}')
+
+
+#Turns a base64 MessageData string into bytes for the binary message types, in place.
+#Strings that aren't valid base64 are left alone. Returns the same dict.
+def unpackMessageData(msgDict: dict):
+    if type(msgDict) != dict:
+        return msgDict
+    if msgDict.get('MessageType') in binaryMessageTypes and type(msgDict.get('MessageData')) == str:
+        try:
+            msgDict['MessageData'] = base64.b64decode(msgDict['MessageData'], validate=True)
+        except (binascii.Error, ValueError):
+            pass
+    return msgDict
+
+
+def _jsonDefault(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode('ascii')
+    raise TypeError("Object of type " + type(obj).__name__ + " is not JSON serializable")
+
+
+class JSONCodec:
+    name = 'json'
+    isText = True
+
+    def encode(self, obj):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=_jsonDefault)
+            except TypeError:
+                pass #orjson only handles 64-bit integers; RSA moduli and the like go through the stdlib instead.
+        return json.dumps(obj, default=_jsonDefault).encode('utf-8')
+
+    def decode(self, data):
+        if orjson is not None:
+            pattern = _bigIntegerPattern if isinstance(data, str) else _bigIntegerBytesPattern
+            if pattern.search(data) is None:
+                return orjson.loads(data)
+        return json.loads(data)
+
+
+#msgpack has no integer type wider than 64 bits, and its packer raises OverflowError for them without calling default=.
+#Returns a copy of obj with every such integer turned into its decimal string, which int() reads back the same
+#(e.g. handleAuth's UserPublicKeyMod). Containers without one are returned as they are.
+def _stringifyBigIntegers(obj):
+    if type(obj) == int:
+        return str(obj) if not -2**63 <= obj < 2**64 else obj
+    if isinstance(obj, dict):
+        return {key: _stringifyBigIntegers(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_stringifyBigIntegers(item) for item in obj]
+    return obj
+
+
+class MsgPackCodec:
+    name = 'msgpack'
+    isText = False
+
+    def encode(self, obj):
+        try:
+            return msgpack.packb(obj, use_bin_type=True)
+        except OverflowError:
+            return msgpack.packb(_stringifyBigIntegers(obj), use_bin_type=True) #Only frames with a huge integer pay for the copy.
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+jsonCodec = JSONCodec()
+availableCodecs = {jsonCodec.name: jsonCodec}
+if msgpack is not None:
+    availableCodecs[MsgPackCodec.name] = MsgPackCodec()
+
+
+#Returns the first codec in the client's preference list that the server supports, or JSON if none are.
+def negotiate(requested):
+    if type(requested) == str:
+        requested = [requested]
+    if type(requested) != list:
+        return jsonCodec
+    for name in requested:
+        codec = availableCodecs.get(str(name).lower())
+        if codec is not None:
+            return codec
+    return jsonCodec
+
+
+#Decodes a frame received from a client: text frames as JSON, binary frames with the socket's codec if it's a binary one.
+#Raises ValueError (or the codec's own subclass of it) if the frame can't be decoded.
+def decodeFrame(message, codec = jsonCodec):
+    if isinstance(message, str) or codec.isText:
+        return jsonCodec.decode(message)
+    try:
+        return codec.decode(message)
+    except Exception as e:
+        raise ValueError("codec.decodeFrame(): Failed to decode a " + codec.name + " frame: " + str(e)) from e
+
+
+#Encodes an outgoing message for the given codec.
+#msgData is normally a dict. A str/bytes is taken to be JSON that was encoded earlier (e.g. a stored mailbox item),
+#which JSON sockets get unchanged and other codecs get re-encoded.
+#Returns the frame as bytes.
+def encodeFrame(msgData, codec = jsonCodec):
+    if isinstance(msgData, (str, bytes)):
+        if codec.isText:
+            return msgData.encode('utf-8') if isinstance(msgData, str) else msgData
+        msgData = unpackMessageData(jsonCodec.decode(msgData))
+    return codec.encode(msgData)
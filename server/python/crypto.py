@@ -29,4 +29,13 @@ def getSHA256(data: bytes):
     return hashlib.sha256(data).digest()
 
 def getSHA512(data: bytes):
-    return hashlib.sha512(data).digest()
\ No newline at end of file
+    return hashlib.sha512(data).digest()
+
+#Same check as verifyRSAClientSignature, but takes the DER-encoded (SubjectPublicKeyInfo) key.
+#Everything it takes is plain bytes, so it can be shipped to a worker process.
+def verifyRSASignatureFromBytes(publicKeyBytes: bytes, signature: bytes, data: bytes):
+    try:
+        publicKey = getPubKeyFromBytes(publicKeyBytes)
+    except:
+        return False
+    return verifyRSAClientSignature(publicKey=publicKey, signature=signature, data=data)
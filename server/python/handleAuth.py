@@ -1,13 +1,16 @@
 import base64
 from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 import random
 import time
 
 from tlsServer import makeError, cleanAuthData
+import clusterLink
 import dmaftServerDB
+import serverLog
+import workers
+
+log = serverLog.getLogger('auth')
 
 #This needs to be renamed in the future.
 #The CONNECT keyword is reserved for clients wanting to start a conversation with each other.
@@ -32,33 +35,27 @@ def handleConnectRequest(clientRequest: dict):
         numSet = rsa.RSAPublicNumbers(userPubKeyExp, userPubKeyMod)
         pubKey = numSet.public_key()
     except Exception as e:
-        print("Exception when trying to construct key:\n", e)
+        log.info("handleConnectRequest(): Failed to construct the client's public key: %s", e)
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Failed to construct the RSA public key from the given parameters.')
 
     #If the client specified an account, make sure that user first exists
     if clientRequest['UserId'] not in ['',None]:
-        dbConn = dmaftServerDB.startDB()
-        try:
-            if not dmaftServerDB.doesUserExist(connection=dbConn, userID=clientRequest['UserId']):
-                dmaftServerDB.closeDB(dbConn)
-                return makeError(clientRequest=clientRequest, errorCode='InvalidUserId', reason='The specified UserId does not exist. Please specify a different user or send a registration request.')
-        except Exception as e:
-            print("handleAuth.handleConnectRequest(): Exception occurred:", e)
-            dmaftServerDB.closeDB(dbConn)
-            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to query the database to check if the specified user is registered.')
-
-        #Make sure the client specified the correct public key.
-        #Otherwise, the client that sent this request is attempting to impersonate the specified user.
-        try:
-            if not dmaftServerDB.verifyPublicKey(connection=dbConn, userID=clientRequest['UserId'], publicKey=pubKey):
-                print("handleAuth.handleConnectRequest(): Provided public key is incorrect!")
-                return makeError(clientRequest=clientRequest, errorCode='WrongPublicKey', reason='This user is registered with a different public key. Please submit the correct public key that was previously registered.')
-            else:
-                print("handleAuth.handleConnectRequest(): Successfully validated provided public key.")
-        except:
-            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to verify whether the provided public key is the one originally registered for this user.')
-
-        dmaftServerDB.closeDB(dbConn)
+        with dmaftServerDB.borrowDB() as dbConn:
+            try:
+                if not dmaftServerDB.doesUserExist(connection=dbConn, userID=clientRequest['UserId']):
+                    return makeError(clientRequest=clientRequest, errorCode='InvalidUserId', reason='The specified UserId does not exist. Please specify a different user or send a registration request.')
+            except Exception as e:
+                log.error("handleConnectRequest(): Failed to check whether the user exists: %s", e)
+                return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to query the database to check if the specified user is registered.')
+
+            #Make sure the client specified the correct public key.
+            #Otherwise, the client that sent this request is attempting to impersonate the specified user.
+            try:
+                if not dmaftServerDB.verifyPublicKey(connection=dbConn, userID=clientRequest['UserId'], publicKey=pubKey):
+                    log.info("handleConnectRequest(): Provided public key is incorrect for user %s", clientRequest['UserId'])
+                    return makeError(clientRequest=clientRequest, errorCode='WrongPublicKey', reason='This user is registered with a different public key. Please submit the correct public key that was previously registered.')
+            except:
+                return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to verify whether the provided public key is the one originally registered for this user.')
 
     #Create the challenge and send it to the client
     if clientRequest['UserId'] == '':
@@ -66,10 +63,8 @@ def handleConnectRequest(clientRequest: dict):
 
     pubKeyBytes = pubKey.public_bytes(encoding=serialization.Encoding.DER, format=serialization.PublicFormat.SubjectPublicKeyInfo)
     challengeBytes = random.randbytes(32)
-    dbConn = dmaftServerDB.startDB()
-    dmaftServerDB.pruneChallenges(connection=dbConn) #Prevent attackers from brute-forcing old challenges later on
-    result = dmaftServerDB.addChallenges(connection=dbConn, challenges=[challengeBytes], publicKeys=[pubKeyBytes], userIDs=[clientRequest['UserId']])
-    dbConn.close()
+    with dmaftServerDB.borrowDB() as dbConn:
+        result = dmaftServerDB.addChallenges(connection=dbConn, challenges=[challengeBytes], publicKeys=[pubKeyBytes], userIDs=[clientRequest['UserId']])
 
     if type(result) is not list:
         return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to produce an authentication challenge.')
@@ -100,68 +95,53 @@ def handleChallengeResponse(clientRequest: dict):
     if clientRequest['ChallengeId'] == '' or clientRequest['Signature'] == '':
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Both the ChallengeId and Signature must be non-empty.')
 
-    print("Received authentication request!")
-    print(clientRequest)
+    log.debug("handleChallengeResponse(): Received authentication request: %s", clientRequest)
 
     #Find the challenge and retrieve the stored public key.
     #Remember, the public key was serialized as DER and the format was SubjectPublicKeyInfo.
-    dbConn = dmaftServerDB.startDB()
-    try:
-        challenges = dmaftServerDB.getChallenge(connection=dbConn, challengeID=clientRequest['ChallengeId'])
-    except Exception as e:
-        print("dmaftserverDB.getChallenges() failed.")
-        dbConn.close()
-        return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='dmaftServerDB.getChallenge() failed.')
-    
-    if type(challenges) is not list:
-        dbConn.close()
-        return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='Failed to query the server challenge database. Please try again.')
+    with dmaftServerDB.borrowDB() as dbConn:
+        try:
+            challenges = dmaftServerDB.getChallenge(connection=dbConn, challengeID=clientRequest['ChallengeId'])
+        except Exception as e:
+            log.error("handleChallengeResponse(): dmaftServerDB.getChallenge() failed: %s", e)
+            return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='dmaftServerDB.getChallenge() failed.')
+
+        if type(challenges) is not list:
+            return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='Failed to query the server challenge database. Please try again.')
 
-    elif len(challenges) != 1:
-        dbConn.close()
-        return makeError(clientRequest=clientRequest, errorCode='InvalidChallengeId', reason='The specified challenge does not exist. Please request a new challenge.')
+        elif len(challenges) != 1:
+            return makeError(clientRequest=clientRequest, errorCode='InvalidChallengeId', reason='The specified challenge does not exist. Please request a new challenge.')
 
-    #We got exactly one match.
-    #Delete the challenge from the DB so it can't be used in a replay attack.
-    #Then, import the public key from the result in 'record' and verify the provided signature.
-    if not dmaftServerDB.deleteChallengesWithUUID(connection=dbConn, challengeID=clientRequest['ChallengeId']):
-        dbConn.close()
-        return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='')
+        #We got exactly one match.
+        #Delete the challenge from the DB so it can't be used in a replay attack.
+        #Then, import the public key from the result in 'record' and verify the provided signature.
+        if not dmaftServerDB.deleteChallengesWithUUID(connection=dbConn, challengeID=clientRequest['ChallengeId']):
+            return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='')
 
     record = challenges[0]
     challengeId, challenge, publicKeyBytes, userId, expireTimestamp = record
     userPublicKey = serialization.load_der_public_key(publicKeyBytes)
     sigBytes = base64.b64decode(clientRequest['Signature'])
-    try:
-        #If this succeeds without an exception, the signature is valid.
-        userPublicKey.verify(
-            signature=sigBytes,
-            data=challenge,
-            padding=padding.PKCS1v15(),
-            algorithm=hashes.SHA256()
-            )
-    except:
+    #The RSA check runs in the worker process pool (if started) so it doesn't hold up other requests.
+    if not workers.verifySignature(publicKeyBytes=publicKeyBytes, signature=sigBytes, data=challenge):
         #The challenge signature is invalid. Treat as if a wrong password was entered; deny access.
         return makeError(clientRequest=clientRequest, errorCode='InvalidResponse', reason='The challenge signature could not be verified. Please request a new challenge.')
 
     #The client is now authenticated!
-    dbConn = dmaftServerDB.startDB()
-    if userId in [None,'']:
-        #The user doesn't exist yet. Register them.
-        newUserId = dmaftServerDB.registerUser(connection=dbConn, publicKey=userPublicKey)
-        if newUserId is None:
-            dmaftServerDB.closeDB(dbConn)
-            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to register the new user record after successful authentication. Please request a new challenge.')
-
-        userId = newUserId
-        print("Successfully created a new userId!")
-
-    #Issue the user a token and construct a response
-    token = dmaftServerDB.createToken(connection=dbConn, userID=userId)
-    print("Created the token!")
+    with dmaftServerDB.borrowDB() as dbConn:
+        if userId in [None,'']:
+            #The user doesn't exist yet. Register them.
+            newUserId = dmaftServerDB.registerUser(connection=dbConn, publicKey=userPublicKey, acceptID=clusterLink.isLocalUser) #In a cluster, new users must belong to this node.
+            if newUserId is None:
+                return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to register the new user record after successful authentication. Please request a new challenge.')
+
+            userId = newUserId
+            log.info("Registered new user %s", userId)
+
+        #Issue the user a token and construct a response
+        token = dmaftServerDB.createToken(connection=dbConn, userID=userId)
     if token is None:
         #Token creation failed. Provide a fake token with the real user ID to the client. They can get a new token on their own using that info.
-        dmaftServerDB.closeDB(dbConn)
         clientRequest['Successful'] = True
         clientRequest['UserId'] = userId
         clientRequest['TokenId'] = ''
@@ -181,7 +161,7 @@ def validateClientToken(clientRequest: dict):
     keys = set(clientRequest.keys())
     requiredKeys = {'UserId','TokenId','TokenSecret'}
     if not requiredKeys.issubset(keys):
-        print("handleAuth.validateClientToken(): Received client request with missing keys! Sending BadRequest to client...")
+        log.debug("validateClientToken(): Received client request with missing keys; sending BadRequest.")
         clientRequest = cleanAuthData(clientRequest)
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='handleAuth.validateClientToken(): A required JSON key (UserId, TokenId, TokenSecret) is missing from the request.')
     
@@ -198,13 +178,25 @@ def validateClientToken(clientRequest: dict):
     #Decode the Base64-encoded token secret.
     trueTokenSecret = base64.b64decode(clientRequest['TokenSecret'])
 
-    dbConn = dmaftServerDB.startDB()
-    try:
-        if not dmaftServerDB.doesUserExist(connection=dbConn, userID=clientRequest['UserId']):
+    #Tokens that were validated recently are checked in memory without touching SQLite.
+    #A cached token also implies its user exists, since tokens are only issued to registered users.
+    cacheHit, authorizedUser = dmaftServerDB.validateCachedToken(tokenID=clientRequest['TokenId'], tokenSecret=trueTokenSecret)
+    if cacheHit:
+        if authorizedUser is None:
+            clientRequest = cleanAuthData(clientRequest)
+            return makeError(clientRequest=clientRequest, errorCode='InvalidToken', reason='The provided token is invalid. Please authenticate.')
+        if str(authorizedUser).upper() != str(clientRequest['UserId']).upper():
             clientRequest = cleanAuthData(clientRequest)
-            return makeError(clientRequest=clientRequest, errorCode='InvalidUserId', reason="The specified User ID doesn't exist. Please try a different ID or register an account.")
-        
-        authorizedUser = dmaftServerDB.validateToken(connection=dbConn, tokenID=clientRequest['TokenId'], tokenSecret=trueTokenSecret)
+            return makeError(clientRequest=clientRequest, errorCode='InvalidToken', reason='A User ID validation error occurred after successful authentication.')
+        return cleanAuthData(clientRequest)
+
+    try:
+        with dmaftServerDB.borrowDB() as dbConn:
+            if not dmaftServerDB.doesUserExist(connection=dbConn, userID=clientRequest['UserId']):
+                clientRequest = cleanAuthData(clientRequest)
+                return makeError(clientRequest=clientRequest, errorCode='InvalidUserId', reason="The specified User ID doesn't exist. Please try a different ID or register an account.")
+
+            authorizedUser = dmaftServerDB.validateToken(connection=dbConn, tokenID=clientRequest['TokenId'], tokenSecret=trueTokenSecret)
         if authorizedUser is None:
            clientRequest = cleanAuthData(clientRequest)
            return makeError(clientRequest=clientRequest, errorCode='InvalidToken', reason='The provided token is invalid. Please authenticate.')
@@ -216,6 +208,6 @@ def validateClientToken(clientRequest: dict):
         return cleanAuthData(clientRequest)
     
     except:
-        print("handleAuth.validateClientToken(): Unable to complete the token validation request. Sending ServerInternalError to client...")
+        log.exception("validateClientToken(): Unable to complete the token validation request.")
         clientRequest = cleanAuthData(clientRequest)
-        return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='handleAuth.validateClientToken(): Server failed to prune the tokens table. Please try again.')
+        return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='handleAuth.validateClientToken(): Server failed to query the tokens table. Please try again.')
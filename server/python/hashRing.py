@@ -0,0 +1,40 @@
+import bisect
+import hashlib
+
+#Consistent hashing of user IDs onto cluster nodes.
+#Each node is placed on a ring of 64-bit positions many times over (virtual nodes), and a key belongs to the first
+#node at or after its own position. Adding or removing a node only moves the keys next to that node's positions,
+#about 1/N of them, and the virtual nodes keep every node's share close to even.
+#Keys are upper-cased first, so a UserID maps to the same node however the client spells it.
+
+defaultVirtualNodes = 64
+
+
+def _position(value: str):
+    return int.from_bytes(hashlib.sha256(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, nodeNames: list[str], virtualNodes: int = defaultVirtualNodes):
+        if len(nodeNames) == 0:
+            raise ValueError("hashRing.HashRing(): At least one node is required!")
+        if len(set(nodeNames)) != len(nodeNames):
+            raise ValueError("hashRing.HashRing(): Node names must be unique!")
+        self.nodeNames = list(nodeNames)
+        points = sorted((_position(name + '#' + str(i)), name) for name in nodeNames for i in range(max(1, virtualNodes)))
+        self.positions = [position for position, name in points]
+        self.owners = [name for position, name in points]
+
+    #Returns the name of the node that owns key.
+    def getNode(self, key: str):
+        index = bisect.bisect_left(self.positions, _position(str(key).upper()))
+        if index == len(self.positions):
+            index = 0
+        return self.owners[index]
+
+    #Returns {nodeName: [keys]} for the given keys, keeping their order within each node.
+    def groupByNode(self, keys: list[str]):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.getNode(key), []).append(key)
+        return groups
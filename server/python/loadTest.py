@@ -0,0 +1,641 @@
+import argparse
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+import websockets
+from websockets.asyncio.client import connect
+
+#End-to-end load generator that drives tlsServer through the real protocol over TLS websockets.
+#By default it starts its own server in a temporary directory (empty database, self-signed localhost certificate,
+#a free port), so results don't depend on master.db or the checked-in keys. --url points it at a running server instead.
+#--nodes N starts a cluster of N servers instead (see clusterLink.py), each with its own database; user i connects to
+#node i mod N and registers there. With several --url values, user i uses the i-th one in the same way.
+#
+#Phases:
+#   register       every synthetic user makes an RSA key pair, CONNECTs with Register=True, signs the challenge,
+#                  AUTHENTICATEs and binds its socket with a token PING.
+#   conversations  random groups are created with NEWCONVERSATION.
+#   send           --offline-ratio of the users disconnect, then the rest send --messages SENDMESSAGEs, --concurrency at a time,
+#                  mixing Text with Image messages of --media-sizes (inline base64, or uploaded first with --media-mode blob).
+#   drain          the offline users reconnect and PING; we time how long until every message queued for them has arrived.
+#   download       with --media-mode blob, every user downloads each attachment it received with DOWNLOADBLOB and checks
+#                  its hash. With --nodes 2 or more this covers members reading attachments uploaded on another node.
+#Reports throughput and p50/p95/p99 latency per command, live delivery latency and reconnect-drain time, as a table or --json.
+#
+#--scenario auth-storm replaces the last three phases with:
+#   quiet          --pingers users send token PINGs back to back for --storm-seconds.
+#   storm          the same, while --storm-clients connections log the other users in over and over (CONNECT, AUTHENTICATE),
+#                  each on one connection, so the TLS handshakes of reconnecting don't count.
+#Reports PING p50/p95/p99 for both, so the cost of the AUTHENTICATE load to everyone else shows up in the difference.
+
+serverDir = os.path.dirname(os.path.abspath(__file__))
+
+
+#Writes a self-signed certificate for localhost into directory and returns (certPath, keyPath).
+def makeSelfSignedCert(directory: str):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName('localhost')]), critical=False)
+        .sign(key, hashes.SHA256()))
+
+    certPath = os.path.join(directory, 'loadtest_cert.pem')
+    keyPath = os.path.join(directory, 'loadtest_key.pem')
+    with open(certPath, 'wb') as certFile:
+        certFile.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyPath, 'wb') as keyFile:
+        keyFile.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return certPath, keyPath
+
+
+def getFreePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+#Starts one tlsServer.py process on port, with its database and log named after name. Returns the process.
+def startServerProcess(directory: str, name: str, port: int, certPath: str, keyPath: str, workers: int, extraEnv: dict = None):
+    env = dict(os.environ,
+        DMAFT_SERVER_HOST='localhost',
+        DMAFT_SERVER_PORT=str(port),
+        DMAFT_TLS_CERT=certPath,
+        DMAFT_TLS_KEY=keyPath,
+        DMAFT_DB_PATH=os.path.join(directory, name + '.db'),
+        DMAFT_BLOB_DIR=os.path.join(directory, 'blobs'),
+        DMAFT_METRICS_PORT='0',
+        DMAFT_SERVER_WORKERS=str(workers),
+        **(extraEnv or {}),
+    )
+    env.setdefault('DMAFT_LOG_LEVEL', 'WARNING')
+    logFile = open(os.path.join(directory, name + '.log'), 'w')
+    return subprocess.Popen([sys.executable, os.path.join(serverDir, 'tlsServer.py')], cwd=serverDir, env=env, stdout=logFile, stderr=subprocess.STDOUT)
+
+
+#Starts tlsServer.py against a fresh database and certificate in directory. Returns (process, url, certPath).
+def spawnServer(directory: str, workers: int = 1):
+    certPath, keyPath = makeSelfSignedCert(directory)
+    port = getFreePort()
+    process = startServerProcess(directory, 'loadtest', port, certPath, keyPath, workers)
+    return process, 'wss://localhost:' + str(port), certPath
+
+
+#Starts a cluster of nodeCount servers sharing one certificate and attachment directory. Returns (processes, urls, certPath).
+def spawnCluster(directory: str, nodeCount: int, workers: int = 1):
+    certPath, keyPath = makeSelfSignedCert(directory)
+    ports = [getFreePort() for i in range(nodeCount)]
+    urls = ['wss://localhost:' + str(port) for port in ports]
+    nodes = [{'Name':'node' + str(i), 'ClusterHost':'127.0.0.1', 'ClusterPort':getFreePort(), 'Url':urls[i]} for i in range(nodeCount)]
+    configPath = os.path.join(directory, 'cluster.json')
+    with open(configPath, 'w') as configFile:
+        json.dump({'Secret':base64.b64encode(os.urandom(24)).decode('ascii'), 'Nodes':nodes}, configFile, indent=2)
+
+    processes = []
+    for i, node in enumerate(nodes):
+        processes.append(startServerProcess(directory, node['Name'], ports[i], certPath, keyPath, workers, {'DMAFT_CLUSTER_CONFIG':configPath, 'DMAFT_CLUSTER_NODE':node['Name']}))
+    return processes, urls, certPath
+
+
+async def waitForServer(url: str, sslContext: ssl.SSLContext, process = None, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with connect(url, ssl=sslContext):
+                return
+        except OSError:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError("loadTest: The server exited during startup; see its log.")
+            if time.monotonic() > deadline:
+                raise RuntimeError("loadTest: Timed out waiting for the server at " + url)
+            await asyncio.sleep(0.2)
+
+
+#Per-command request latencies.
+class LatencyLog:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.spans = {}
+
+    def record(self, command: str, start: float, end: float, errorType: str = None):
+        self.samples.setdefault(command, []).append(end - start)
+        if errorType is not None:
+            self.errors.setdefault(command, {})
+            self.errors[command][errorType] = self.errors[command].get(errorType, 0) + 1
+        first, last = self.spans.get(command, (start, end))
+        self.spans[command] = (min(first, start), max(last, end))
+
+    def summarize(self):
+        results = {}
+        for command, samples in sorted(self.samples.items()):
+            first, last = self.spans[command]
+            results[command] = dict(summarizeSeconds(samples),
+                Errors=self.errors.get(command, {}),
+                PerSecond=len(samples) / (last - first) if last > first else None,
+            )
+        return results
+
+
+#Nearest-rank percentiles of a list of durations, in milliseconds.
+def summarizeSeconds(samples: list[float]):
+    if len(samples) == 0:
+        return {'Count':0, 'P50Ms':None, 'P95Ms':None, 'P99Ms':None, 'MaxMs':None}
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))] * 1000
+
+    return {'Count':len(ordered), 'P50Ms':percentile(0.50), 'P95Ms':percentile(0.95), 'P99Ms':percentile(0.99), 'MaxMs':ordered[-1] * 1000}
+
+
+class RequestFailed(Exception):
+    pass
+
+
+#One simulated client. Requests go out one at a time per user, like a real client; replies are the frames with a
+#'Successful' key (server pushes such as INCOMINGMESSAGE don't have one) and arrive in request order.
+class SyntheticUser:
+    def __init__(self, index: int, privateKey: rsa.RSAPrivateKey, latencies: LatencyLog, requestTimeout: float):
+        self.index = index
+        self.privateKey = privateKey
+        self.latencies = latencies
+        self.requestTimeout = requestTimeout
+        self.auth = None
+        self.socket = None
+        self.reader = None
+        self.replies = None
+        self.requestLock = asyncio.Lock()
+        self.received = 0
+        self.receivedEvent = asyncio.Event()
+        self.lastReceived = None
+        self.deliverySeconds = []
+        self.blobRefs = {} #Sha256 -> Size of every attachment received
+        self.url = None #the server this user registered on
+
+    async def open(self, url: str, sslContext: ssl.SSLContext):
+        self.url = url
+        self.socket = await connect(url, ssl=sslContext, max_size=None)
+        self.replies = asyncio.Queue()
+        self.reader = asyncio.create_task(self._readFrames())
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+            await self.reader
+            self.socket = None
+
+    async def _readFrames(self):
+        try:
+            async for message in self.socket:
+                frame = json.loads(message)
+                if 'Successful' in frame:
+                    self.replies.put_nowait(frame)
+                elif frame.get('Command') == 'INCOMINGMESSAGE':
+                    self._onMessage(frame)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    #MessageIds carry the sender's perf_counter, which is comparable here because every user lives in this process.
+    def _onMessage(self, frame: dict):
+        now = time.perf_counter()
+        self.received += 1
+        self.lastReceived = now
+        self.receivedEvent.set()
+        if type(frame.get('BlobRef')) == dict:
+            self.blobRefs[frame['BlobRef']['Sha256']] = frame['BlobRef']['Size']
+        try:
+            self.deliverySeconds.append(now - float(str(frame.get('MessageId')).rsplit('-', 1)[1]))
+        except (IndexError, ValueError):
+            pass
+
+    #Sends one request and returns its reply. Raises RequestFailed on an error reply or a timeout.
+    async def request(self, msgDict: dict, *, authenticated: bool = True):
+        if authenticated:
+            msgDict = dict(msgDict, **self.auth)
+        msgDict.setdefault('ClientTimestamp', time.time())
+        command = msgDict['Command']
+        async with self.requestLock:
+            start = time.perf_counter()
+            await self.socket.send(json.dumps(msgDict))
+            try:
+                reply = await asyncio.wait_for(self.replies.get(), self.requestTimeout)
+            except asyncio.TimeoutError:
+                self.latencies.record(command, start, time.perf_counter(), 'Timeout')
+                await self.socket.close()
+                raise RequestFailed(command + " timed out for user " + str(self.index))
+            errorType = reply.get('ErrorType')
+            self.latencies.record(command, start, time.perf_counter(), errorType)
+        if errorType is not None:
+            raise RequestFailed(command + " failed for user " + str(self.index) + ": " + str(errorType) + " " + str(reply.get('UserErrorMessage')))
+        return reply
+
+    async def register(self):
+        await self.logIn(register=True)
+        await self.bind()
+
+    #CONNECTs and AUTHENTICATEs, as a new user or as the one in self.auth, and keeps the new token.
+    async def logIn(self, register: bool = False):
+        publicNumbers = self.privateKey.public_key().public_numbers()
+        reply = await self.request({
+            'Command':'CONNECT',
+            'UserPublicKeyMod':str(publicNumbers.n),
+            'UserPublicKeyExp':str(publicNumbers.e),
+            'ClientTimestamp':time.time(),
+            'UserId':'' if register else self.auth['UserId'],
+            'Register':register,
+        }, authenticated=False)
+        signature = self.privateKey.sign(base64.b64decode(reply['ChallengeData']), padding.PKCS1v15(), hashes.SHA256())
+        reply = await self.request({
+            'Command':'AUTHENTICATE',
+            'ChallengeId':reply['ChallengeId'],
+            'Signature':base64.b64encode(signature).decode('ascii'),
+            'HashAlgorithm':'SHA256',
+        }, authenticated=False)
+        self.auth = {'UserId':reply['UserId'], 'TokenId':reply['TokenId'], 'TokenSecret':reply['TokenSecret']}
+
+    #Ties the socket to the user, which also starts the mailbox drain.
+    async def bind(self):
+        reply = await self.request({'Command':'PING'})
+        if not reply.get('AuthSuccessful'):
+            raise RequestFailed("PING authentication failed for user " + str(self.index))
+
+    async def uploadBlob(self, data: bytes, chunkBytes: int):
+        sha256 = hashlib.sha256(data).hexdigest()
+        offset = 0
+        while True:
+            reply = await self.request({
+                'Command':'UPLOADBLOB',
+                'Sha256':sha256,
+                'Size':len(data),
+                'Offset':offset,
+                'ChunkData':base64.b64encode(data[offset:offset + chunkBytes]).decode('ascii'),
+            })
+            offset = reply['NextOffset']
+            if reply['Complete']:
+                return reply['BlobRef']
+
+
+    #Downloads a whole attachment in chunks and returns it.
+    async def downloadBlob(self, sha256: str, chunkBytes: int):
+        chunks = []
+        offset = 0
+        while True:
+            reply = await self.request({'Command':'DOWNLOADBLOB', 'Sha256':sha256, 'Offset':offset, 'Length':chunkBytes})
+            chunks.append(base64.b64decode(reply['ChunkData']))
+            offset = reply['NextOffset']
+            if reply['Final']:
+                return b''.join(chunks)
+
+
+async def runConcurrently(jobs, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def runJob(job):
+        async with semaphore:
+            try:
+                return await job
+            except (RequestFailed, OSError, websockets.exceptions.WebSocketException) as e:
+                return e
+
+    return await asyncio.gather(*[runJob(job) for job in jobs])
+
+
+class LoadTest:
+    def __init__(self, args, urls: list[str], sslContext: ssl.SSLContext):
+        self.args = args
+        self.urls = urls
+        self.sslContext = sslContext
+        self.random = random.Random(args.seed)
+        self.latencies = LatencyLog()
+        self.users = []
+        self.conversations = [] #(ConversationId, [member SyntheticUsers])
+        self.phaseSeconds = {}
+        self.failures = []
+        self.payloads = {size: os.urandom(size) for size in args.media_sizes}
+
+    def _noteFailures(self, results):
+        for result in results:
+            if isinstance(result, Exception):
+                self.failures.append(str(result))
+
+    async def registerUsers(self):
+        loop = asyncio.get_running_loop()
+        keys = await asyncio.gather(*[loop.run_in_executor(None, lambda: rsa.generate_private_key(public_exponent=65537, key_size=self.args.key_bits)) for i in range(self.args.users)])
+        users = [SyntheticUser(i, key, self.latencies, self.args.request_timeout) for i, key in enumerate(keys)]
+
+        async def registerOne(user):
+            await user.open(self.urls[user.index % len(self.urls)], self.sslContext)
+            await user.register()
+            return user
+
+        start = time.perf_counter()
+        results = await runConcurrently([registerOne(user) for user in users], self.args.concurrency)
+        self.phaseSeconds['Register'] = time.perf_counter() - start
+        self._noteFailures(results)
+        self.users = [user for user in results if isinstance(user, SyntheticUser)]
+        if len(self.users) < 2:
+            raise RuntimeError("loadTest: Fewer than two users registered; nothing to test. First failure: " + str(self.failures[:1]))
+
+    async def createConversations(self):
+        async def createOne():
+            members = self.random.sample(self.users, min(len(self.users), max(2, self.args.members)))
+            reply = await members[0].request({'Command':'NEWCONVERSATION', 'RecipientIds':[member.auth['UserId'] for member in members[1:]]})
+            return reply['NewConversationId'], members
+
+        start = time.perf_counter()
+        results = await runConcurrently([createOne() for i in range(self.args.conversations)], self.args.concurrency)
+        self.phaseSeconds['Conversations'] = time.perf_counter() - start
+        self._noteFailures(results)
+        self.conversations = [result for result in results if not isinstance(result, Exception)]
+
+    async def sendMessages(self):
+        offlineCount = int(round(self.args.offline_ratio * len(self.users)))
+        self.offlineUsers = set(self.random.sample(self.users, offlineCount))
+        await asyncio.gather(*[user.close() for user in self.offlineUsers])
+        self.expected = {user: 0 for user in self.offlineUsers}
+        self.expectedLive = 0
+
+        sendable = [(conversationID, members, [member for member in members if member not in self.offlineUsers]) for conversationID, members in self.conversations]
+        sendable = [entry for entry in sendable if len(entry[2]) > 0]
+        if len(sendable) == 0:
+            raise RuntimeError("loadTest: No conversation has an online member to send from.")
+
+        async def sendOne(sequence: int, conversationID: str, members: list, sender: SyntheticUser):
+            msgDict = {'Command':'SENDMESSAGE', 'ConversationId':conversationID, 'MessageType':'Text', 'MessageData':'load test message ' + str(sequence)}
+            if self.random.random() < self.args.media_ratio:
+                size = self.random.choice(self.args.media_sizes)
+                data = sequence.to_bytes(8, 'big') + self.payloads[size][8:]
+                msgDict['MessageType'] = 'Image'
+                if self.args.media_mode == 'blob':
+                    msgDict['BlobRef'] = await sender.uploadBlob(data, self.args.chunk_bytes)
+                    msgDict['MessageData'] = ''
+                else:
+                    msgDict['MessageData'] = base64.b64encode(data).decode('ascii')
+            msgDict['MessageId'] = 'lt' + str(sequence) + '-' + repr(time.perf_counter())
+            await sender.request(msgDict)
+            for member in members:
+                if member in self.offlineUsers and member is not sender:
+                    self.expected[member] += 1
+                elif member is not sender:
+                    self.expectedLive += 1
+
+        jobs = []
+        for sequence in range(self.args.messages):
+            conversationID, members, online = self.random.choice(sendable)
+            jobs.append(sendOne(sequence, conversationID, members, self.random.choice(online)))
+
+        start = time.perf_counter()
+        results = await runConcurrently(jobs, self.args.concurrency)
+        self.phaseSeconds['Send'] = time.perf_counter() - start
+        self._noteFailures(results)
+
+    #Reconnects the offline users and times how long each takes to receive everything that was queued for it.
+    async def drainMailboxes(self):
+        drainSeconds = []
+        missing = 0
+
+        async def drainOne(user: SyntheticUser):
+            nonlocal missing
+            user.received = 0
+            user.lastReceived = None
+            await user.open(user.url, self.sslContext)
+            start = time.perf_counter()
+            await user.bind()
+            deadline = start + self.args.drain_timeout
+            while user.received < self.expected[user] and time.perf_counter() < deadline:
+                user.receivedEvent.clear()
+                try:
+                    await asyncio.wait_for(user.receivedEvent.wait(), deadline - time.perf_counter())
+                except asyncio.TimeoutError:
+                    break
+            missing += max(0, self.expected[user] - user.received)
+            if self.expected[user] > 0 and user.lastReceived is not None:
+                drainSeconds.append(user.lastReceived - start)
+
+        start = time.perf_counter()
+        results = await runConcurrently([drainOne(user) for user in self.offlineUsers], self.args.concurrency)
+        self.phaseSeconds['Drain'] = time.perf_counter() - start
+        self._noteFailures(results)
+        return dict(summarizeSeconds(drainSeconds), Users=len(self.offlineUsers), Messages=sum(self.expected.values()), Missing=missing)
+
+    #Times back-to-back token PINGs from the first --pingers users for --storm-seconds, first on their own and then
+    #while the other users log in again and again on connections of their own. Returns the PING latencies for each.
+    async def authStorm(self):
+        pingers = self.users[:max(1, min(self.args.pingers, len(self.users) - 1))]
+        loggers = self.users[len(pingers):]
+
+        async def pingUntil(user: SyntheticUser, latencies: LatencyLog, stopAt: float):
+            user.latencies = latencies
+            try:
+                while time.perf_counter() < stopAt:
+                    await user.request({'Command':'PING'})
+            finally:
+                user.latencies = self.latencies
+
+        async def logInUntil(index: int, stopAt: float):
+            account = loggers[index % len(loggers)]
+            user = SyntheticUser(account.index, account.privateKey, self.latencies, self.args.request_timeout)
+            user.auth = dict(account.auth)
+            await user.open(account.url, self.sslContext)
+            try:
+                while time.perf_counter() < stopAt:
+                    await user.logIn()
+            finally:
+                await user.close()
+
+        results = {}
+        for phase, stormClients in [('Quiet', 0), ('Storm', self.args.storm_clients)]:
+            latencies = LatencyLog()
+            start = time.perf_counter()
+            stopAt = start + self.args.storm_seconds
+            jobs = [pingUntil(user, latencies, stopAt) for user in pingers] + [logInUntil(i, stopAt) for i in range(stormClients)]
+            self._noteFailures(await runConcurrently(jobs, len(jobs)))
+            self.phaseSeconds[phase] = time.perf_counter() - start
+            results[phase] = latencies.summarize().get('PING', summarizeSeconds([]))
+        return dict(results, Pingers=len(pingers), StormClients=self.args.storm_clients)
+
+    #Has every user download the attachments it received. Returns how many there were, and how many came back intact.
+    async def downloadBlobs(self):
+        intact = 0
+
+        async def downloadOne(user: SyntheticUser, sha256: str):
+            nonlocal intact
+            data = await user.downloadBlob(sha256, self.args.chunk_bytes)
+            if hashlib.sha256(data).hexdigest() == sha256:
+                intact += 1
+            else:
+                self.failures.append("The attachment " + sha256 + " came back changed for user " + str(user.index))
+
+        jobs = [downloadOne(user, sha256) for user in self.users for sha256 in user.blobRefs]
+        start = time.perf_counter()
+        results = await runConcurrently(jobs, self.args.concurrency)
+        self.phaseSeconds['Download'] = time.perf_counter() - start
+        self._noteFailures(results)
+        return {'Expected':len(jobs), 'Intact':intact}
+
+    async def run(self):
+        await self.registerUsers()
+        if self.args.scenario == 'auth-storm':
+            storm = await self.authStorm()
+            await asyncio.gather(*[user.close() for user in self.users], return_exceptions=True)
+            return {
+                'Config':{key: value for key, value in vars(self.args).items() if key not in ['json', 'output']},
+                'Url':', '.join(self.urls),
+                'Users':len(self.users),
+                'PhaseSeconds':self.phaseSeconds,
+                'Commands':self.latencies.summarize(),
+                'AuthStorm':storm,
+                'Failures':len(self.failures),
+                'FirstFailures':self.failures[:5],
+            }
+        await self.createConversations()
+        await self.sendMessages()
+        liveDelivery = summarizeSeconds([seconds for user in self.users for seconds in user.deliverySeconds])
+        liveDelivery['Expected'] = self.expectedLive
+        drain = await self.drainMailboxes()
+        downloads = await self.downloadBlobs() if self.args.media_mode == 'blob' else None
+        await asyncio.gather(*[user.close() for user in self.users], return_exceptions=True)
+
+        return {
+            'Config':{key: value for key, value in vars(self.args).items() if key not in ['json', 'output']},
+            'Url':', '.join(self.urls),
+            'Users':len(self.users),
+            'Conversations':len(self.conversations),
+            'PhaseSeconds':self.phaseSeconds,
+            'MessagesPerSecond':self.args.messages / self.phaseSeconds['Send'] if self.phaseSeconds.get('Send') else None,
+            'Commands':self.latencies.summarize(),
+            'LiveDelivery':liveDelivery,
+            'Drain':drain,
+            'Downloads':downloads,
+            'Failures':len(self.failures),
+            'FirstFailures':self.failures[:5],
+        }
+
+
+def formatMs(value):
+    return '-' if value is None else f"{value:.1f}"
+
+
+def printReport(results: dict):
+    print(f"{results['Users']} users, {results.get('Conversations', 0)} conversations, {results['Failures']} failures against {results['Url']}")
+    print("Phases: " + ", ".join(name + ' ' + f"{seconds:.2f}s" for name, seconds in results['PhaseSeconds'].items()))
+    if results.get('MessagesPerSecond') is not None:
+        print(f"SENDMESSAGE throughput: {results['MessagesPerSecond']:.1f} messages/s")
+    print()
+    print(f"{'command':<18} {'count':>7} {'errors':>7} {'per sec':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for command, row in results['Commands'].items():
+        perSecond = '-' if row['PerSecond'] is None else f"{row['PerSecond']:.1f}"
+        print(f"{command:<18} {row['Count']:>7} {sum(row['Errors'].values()):>7} {perSecond:>9} {formatMs(row['P50Ms']):>9} {formatMs(row['P95Ms']):>9} {formatMs(row['P99Ms']):>9} {formatMs(row['MaxMs']):>9}")
+    if 'AuthStorm' in results:
+        storm = results['AuthStorm']
+        for name in ['Quiet', 'Storm']:
+            row = storm[name]
+            perSecond = '-' if row.get('PerSecond') is None else f"{row['PerSecond']:.1f}"
+            print(f"{'PING ' + name.lower():<18} {row['Count']:>7} {sum(row.get('Errors', {}).values()):>7} {perSecond:>9} {formatMs(row['P50Ms']):>9} {formatMs(row['P95Ms']):>9} {formatMs(row['P99Ms']):>9} {formatMs(row['MaxMs']):>9}")
+        print(f"PING from {storm['Pingers']} users, alone and then with {storm['StormClients']} connections logging in.")
+        for failure in results['FirstFailures']:
+            print("Failure:", failure)
+        return
+    for name in ['LiveDelivery', 'Drain']:
+        row = results[name]
+        print(f"{name:<18} {row['Count']:>7} {'':>7} {'':>9} {formatMs(row['P50Ms']):>9} {formatMs(row['P95Ms']):>9} {formatMs(row['P99Ms']):>9} {formatMs(row['MaxMs']):>9}")
+    print(f"Live: {results['LiveDelivery']['Count']} of {results['LiveDelivery']['Expected']} messages to online members arrived live.")
+    print(f"Drain: {results['Drain']['Messages']} queued messages for {results['Drain']['Users']} users, {results['Drain']['Missing']} never arrived.")
+    if results.get('Downloads') is not None:
+        print(f"Download: {results['Downloads']['Intact']} of {results['Downloads']['Expected']} received attachments downloaded intact.")
+    for failure in results['FirstFailures']:
+        print("Failure:", failure)
+
+
+async def main(args):
+    directory = None
+    processes = []
+    if args.url is None:
+        directory = tempfile.TemporaryDirectory(prefix='dmaft-loadtest-')
+        if args.nodes > 1:
+            processes, urls, certPath = spawnCluster(directory.name, args.nodes, args.workers)
+        else:
+            process, url, certPath = spawnServer(directory.name, args.workers)
+            processes, urls = [process], [url]
+        sslContext = ssl.create_default_context(cafile=certPath)
+    else:
+        urls = args.url
+        sslContext = ssl.create_default_context(cafile=args.ca_file)
+        if args.insecure:
+            sslContext.check_hostname = False
+            sslContext.verify_mode = ssl.CERT_NONE
+
+    try:
+        for i, url in enumerate(urls):
+            await waitForServer(url, sslContext, processes[i] if i < len(processes) else None)
+        return await LoadTest(args, urls, sslContext).run()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if directory is not None:
+            directory.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drive tlsServer end to end with synthetic users and report per-command latency.')
+    parser.add_argument('--url', nargs='+', help='wss:// URL of a running server, or one per cluster node. By default a throwaway server is started.')
+    parser.add_argument('--ca-file', help='CA bundle for verifying --url.')
+    parser.add_argument('--insecure', action='store_true', help="Don't verify the --url server's certificate.")
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for the throwaway server (SERVER_WORKERS).')
+    parser.add_argument('--nodes', type=int, default=1, help='Start a throwaway cluster of this many nodes instead of one server.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--conversations', type=int, default=20)
+    parser.add_argument('--members', type=int, default=5, help='Members per conversation, creator included.')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32, help='Requests in flight across all users.')
+    parser.add_argument('--media-ratio', type=float, default=0.1, help='Fraction of messages that are Image messages.')
+    parser.add_argument('--media-sizes', type=int, nargs='+', default=[16384, 262144], help='Image payload sizes in bytes, picked at random. Inline payloads must fit the server frame limit.')
+    parser.add_argument('--media-mode', choices=['inline', 'blob'], default='inline', help='Send media as base64 MessageData, or upload it with UPLOADBLOB and send a BlobRef.')
+    parser.add_argument('--chunk-bytes', type=int, default=262144, help='UPLOADBLOB chunk size for --media-mode blob.')
+    parser.add_argument('--offline-ratio', type=float, default=0.2, help='Fraction of users offline during the send phase.')
+    parser.add_argument('--key-bits', type=int, default=2048)
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--drain-timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenario', choices=['messages', 'auth-storm'], default='messages', help='What to run after registering (see the top of this file).')
+    parser.add_argument('--pingers', type=int, default=8, help='Users sending PINGs during auth-storm.')
+    parser.add_argument('--storm-clients', type=int, default=16, help='Connections logging in at once during auth-storm.')
+    parser.add_argument('--storm-seconds', type=float, default=10, help='Length of each auth-storm phase.')
+    parser.add_argument('--output', help='Also write the JSON results to this file.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        printReport(results)
@@ -0,0 +1,232 @@
+import bisect
+import contextlib
+import functools
+import http.server
+import math
+import threading
+import time
+
+import serverLog
+
+#In-process counters, gauges and latency histograms, exported in the Prometheus text format.
+#Counters and histograms are updated inline by the code they measure; each update is a dict lookup and a few additions
+#under a per-metric lock, so they stay on in production. Gauges are computed by a callback when someone reads them.
+#Metrics are created with counter()/histogram()/gauge(), which return the existing metric if the name is already
+#registered, so a module imported twice (tlsServer is, through handleAuth) still shares one set.
+#
+#The text can be scraped over HTTP (startHTTPServer) or fetched by an admin with the METRICS command.
+
+log = serverLog.getLogger('metrics')
+
+#Seconds. Spans sub-millisecond cache hits up to requests that hit the send timeout.
+latencyBuckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+#Counts of things (recipients, sockets).
+sizeBuckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_registry = {}
+_registryLock = threading.Lock()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labelNames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {} #tuple of label values -> this metric's state for them
+
+    def _checkLabels(self, labelValues: tuple):
+        if len(labelValues) != len(self.labelNames):
+            raise ValueError("metrics: " + self.name + " takes labels " + str(self.labelNames) + ", got " + repr(labelValues))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labelValues, amount: float = 1):
+        with self.lock:
+            try:
+                self.values[labelValues] += amount
+            except KeyError:
+                self._checkLabels(labelValues)
+                self.values[labelValues] = amount
+
+    def get(self, *labelValues):
+        return self.values.get(labelValues, 0)
+
+    def samples(self):
+        with self.lock:
+            return [('', labelValues, value) for labelValues, value in self.values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelNames: tuple = (), buckets: tuple = latencyBuckets):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelValues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelValues)
+            if state is None:
+                self._checkLabels(labelValues)
+                #One slot per bucket plus +Inf, then the sum.
+                state = self.values[labelValues] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    #Times the body of a with statement and records it.
+    @contextlib.contextmanager
+    def time(self, *labelValues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelValues)
+
+    def samples(self):
+        with self.lock:
+            items = [(labelValues, list(state)) for labelValues, state in self.values.items()]
+        samples = []
+        for labelValues, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += count
+                samples.append(('_bucket', labelValues + (_formatValue(bound),), cumulative))
+            samples.append(('_sum', labelValues, state[-1]))
+            samples.append(('_count', labelValues, cumulative))
+        return samples
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    #callback returns a number, or {tuple of label values: number} for a labelled gauge.
+    def __init__(self, name: str, help: str, labelNames: tuple = (), callback = None):
+        super().__init__(name, help, labelNames)
+        self.callback = callback
+
+    def set(self, value: float, *labelValues):
+        with self.lock:
+            self._checkLabels(labelValues)
+            self.values[labelValues] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception as e:
+                log.warning("Gauge %s: Callback failed: %s", self.name, e)
+                return []
+            if not isinstance(result, dict):
+                result = {(): result}
+            return [('', tuple(labelValues), value) for labelValues, value in result.items()]
+        with self.lock:
+            return [('', labelValues, value) for labelValues, value in self.values.items()]
+
+
+def _register(metricClass, name: str, *args, **kwargs):
+    with _registryLock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metricClass(name, *args, **kwargs)
+        elif not isinstance(metric, metricClass):
+            raise ValueError("metrics: " + name + " is already registered as a " + metric.kind)
+        return metric
+
+
+def counter(name: str, help: str, labelNames: tuple = ()):
+    return _register(Counter, name, help, labelNames)
+
+
+def histogram(name: str, help: str, labelNames: tuple = (), buckets: tuple = latencyBuckets):
+    return _register(Histogram, name, help, labelNames, buckets)
+
+
+#Registering a gauge that already exists replaces its callback, so the last module to register it owns it.
+def gauge(name: str, help: str, labelNames: tuple = (), callback = None):
+    metric = _register(Gauge, name, help, labelNames, callback)
+    if callback is not None:
+        metric.callback = callback
+    return metric
+
+
+#Wraps func so every call is timed into histogram under the function's name.
+def timedFunction(func, histogram: Histogram):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start, name)
+    return wrapper
+
+
+def _formatValue(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+#Returns every registered metric in the Prometheus text exposition format.
+def renderPrometheus():
+    with _registryLock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP ' + metric.name + ' ' + metric.help.replace('\\', '\\\\').replace('\n', '\\n'))
+        lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+        for suffix, labelValues, value in metric.samples():
+            labelNames = metric.labelNames + (('le',) if suffix == '_bucket' else ())
+            labels = ''
+            if len(labelNames) > 0:
+                labels = '{' + ','.join(name + '="' + _escapeLabel(labelValue) + '"' for name, labelValue in zip(labelNames, labelValues)) + '}'
+            lines.append(metric.name + suffix + labels + ' ' + _formatValue(value))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/metrics', '/']:
+            self.send_error(404)
+            return
+        body = renderPrometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("HTTP %s: " + format, self.address_string(), *args)
+
+
+#Serves GET /metrics on its own daemon thread. Returns the server (pass it to stopHTTPServer), or None if port is 0.
+def startHTTPServer(host: str, port: int):
+    if port == 0:
+        return None
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='dmaft-metrics', daemon=True).start()
+    log.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+def stopHTTPServer(server):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
@@ -9,6 +9,7 @@ pingMsgFormat = {
     'TokenId':'', #OPTIONAL. If passed then all other fields are required. The server will attempt to authenticate the user and tie their websocket to their user ID.
     'TokenSecret':'', #OPTIONAL, ephemeral token provided to 'securely' keep the session alive. Most major platforms use a token of some kind for continued auth.
     'UserId':'', #OPTIONAL, server-issued, permanent User ID. Might not be needed since the server-side DB already has the token associated with a user ID.
+    'Codecs':['msgpack', 'json'], #OPTIONAL, wire codecs the client supports, most preferred first. See codec.py.
     'ClientTimestamp': time.time(),
 }
 
@@ -19,6 +20,7 @@ requestChallengeMsgFormat = {
     'UserPublicKeyExp':'', #public key exponent (e); should be Big int
     'UserId':'', #leave blank for registration, or fill for login
     'Register':'', #TRUE for new users, FALSE for existing users. If False, UserId must NOT be blank.
+    'Codecs':['msgpack', 'json'], #OPTIONAL, same as in PING.
     'ClientTimestamp': time.time(),
 }
 
@@ -66,7 +68,53 @@ sendMessageMsgFormat = {
     'ConversationId':'', #server-issued Conversation ID.
     'ClientTimestamp': time.time(),
     'MessageType':['Text', 'Image', 'Video', 'File'],
-    'MessageData':'', #text if a text-based message; base64-encoded bytes otherwise.
+    'MessageData':'', #text if a text-based message; base64-encoded bytes otherwise (raw bytes if a binary codec was negotiated).
+    'BlobRef':{'Sha256':'', 'Size':0}, #OPTIONAL, Image/Video/File only. An attachment uploaded with UPLOADBLOB, sent instead of inline MessageData.
+}
+
+#Fetch full profiles (including pictures) for up to GETPROFILES_MAX_USERS users.
+getProfilesMsgFormat = {
+    'Command':'GETPROFILES',
+    'TokenId':'',
+    'TokenSecret':'',
+    'UserId':'',
+    'Users':[{'UserId':'', 'ProfileVersion':0}], #ProfileVersion is OPTIONAL: the version the client has cached, if any.
+    'ClientTimestamp': time.time(),
+}
+
+#Upload an attachment in chunks. Chunks must arrive in order; send Offset 0 with empty ChunkData to learn where to resume.
+#Every user sends the whole attachment at least once, even if someone else already uploaded it.
+uploadBlobMsgFormat = {
+    'Command':'UPLOADBLOB',
+    'TokenId':'',
+    'TokenSecret':'',
+    'UserId':'',
+    'Sha256':'', #hex SHA-256 of the whole attachment; this is its ID.
+    'Size':0, #total size of the attachment in bytes.
+    'Offset':0, #where this chunk starts. Must equal the NextOffset from the previous reply.
+    'ChunkData':'', #base64-encoded bytes (raw bytes if a binary codec was negotiated), at most BLOB_CHUNK_BYTES.
+    'ClientTimestamp': time.time(),
+}
+
+#Download an attachment one chunk at a time. Only its uploader and the members of conversations it was sent to may.
+downloadBlobMsgFormat = {
+    'Command':'DOWNLOADBLOB',
+    'TokenId':'',
+    'TokenSecret':'',
+    'UserId':'',
+    'Sha256':'',
+    'Offset':0,
+    'Length':0, #OPTIONAL, capped at BLOB_CHUNK_BYTES.
+    'ClientTimestamp': time.time(),
+}
+
+#Admin only (ADMIN_USER_IDS): read the server's counters, gauges and latency histograms.
+metricsMsgFormat = {
+    'Command':'METRICS',
+    'TokenId':'',
+    'TokenSecret':'',
+    'UserId':'',
+    'ClientTimestamp': time.time(),
 }
 
 searchUsersMsgFormat = {
@@ -76,6 +124,8 @@ searchUsersMsgFormat = {
     'UserId':'', #server-issued, permanent User ID. Might not be needed since the server-side DB already has the token associated with a user ID.
     'SearchBy':['UserId','UserName'],
     'SearchTerm':'', #
+    'Limit':25, #OPTIONAL, name searches only. Results per page, at most SEARCH_MAX_LIMIT.
+    'Cursor':'', #OPTIONAL, name searches only. The NextCursor from the previous page.
     'ClientTimestamp': time.time()
 }
 
@@ -121,12 +171,18 @@ errorTypes = [
     {'ErrorType':'BadRequest'},
     {'ErrorType':'InvalidToken'},
     {'ErrorType':'InvalidResponse'},
-    {'ErrorType':'InvalidChallengeId'}, #could either be due to the challenge expiring earlier or it just not existing. Basically the same situation since the table gets pruned BEFORE querying.
+    {'ErrorType':'InvalidChallengeId'}, #could either be due to the challenge expiring earlier or it just not existing. Basically the same situation since expired challenges are filtered out when querying.
     {'ErrorType':'ServerInternalError'},
     {'ErrorType':'InvalidConversationId'},
     {'ErrorType':'InvalidUserId'},
     {'ErrorType':'InvalidRecipientId'},
     {'ErrorType':'NoRecipientsSpecified'},
+    {'ErrorType':'InvalidBlobRef'}, #the attachment hasn't been uploaded (or the Size is wrong).
+    {'ErrorType':'InvalidOffset', 'NextOffset':0}, #upload/download offset doesn't match what the server has; resume from NextOffset.
+    {'ErrorType':'BlobTooLarge'},
+    {'ErrorType':'BlobHashMismatch'}, #the finished upload didn't hash to its Sha256; it was discarded.
+    {'ErrorType':'PermissionDenied'}, #admin-only command sent by a regular user.
+    {'ErrorType':'WrongNode', 'NodeUrl':'wss://...'}, #clustered server: this user is served by another node; reconnect to NodeUrl.
     {
         'ErrorType':'UserBanned',
         'BanExpiry': time, #Cannot be non-None unless PermanentBan is False
@@ -139,6 +195,7 @@ pingReplyFormat = {
     'Command': 'PING',
     'Successful': True,
     'AuthSuccessful': bool, #only appears if the client submitted their token info.
+    'Codec': 'json', #only appears if the client sent Codecs. Every frame the server sends after this reply uses this codec.
     'ClientTimestamp':'', #inherited from request
     'ServerTimestamp': time.time()
 }
@@ -175,6 +232,42 @@ incomingMessageMsgFormat = {
     'ConversationId':'',
     'MessageType':'',
     'MessageData':'',
+    'BlobRef':{'Sha256':'', 'Size':0}, #only present if the sender attached an uploaded blob; fetch it with DOWNLOADBLOB.
+}
+
+getProfilesResponseFormat = {
+    'Command':'GETPROFILES',
+    'Successful': True,
+    'Profiles':[{'UserId':'', 'UserName':'', 'Status':'', 'Bio':'', 'ProfilePic':'', 'ProfileVersion':0}], #only users whose profile differs from the version sent
+    'Unchanged':[], #User IDs whose cached version is still current
+    'Missing':[], #User IDs that aren't registered
+    'ServerTimestamp': time.time(),
+}
+
+uploadBlobResponseFormat = {
+    'Command':'UPLOADBLOB',
+    'Successful': True,
+    'NextOffset':0, #next byte the server expects
+    'Complete': bool,
+    'BlobRef':{'Sha256':'', 'Size':0}, #only present once Complete is True.
+    'ServerTimestamp': time.time(),
+}
+
+metricsResponseFormat = {
+    'Command':'METRICS',
+    'Successful': True,
+    'Metrics':'', #Prometheus text exposition format, same as the HTTP metrics endpoint serves.
+    'ServerTimestamp': time.time(),
+}
+
+downloadBlobResponseFormat = {
+    'Command':'DOWNLOADBLOB',
+    'Successful': True,
+    'Size':0, #total size of the attachment
+    'ChunkData':'', #base64-encoded bytes (raw bytes if a binary codec was negotiated)
+    'NextOffset':0,
+    'Final': bool, #True once the last chunk has been sent.
+    'ServerTimestamp': time.time(),
 }
 
 newConversationCreatedMsgFormat = {
@@ -182,6 +275,7 @@ newConversationCreatedMsgFormat = {
     'ServerTimestamp': time.time(),
     'CreatorId':'', #server-issued ID for the user that created the conversation
     'Members':'', #server-issued User IDs for all participants in the conversation.
+    'MemberData':[{'UserId':'', 'UserName':'', 'ProfileVersion':0}], #use GETPROFILES for anything else, e.g. pictures that aren't cached at this version.
     'ConversationId':'', #server-issued Conversation ID for this conversation.
 }
 
@@ -198,7 +292,8 @@ searchUsersResponseMsgFormat = {
     'SearchBy':['UserId','UserName'],
     'SearchTerm':'', #
     'ServerTimestamp': time.time(),
-    'Results':[{'UserId':'','UserName':'','Status':'','Bio:':'','ProfilePic':''}, {'UserId':'','UserName':'','Status':'','Bio:':'','ProfilePic':''}]
+    'Results':[{'UserId':'','UserName':'','Status':'','Bio:':'','ProfilePic':''}, {'UserId':'','UserName':'','Status':'','Bio:':'','ProfilePic':''}],
+    'NextCursor':'', #None on the last page. Name matches that start with the SearchTerm come before ones that only contain it.
 }
 #Status, Bio, ProfilePic only appear if searching by ID.
 
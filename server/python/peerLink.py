@@ -0,0 +1,291 @@
+import asyncio
+import itertools
+import os
+import pickle
+import struct
+
+import dmaftServerDB
+import metrics
+import serverConfig
+import serverLog
+
+#Links between the worker processes of one server (see supervisor.py), over Unix sockets.
+#Each worker listens on <socketDir>/worker-<N>.sock and keeps one outgoing connection to every other worker.
+#Everything a worker says goes out on its own outgoing connections; replies come back on the same connection.
+#
+#Presence: whenever a user's first socket on a worker authenticates, or their last one closes, the worker tells
+#every other worker, and a worker that (re)connects to a peer starts by sending the full list of its users.
+#So each worker holds a copy of the presence directory: which other workers each online user is connected to.
+#A worker's entries are dropped as soon as its connection closes, so a crashed worker's users stop looking online.
+#
+#Delivery: a message for a user who is online on another worker is forwarded to that worker, which queues it on the
+#user's sockets there and replies with the users it reached. Anyone it didn't reach goes to the mailbox as before.
+#Conversation topic changes (new conversations, members leaving) are forwarded too, so every worker's topics stay current.
+#
+#Tokens: every worker caches validated tokens (dmaftServerDB.TokenCache), so a deleted token is announced for the others
+#to evict. Announcements made while a link is down are lost, so a worker clears its whole cache when a peer says HELLO.
+#
+#Frames are a 4-byte length followed by a pickle. Only processes running as the server's user can open the
+#sockets (the directory is private to it), so nothing here is read from an untrusted peer.
+
+log = serverLog.getLogger('peers')
+
+forwardedUsers = metrics.counter('dmaft_peer_forwarded_users_total', 'Recipients forwarded to another worker process, by whether it reached them.', ('result',))
+
+_header = struct.Struct('>I')
+#Frames bigger than this mean the stream is out of step; the connection is dropped.
+_maxFrameBytes = 256 * 1024 * 1024
+#Seconds between attempts to reach a worker that isn't listening (yet).
+_reconnectDelay = 0.5
+
+
+def getSocketPath(socketDir: str, workerID: int):
+    return os.path.join(socketDir, 'worker-' + str(workerID) + '.sock')
+
+
+async def _readFrame(reader: asyncio.StreamReader):
+    size = _header.unpack(await reader.readexactly(_header.size))[0]
+    if size > _maxFrameBytes:
+        raise ValueError("peerLink: Frame of " + str(size) + " bytes is over the limit.")
+    return pickle.loads(await reader.readexactly(size))
+
+
+def _packFrame(message: dict):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return _header.pack(len(data)) + data
+
+
+class _Peer:
+    def __init__(self, workerID: int):
+        self.workerID = workerID
+        self.writer = None #outgoing connection, once it's up
+        self.pending = {} #RequestId -> future for the users a DELIVER reached
+        self.task = None
+
+
+#One worker's end of the links. Every method except announce* must run on the worker's event loop;
+#the announce* methods may be called from any thread (ConnectionList calls them from request handlers).
+class PeerLink:
+    def __init__(self, connections, *, workerID: int, workerCount: int, socketDir: str):
+        self.connections = connections
+        self.workerID = workerID
+        self.socketDir = socketDir
+        self.peers = {peerID: _Peer(peerID) for peerID in range(workerCount) if peerID != workerID}
+        self.presence = {} #upper-cased UserID -> set of other worker IDs the user is connected to
+        self.server = None
+        self.loop = None
+        self.requestIDs = itertools.count()
+        self.inbound = set()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        path = getSocketPath(self.socketDir, self.workerID)
+        if os.path.exists(path):
+            os.unlink(path) #left behind by the worker this one replaces
+        self.server = await asyncio.start_unix_server(self._serveInbound, path=path)
+        for peer in self.peers.values():
+            peer.task = asyncio.create_task(self._connectOutbound(peer))
+        log.info("Worker %d: Linking to %d other workers through %s", self.workerID, len(self.peers), self.socketDir)
+
+    async def stop(self):
+        for peer in self.peers.values():
+            if peer.task is not None:
+                peer.task.cancel()
+            self._dropOutbound(peer)
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.inbound):
+                writer.close()
+            self.server = None
+        try:
+            os.unlink(getSocketPath(self.socketDir, self.workerID))
+        except FileNotFoundError:
+            pass
+
+    #Returns the other workers the user is connected to.
+    def getRemoteWorkers(self, userID: str):
+        return self.presence.get(str(userID).upper(), ())
+
+    def isUserOnline(self, userID: str):
+        return len(self.getRemoteWorkers(userID)) > 0
+
+
+    #ANNOUNCEMENTS (any thread)
+    #Called with the ConnectionList lock held, so announcements leave in the order the changes happened.
+    def announcePresence(self, userKey: str, online: bool):
+        self._announce({'Type':'ONLINE' if online else 'OFFLINE', 'UserId':userKey})
+
+    def announceTopic(self, conversationID: str, members: list[str]):
+        self._announce({'Type':'TOPICADD', 'ConversationId':conversationID, 'Members':list(members)})
+
+    def announceTopicMemberRemoved(self, conversationID: str, userID: str):
+        self._announce({'Type':'TOPICREMOVE', 'ConversationId':conversationID, 'UserId':userID})
+
+    #Pass tokenID to revoke one token, or userID to revoke every token the user holds.
+    def announceTokensRevoked(self, *, tokenID: str = None, userID: str = None):
+        self._announce({'Type':'TOKENREVOKED', 'TokenId':tokenID, 'UserId':userID})
+
+    def _announce(self, message: dict):
+        if self.loop is None:
+            return
+        frame = _packFrame(message)
+        try:
+            if _isOnLoop(self.loop):
+                self._sendToAll(frame)
+            else:
+                self.loop.call_soon_threadsafe(self._sendToAll, frame)
+        except RuntimeError:
+            pass #the loop has already closed; we're shutting down
+
+    def _sendToAll(self, frame: bytes):
+        for peer in self.peers.values():
+            if peer.writer is not None:
+                peer.writer.write(frame)
+
+
+    #FORWARDING
+    #Forwards the message to every other worker any of the users are connected to, and waits for their replies.
+    #The other workers reply once the message is queued on their sockets, and mailbox it themselves if it's dropped after that
+    #(see clients.ConnectionList.fanOut for mailbox).
+    #Returns the set of users (as given) that at least one other worker queued it for.
+    async def deliver(self, userList: list[str], msgData, mailbox: dict = None):
+        byWorker = {}
+        for user in dict.fromkeys(userList):
+            for peerID in self.getRemoteWorkers(user):
+                byWorker.setdefault(peerID, []).append(user)
+        if len(byWorker) == 0:
+            return set()
+
+        waiting = []
+        for peerID, users in byWorker.items():
+            peer = self.peers.get(peerID)
+            if peer is None or peer.writer is None:
+                continue
+            requestID = next(self.requestIDs)
+            future = self.loop.create_future()
+            peer.pending[requestID] = future
+            peer.writer.write(_packFrame({'Type':'DELIVER', 'RequestId':requestID, 'Users':users, 'Message':msgData, 'Mailbox':mailbox}))
+            waiting.append((peer, requestID, future))
+        if len(waiting) == 0:
+            return set()
+
+        #The other worker only has to queue it, so this is only reached if it has stopped answering.
+        await asyncio.wait([future for peer, requestID, future in waiting], timeout=serverConfig.PEER_REPLY_TIMEOUT)
+        delivered = set()
+        for peer, requestID, future in waiting:
+            peer.pending.pop(requestID, None)
+            if future.done() and not future.cancelled():
+                delivered.update(future.result())
+        forwarded = {user for peerID, users in byWorker.items() for user in users}
+        forwardedUsers.inc('delivered', amount=len(delivered))
+        forwardedUsers.inc('missed', amount=len(forwarded - delivered))
+        return delivered
+
+
+    #OUTGOING CONNECTIONS
+    async def _connectOutbound(self, peer: _Peer):
+        path = getSocketPath(self.socketDir, peer.workerID)
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(_reconnectDelay)
+                continue
+
+            peer.writer = writer
+            #Introduce ourselves with everyone connected here; later changes follow on the same stream.
+            writer.write(_packFrame({'Type':'HELLO', 'Worker':self.workerID, 'Online':self.connections.getOnlineUsers()}))
+            log.info("Worker %d: Linked to worker %d", self.workerID, peer.workerID)
+            try:
+                while True:
+                    message = await _readFrame(reader)
+                    if message.get('Type') == 'DELIVERED':
+                        future = peer.pending.pop(message['RequestId'], None)
+                        if future is not None and not future.done():
+                            future.set_result(set(message['Users']))
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+                log.warning("Worker %d: Lost the link to worker %d: %s", self.workerID, peer.workerID, e)
+            finally:
+                self._dropOutbound(peer)
+            await asyncio.sleep(_reconnectDelay)
+
+    def _dropOutbound(self, peer: _Peer):
+        if peer.writer is not None:
+            peer.writer.close()
+            peer.writer = None
+        for future in peer.pending.values():
+            if not future.done():
+                future.set_result(set())
+        peer.pending = {}
+
+
+    #INCOMING CONNECTIONS
+    async def _serveInbound(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peerID = None
+        self.inbound.add(writer)
+        try:
+            while True:
+                message = await _readFrame(reader)
+                messageType = message.get('Type')
+                if messageType == 'HELLO':
+                    peerID = message['Worker']
+                    self._forgetWorker(peerID)
+                    dmaftServerDB.tokenCache.clear() #it may have deleted tokens while we couldn't hear it
+                    for userKey in message['Online']:
+                        self.presence.setdefault(userKey, set()).add(peerID)
+                elif messageType == 'ONLINE':
+                    self.presence.setdefault(message['UserId'], set()).add(peerID)
+                elif messageType == 'OFFLINE':
+                    self._removePresence(message['UserId'], peerID)
+                elif messageType == 'TOPICADD':
+                    self.connections.addTopic(message['ConversationId'], message['Members'], announce=False)
+                elif messageType == 'TOPICREMOVE':
+                    self.connections.removeTopicMember(message['ConversationId'], message['UserId'], announce=False)
+                elif messageType == 'TOKENREVOKED':
+                    if message['TokenId'] is not None:
+                        dmaftServerDB.tokenCache.evictToken(message['TokenId'], announce=False)
+                    if message['UserId'] is not None:
+                        dmaftServerDB.tokenCache.evictUser(message['UserId'], announce=False)
+                elif messageType == 'DELIVER':
+                    #Each delivery waits on its own sockets, so one slow reader doesn't hold up the rest of the stream.
+                    asyncio.create_task(self._deliverLocally(writer, message))
+                else:
+                    log.warning("Worker %d: Unknown message type %s from worker %s", self.workerID, messageType, peerID)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass #shutting down; asyncio's stream callback would report the cancellation as an error
+        finally:
+            self.inbound.discard(writer)
+            writer.close()
+            if peerID is not None:
+                self._forgetWorker(peerID)
+
+    async def _deliverLocally(self, writer: asyncio.StreamWriter, message: dict):
+        try:
+            delivered = await self.connections.fanOut(message['Users'], message['Message'], message.get('Mailbox'))
+        except Exception as e:
+            log.error("Worker %d: Failed to deliver a forwarded message: %s", self.workerID, e)
+            delivered = set()
+        if not writer.is_closing():
+            writer.write(_packFrame({'Type':'DELIVERED', 'RequestId':message['RequestId'], 'Users':list(delivered)}))
+
+    def _removePresence(self, userKey: str, peerID: int):
+        workers = self.presence.get(userKey)
+        if workers is None:
+            return
+        workers.discard(peerID)
+        if len(workers) == 0:
+            del self.presence[userKey]
+
+    #Drops everything we knew about a worker's users, e.g. because its link closed.
+    def _forgetWorker(self, peerID: int):
+        for userKey in [userKey for userKey, workers in self.presence.items() if peerID in workers]:
+            self._removePresence(userKey, peerID)
+
+
+def _isOnLoop(loop: asyncio.AbstractEventLoop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
@@ -0,0 +1,98 @@
+import os
+
+#Server-wide settings.
+#Every value can be overridden by setting the environment variable of the same name prefixed with DMAFT_,
+#e.g. DMAFT_DB_POOL_SIZE=16.
+
+def _envStr(name: str, default: str):
+    return os.environ.get('DMAFT_' + name, default)
+
+def _envInt(name: str, default: int):
+    value = os.environ.get('DMAFT_' + name)
+    if value in [None, '']:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("serverConfig: DMAFT_" + name + " must be an integer, got " + repr(value))
+
+
+#SERVER
+SERVER_HOST = _envStr('SERVER_HOST', 'localhost') #Address the websocket server listens on.
+SERVER_PORT = _envInt('SERVER_PORT', 8765)
+TLS_CERT = _envStr('TLS_CERT', 'keys/peregrine-tls_cert.pem') #PEM certificate chain for the websocket server.
+TLS_KEY = _envStr('TLS_KEY', 'keys/peregrine-tls_key.pem') #PEM private key for TLS_CERT.
+SERVER_WORKERS = _envInt('SERVER_WORKERS', 1) #Processes sharing SERVER_PORT (SO_REUSEPORT). Above 1, a supervisor starts and restarts them.
+PEER_SOCKET_DIR = _envStr('PEER_SOCKET_DIR', '') #Directory for the workers' Unix sockets to each other. Empty uses a new private temporary directory.
+PEER_REPLY_TIMEOUT = _envInt('PEER_REPLY_TIMEOUT', 2) #Seconds to wait for another worker to say which of its users a forwarded message was queued for.
+
+
+#DATABASE
+DB_BACKEND = _envStr('DB_BACKEND', 'sqlite') #Storage engine: sqlite (one file at DB_PATH), sharded (DB_SHARDS files next to it) or memory (nothing saved).
+DB_PATH = _envStr('DB_PATH', 'master.db')
+DB_SHARDS = _envInt('DB_SHARDS', 4) #User, token and mailbox files for the sharded backend.
+DB_POOL_SIZE = _envInt('DB_POOL_SIZE', 8) #Maximum number of open SQLite connections shared by all handlers.
+DB_POOL_TIMEOUT = _envInt('DB_POOL_TIMEOUT', 30) #Seconds to wait for a free connection before giving up.
+DB_BUSY_TIMEOUT_MS = _envInt('DB_BUSY_TIMEOUT_MS', 5000) #How long SQLite waits on a locked database before raising.
+DB_STATEMENT_CACHE_SIZE = _envInt('DB_STATEMENT_CACHE_SIZE', 256) #Prepared statements kept per connection.
+DB_WRITE_BATCH_SIZE = _envInt('DB_WRITE_BATCH_SIZE', 256) #Most writes the writer thread commits in one synced transaction (see WRITE QUEUE in dmaftServerDB.py). 0 commits every write on its own, on the borrowing thread, at synchronous=NORMAL instead.
+DB_WRITE_BATCH_WAIT_MS = _envInt('DB_WRITE_BATCH_WAIT_MS', 0) #How long the writer thread waits for more writes to join a batch that isn't full. Waiting only slowed writes down in benchWriteQueue.py.
+TOKEN_CACHE_SIZE = _envInt('TOKEN_CACHE_SIZE', 100000) #Validated tokens kept in memory. 0 disables the cache.
+MAILBOX_PAGE_ROWS = _envInt('MAILBOX_PAGE_ROWS', 50) #Most queued messages read at once when draining a mailbox.
+MAILBOX_PAGE_BYTES = _envInt('MAILBOX_PAGE_BYTES', 8000000) #Most message bytes read at once when draining a mailbox.
+MAILBOX_DRAIN_LEASE = _envInt('MAILBOX_DRAIN_LEASE', 60) #Seconds a worker's claim on a mailbox it is draining lasts without being renewed.
+
+
+#USER SEARCH
+SEARCH_DEFAULT_LIMIT = _envInt('SEARCH_DEFAULT_LIMIT', 25) #Results per SEARCHUSERS page when the client doesn't give a Limit.
+SEARCH_MAX_LIMIT = _envInt('SEARCH_MAX_LIMIT', 100) #Most results a single SEARCHUSERS page can return.
+USERNAME_MAX_LENGTH = _envInt('USERNAME_MAX_LENGTH', 64) #Longest UserName accepted by UPDATEPROFILE (and returned by searches).
+GETPROFILES_MAX_USERS = _envInt('GETPROFILES_MAX_USERS', 100) #Most profiles one GETPROFILES request can ask for.
+
+
+#OUTBOUND DELIVERY
+OUTBOX_MAX_FRAMES = _envInt('OUTBOX_MAX_FRAMES', 256) #Frames queued per socket before the client is treated as a slow reader and disconnected.
+OUTBOX_SEND_TIMEOUT = _envInt('OUTBOX_SEND_TIMEOUT', 10) #Seconds a single frame may take to send before the client is disconnected.
+
+
+#ATTACHMENTS
+BLOB_DIR = _envStr('BLOB_DIR', 'blobs') #Where uploaded attachments are stored, named by their SHA-256.
+BLOB_MAX_BYTES = _envInt('BLOB_MAX_BYTES', 60000000) #Largest attachment accepted.
+BLOB_CHUNK_BYTES = _envInt('BLOB_CHUNK_BYTES', 1048576) #Largest chunk accepted per upload frame, and returned per download frame.
+BLOB_UPLOAD_EXPIRY = _envInt('BLOB_UPLOAD_EXPIRY', 86400) #Seconds an unfinished upload is kept for resuming after its last chunk.
+
+
+#REQUEST WORKERS
+WORKER_THREADS = _envInt('WORKER_THREADS', 8) #Threads that run blocking request handlers (SQLite, hashing).
+LOGIN_WORKER_THREADS = _envInt('LOGIN_WORKER_THREADS', 2) #Threads that run CONNECT and AUTHENTICATE, apart from the others. 0 runs them on the WORKER_THREADS.
+WORKER_PROCESSES = _envInt('WORKER_PROCESSES', 2) #Processes that verify RSA signatures. 0 verifies on the worker threads instead.
+
+
+#LOGGING
+LOG_LEVEL = _envStr('LOG_LEVEL', 'INFO') #DEBUG also logs every frame received and sent.
+LOG_LEVELS = _envStr('LOG_LEVELS', '') #Per-subsystem overrides, e.g. 'db=DEBUG,clients=WARNING'.
+LOG_MAX_FIELD_CHARS = _envInt('LOG_MAX_FIELD_CHARS', 200) #Longer strings in logged values are truncated.
+LOG_SAMPLE_RATES = _envStr('LOG_SAMPLE_RATES', 'frames=1,replies=1') #Log one in N of these DEBUG events, e.g. 'frames=100'.
+
+
+#METRICS
+METRICS_HOST = _envStr('METRICS_HOST', '127.0.0.1') #Address the Prometheus metrics endpoint listens on.
+METRICS_PORT = _envInt('METRICS_PORT', 9464) #Port for GET /metrics; worker N of SERVER_WORKERS uses METRICS_PORT + N. 0 disables the endpoint (METRICS still works for admins).
+METRICS_MAILBOX_REFRESH = _envInt('METRICS_MAILBOX_REFRESH', 30) #Seconds the mailbox size gauges are cached between scrapes.
+ADMIN_USER_IDS = _envStr('ADMIN_USER_IDS', '') #Comma-separated UserIDs allowed to send METRICS.
+
+
+#CLUSTER
+CLUSTER_CONFIG = _envStr('CLUSTER_CONFIG', '') #JSON file listing the cluster's nodes (see clusterLink.py). Empty runs a standalone server.
+CLUSTER_NODE = _envStr('CLUSTER_NODE', '') #This node's Name in CLUSTER_CONFIG.
+CLUSTER_SECRET = _envStr('CLUSTER_SECRET', '') #Shared secret the nodes authenticate each other with. Empty uses the Secret in CLUSTER_CONFIG.
+CLUSTER_CALL_TIMEOUT = _envInt('CLUSTER_CALL_TIMEOUT', 5) #Seconds to wait for another node to answer.
+CLUSTER_THREADS = _envInt('CLUSTER_THREADS', 4) #Threads that answer requests from other nodes.
+
+
+#EXPIRY SWEEPER
+#Seconds between background deletions of expired rows. 0 disables sweeping that table.
+SWEEP_CHALLENGES_INTERVAL = _envInt('SWEEP_CHALLENGES_INTERVAL', 60)
+SWEEP_TOKENS_INTERVAL = _envInt('SWEEP_TOKENS_INTERVAL', 300)
+SWEEP_MAILBOX_INTERVAL = _envInt('SWEEP_MAILBOX_INTERVAL', 3600)
+SWEEP_BLOB_UPLOADS_INTERVAL = _envInt('SWEEP_BLOB_UPLOADS_INTERVAL', 3600)
@@ -0,0 +1,190 @@
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+
+import serverConfig
+
+#Leveled logging for the server.
+#Each module logs through its own subsystem logger (getLogger('db') gives 'dmaft.db'), so verbosity can be turned
+#up or down per subsystem with LOG_LEVELS. startLogging() puts a queue between the loggers and the output:
+#whichever thread logs a record only appends it to an in-memory queue, and a single background thread formats and
+#writes it, so a slow terminal or log file never stalls the event loop.
+#
+#Before a record is queued its arguments are copied into a safe form: token secrets and signatures are redacted,
+#payload fields (message data, attachment chunks, profile pictures) are replaced by their size, and any other long
+#string is cut to LOG_MAX_FIELD_CHARS. Taking the copy up front also means a request dict that's changed after it was
+#logged can't change the record waiting in the queue.
+#
+#Per-frame events are logged at DEBUG, and can be sampled on top of that with LOG_SAMPLE_RATES,
+#e.g. 'frames=100' keeps one received frame in a hundred. Check debugSampled() before building the log call.
+
+rootLoggerName = 'dmaft'
+
+#Never written to the log, even at DEBUG.
+secretKeys = {'TokenId', 'TokenSecret', 'Signature', 'ChallengeData'}
+#Written as their size only.
+payloadKeys = {'MessageData', 'ChunkData', 'ProfilePic', 'UserProfilePic', 'Message'}
+
+#Nested containers deeper than this are summarized instead of copied.
+_maxDepth = 4
+#Longest list or dict copied into a record; the rest is summarized.
+_maxItems = 20
+
+_listener = None
+_sampleCounters = {}
+
+
+def getLogger(subsystem: str):
+    return logging.getLogger(rootLoggerName + '.' + subsystem)
+
+
+def _parseList(value: str):
+    pairs = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        name, setting = item.split('=', 1)
+        pairs[name.strip()] = setting.strip()
+    return pairs
+
+
+def _parseSampleRates(value: str):
+    rates = {}
+    for name, rate in _parseList(value).items():
+        try:
+            rates[name] = max(1, int(rate))
+        except ValueError:
+            raise ValueError("serverLog: LOG_SAMPLE_RATES entries must look like name=N, got " + repr(name + '=' + rate))
+    return rates
+
+
+_sampleRates = _parseSampleRates(serverConfig.LOG_SAMPLE_RATES)
+
+
+#Returns True for one call in every N for the named event, where N comes from LOG_SAMPLE_RATES (1 if not listed).
+#Cheap enough to call for every frame; next() on an itertools.count is atomic, so it's safe from any thread.
+def sampled(event: str):
+    rate = _sampleRates.get(event, 1)
+    if rate == 1:
+        return True
+    counter = _sampleCounters.get(event)
+    if counter is None:
+        counter = _sampleCounters.setdefault(event, itertools.count())
+    return next(counter) % rate == 0
+
+
+#For per-frame DEBUG events: True if the logger would write DEBUG records and this occurrence is sampled.
+#The level is checked first, so with DEBUG off the sample counters aren't touched at all.
+def debugSampled(logger: logging.Logger, event: str):
+    return logger.isEnabledFor(logging.DEBUG) and sampled(event)
+
+
+def _describeSize(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '<' + str(len(value)) + ' bytes>'
+    if isinstance(value, str):
+        return '<' + str(len(value)) + ' chars>'
+    return '<' + type(value).__name__ + '>'
+
+
+#Returns a copy of value that is safe to keep in a queued record and short enough to print.
+def redact(value, depth: int = 0):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    maxChars = serverConfig.LOG_MAX_FIELD_CHARS
+    if isinstance(value, str):
+        if len(value) <= maxChars:
+            return value
+        return value[:maxChars] + '...<' + str(len(value)) + ' chars>'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _describeSize(value)
+    if depth >= _maxDepth:
+        return '<' + type(value).__name__ + '>'
+
+    if isinstance(value, dict):
+        copy = {}
+        for key, item in itertools.islice(value.items(), _maxItems):
+            if key in secretKeys:
+                copy[key] = '<redacted>'
+            elif key in payloadKeys and item is not None:
+                copy[key] = _describeSize(item)
+            else:
+                copy[key] = redact(item, depth + 1)
+        if len(value) > _maxItems:
+            copy['...'] = str(len(value) - _maxItems) + ' more keys'
+        return copy
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        copy = [redact(item, depth + 1) for item in itertools.islice(value, _maxItems)]
+        if len(value) > _maxItems:
+            copy.append('...' + str(len(value) - _maxItems) + ' more items')
+        return copy
+
+    #Anything else (sockets, exceptions, ...) is turned into text now, while it still describes the moment it was logged.
+    return redact(str(value), depth)
+
+
+#Runs on the logging thread, before the record is queued.
+class RedactingFilter(logging.Filter):
+    def filter(self, record):
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = redact(record.args)
+            else:
+                record.args = tuple(redact(arg) for arg in record.args)
+        if not isinstance(record.msg, str):
+            record.msg = redact(record.msg)
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    #The stock prepare() formats the message on the logging thread. The filter has already made the arguments safe to
+    #keep, so formatting (and traceback rendering) is left to the listener thread instead.
+    def prepare(self, record):
+        return record
+
+
+def _applyLevels():
+    logging.getLogger(rootLoggerName).setLevel(serverConfig.LOG_LEVEL.upper())
+    for subsystem, level in _parseList(serverConfig.LOG_LEVELS).items():
+        getLogger(subsystem).setLevel(level.upper())
+
+
+#Routes every subsystem logger through the queue and starts the thread that writes records out.
+#Call once at startup; stopLogging() flushes whatever is still queued.
+#label, if given, goes on every line, e.g. to tell worker processes apart.
+def startLogging(stream = None, label: str = None):
+    global _listener
+    if _listener is not None:
+        return
+
+    _applyLevels()
+    output = logging.StreamHandler(sys.stderr if stream is None else stream)
+    prefix = '%(asctime)s %(levelname)s ' + ('' if label is None else '[' + label.replace('%', '%%') + '] ')
+    output.setFormatter(logging.Formatter(prefix + '%(name)s: %(message)s'))
+
+    recordQueue = queue.SimpleQueue()
+    queueHandler = _QueueHandler(recordQueue)
+    queueHandler.addFilter(RedactingFilter())
+
+    rootLogger = logging.getLogger(rootLoggerName)
+    rootLogger.addHandler(queueHandler)
+    rootLogger.propagate = False
+
+    _listener = logging.handlers.QueueListener(recordQueue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stopLogging():
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    rootLogger = logging.getLogger(rootLoggerName)
+    for handler in list(rootLogger.handlers):
+        if isinstance(handler, _QueueHandler):
+            rootLogger.removeHandler(handler)
+    rootLogger.propagate = True
+    _listener = None
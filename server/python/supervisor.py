@@ -0,0 +1,116 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import serverConfig
+import serverLog
+
+#Runs the server as several worker processes that all accept connections on SERVER_PORT.
+#Each worker is a complete server (its own event loop, request threads and database pool); the kernel spreads new
+#connections across them with SO_REUSEPORT, so TLS, JSON and SQLite work uses every core instead of one.
+#Workers forward messages for users connected to another worker over Unix sockets (see peerLink.py).
+#
+#The supervisor itself only starts the workers, restarts any that exit, and stops them all on SIGINT or SIGTERM.
+
+log = serverLog.getLogger('supervisor')
+
+#Seconds to wait before restarting a worker that exited, doubling (up to the maximum) while it keeps failing quickly.
+_restartDelay = 1
+_maxRestartDelay = 30
+#A worker that ran at least this many seconds is considered to have been healthy.
+_healthyUptime = 60
+#Seconds a worker gets to shut down after SIGTERM before it's killed.
+_stopTimeout = 10
+
+
+#Entry point of each worker process.
+def _runWorker(workerID: int, workerCount: int, peerDir: str):
+    import tlsServer
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C reaches the whole process group; let the supervisor do the stopping.
+    try:
+        asyncio.run(tlsServer.main(workerID=workerID, workerCount=workerCount, peerDir=peerDir))
+    except asyncio.CancelledError:
+        pass
+
+
+class _Worker:
+    def __init__(self, workerID: int):
+        self.workerID = workerID
+        self.process = None
+        self.startedAt = 0
+        self.restartDelay = _restartDelay
+        self.restartAt = 0
+
+
+#Starts workerCount workers and supervises them until SIGINT or SIGTERM.
+def runSupervisor(workerCount: int):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("supervisor.runSupervisor(): Multiple workers need SO_REUSEPORT, which this platform doesn't have. Set SERVER_WORKERS to 1.")
+    if workerCount < 2:
+        raise ValueError("supervisor.runSupervisor(): Use tlsServer.main() directly for a single process.")
+    if serverConfig.DB_BACKEND == 'memory':
+        raise ValueError("supervisor.runSupervisor(): Workers can't share the memory backend's database. Use the sqlite or sharded backend.")
+
+    serverLog.startLogging(label='supervisor')
+    ownsPeerDir = serverConfig.PEER_SOCKET_DIR == ''
+    peerDir = tempfile.mkdtemp(prefix='dmaft-peers-') if ownsPeerDir else serverConfig.PEER_SOCKET_DIR
+    os.makedirs(peerDir, mode=0o700, exist_ok=True)
+    #The workers' sockets accept forwarded messages, so only this user may reach them.
+    os.chmod(peerDir, 0o700)
+
+    #Workers are started fresh rather than forked from a process that already has threads running.
+    context = multiprocessing.get_context('spawn')
+    stopping = []
+
+    def requestStop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGINT, requestStop)
+    signal.signal(signal.SIGTERM, requestStop)
+
+    workers = [_Worker(workerID) for workerID in range(workerCount)]
+
+    def startWorker(worker: _Worker):
+        worker.process = context.Process(target=_runWorker, args=(worker.workerID, workerCount, peerDir), name='dmaft-worker-' + str(worker.workerID))
+        worker.process.start()
+        worker.startedAt = time.monotonic()
+        log.info("Started worker %d (pid %d)", worker.workerID, worker.process.pid)
+
+    log.info("Serving port %d with %d workers; peer sockets in %s", serverConfig.SERVER_PORT, workerCount, peerDir)
+    try:
+        for worker in workers:
+            startWorker(worker)
+
+        while not stopping:
+            now = time.monotonic()
+            for worker in workers:
+                if worker.process is not None and not worker.process.is_alive():
+                    uptime = now - worker.startedAt
+                    worker.restartDelay = _restartDelay if uptime >= _healthyUptime else min(_maxRestartDelay, worker.restartDelay * 2)
+                    log.error("Worker %d exited with code %s after %.0fs; restarting in %ds", worker.workerID, worker.process.exitcode, uptime, worker.restartDelay)
+                    worker.process.close()
+                    worker.process = None
+                    worker.restartAt = now + worker.restartDelay
+                elif worker.process is None and now >= worker.restartAt:
+                    startWorker(worker)
+            time.sleep(0.5)
+
+        log.info("Stopping %d workers", workerCount)
+    finally:
+        running = [worker.process for worker in workers if worker.process is not None and worker.process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + _stopTimeout
+        for process in running:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.warning("Worker %s didn't stop in time; killing it", process.name)
+                process.kill()
+                process.join()
+        if ownsPeerDir:
+            shutil.rmtree(peerDir, ignore_errors=True)
+        serverLog.stopLogging()
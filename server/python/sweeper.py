@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import blobStore
+import dmaftServerDB
+import serverConfig
+import serverLog
+import workers
+
+#Background deletion of expired challenges, tokens and mailbox items.
+#Request handlers never prune; they filter expired rows out when reading instead,
+#so the sweeper only has to keep the tables from growing and can run on its own schedule.
+
+#Unfinished attachment uploads are swept on their own schedule too, under this name.
+blobUploadsJob = 'blobUploads'
+
+#Rows (or partial uploads) purged per table since the server started.
+purgedTotals = {tableName: 0 for tableName in dmaftServerDB.expiringTables}
+purgedTotals[blobUploadsJob] = 0
+
+log = serverLog.getLogger('sweeper')
+
+
+def getDefaultIntervals():
+    return {
+        'tblChallenges':serverConfig.SWEEP_CHALLENGES_INTERVAL,
+        'tblTokens':serverConfig.SWEEP_TOKENS_INTERVAL,
+        'tblMailbox':serverConfig.SWEEP_MAILBOX_INTERVAL,
+        blobUploadsJob:serverConfig.SWEEP_BLOB_UPLOADS_INTERVAL,
+    }
+
+
+#Deletes the expired rows from one table (or the stale partial uploads, for blobUploadsJob).
+#Returns the number of rows purged.
+def sweepTable(tableName: str):
+    if tableName == blobUploadsJob:
+        purged = blobStore.purgeStaleUploads()
+    else:
+        with dmaftServerDB.borrowDB() as dbConn:
+            purged = dmaftServerDB.deleteExpiredRows(connection=dbConn, tableName=tableName)
+    purgedTotals[tableName] += purged
+    return purged
+
+
+#Sweeps every table once, right away. Returns {tableName: rowsPurged}.
+def sweepAll():
+    results = {}
+    for tableName in dmaftServerDB.expiringTables + [blobUploadsJob]:
+        results[tableName] = sweepTable(tableName)
+    return results
+
+
+#Runs until cancelled, sweeping each table every intervals[tableName] seconds (the first sweep happens at startup).
+#Tables with an interval of 0 or less are skipped.
+async def runSweeper(*, intervals: dict = None):
+    if intervals is None:
+        intervals = getDefaultIntervals()
+    intervals = {tableName: interval for tableName, interval in intervals.items() if interval > 0}
+    if len(intervals) == 0:
+        log.info("runSweeper(): All sweep intervals are disabled; not sweeping.")
+        return
+
+    nextRun = {tableName: time.monotonic() for tableName in intervals}
+    while True:
+        tableName = min(nextRun, key=nextRun.get)
+        delay = nextRun[tableName] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        try:
+            purged = await workers.runBlocking(sweepTable, tableName)
+            if purged > 0:
+                log.info("runSweeper(): Purged %d expired rows from %s (%d since startup)", purged, tableName, purgedTotals[tableName])
+        except Exception as e:
+            log.error("runSweeper(): Failed to sweep %s: %s", tableName, e)
+        nextRun[tableName] = time.monotonic() + intervals[tableName]
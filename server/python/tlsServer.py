@@ -1,5 +1,6 @@
 import asyncio
 import base64
+import binascii
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
@@ -8,21 +9,32 @@ import hashlib
 import json
 import time
 import random
+import uuid
+import signal
 import socket
 import ssl
-import traceback
 import websockets
 import websockets.asyncio
 import websockets.asyncio.server
 
+import blobStore
 import clients
+import clusterLink
+import codec
 import dmaftServerDB
 import handleAuth
+import metrics
+import peerLink
+import serverConfig
+import serverLog
+import supervisor
+import sweeper
+import workers
 
 ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
 
-ssl_cert = 'keys/peregrine-tls_cert.pem'
-ssl_key = 'keys/peregrine-tls_key.pem'
+ssl_cert = serverConfig.TLS_CERT
+ssl_key = serverConfig.TLS_KEY
 
 # Nigel's path
 # ssl_cert = '/Users/Shared/Keys/DMAFT/dmaft-tls_cert.pem'
@@ -40,6 +52,16 @@ ssl_context.load_cert_chain(ssl_cert, keyfile=ssl_key)
 
 connectedClients = clients.ConnectionList()
 
+log = serverLog.getLogger('server')
+
+#Commands get their own metric labels; anything else is counted as OTHER so clients can't create new label values.
+knownCommands = ['PING', 'CONNECT', 'AUTHENTICATE', 'SEARCHUSERS', 'NEWCONVERSATION', 'SENDMESSAGE', 'UPDATEPROFILE',
+                 'LEAVECONVERSATION', 'GETPROFILES', 'UPLOADBLOB', 'DOWNLOADBLOB', 'METRICS']
+requestSeconds = metrics.histogram('dmaft_request_seconds', 'Time to handle each client command, including any wait for a worker thread.', ('command',))
+requestErrors = metrics.counter('dmaft_request_errors_total', 'Error replies sent to clients, by command and error type.', ('command', 'error'))
+
+adminUserIDs = {userID.strip().upper() for userID in serverConfig.ADMIN_USER_IDS.split(',') if userID.strip() != ''}
+
 
 def getRSAPublicKeySHA512(pubkey: rsa.RSAPublicKey):
     pubBytes = pubkey.public_bytes(encoding=serialization.Encoding.DER, format=serialization.PublicFormat.SubjectPublicKeyInfo)
@@ -47,44 +69,248 @@ def getRSAPublicKeySHA512(pubkey: rsa.RSAPublicKey):
     return sha512Thumbprint
 
 
+#Users whose mailbox is currently being drained, so two sockets authenticating at once don't both send it.
+#Only touched on the event loop thread.
+drainingUsers = set()
+
+def readMailboxPage(userID: str, afterRowID: int):
+    with dmaftServerDB.borrowDB() as dbConn:
+        return dmaftServerDB.getMailboxPage(
+            connection=dbConn,
+            userID=userID,
+            afterRowID=afterRowID,
+            maxRows=serverConfig.MAILBOX_PAGE_ROWS,
+            maxBytes=serverConfig.MAILBOX_PAGE_BYTES,
+            )
+
+def deleteMailboxRows(rowIDs: list[int]):
+    with dmaftServerDB.borrowDB() as dbConn:
+        return dmaftServerDB.deleteMsgsFromMailbox(connection=dbConn, rowIDs=rowIDs)
+
+#Identifies this process's claims on the mailboxes it drains (see dmaftServerDB.claimMailboxDrain).
+drainOwner = uuid.uuid4().hex
+
+def claimMailbox(userID: str):
+    with dmaftServerDB.borrowDB() as dbConn:
+        return dmaftServerDB.claimMailboxDrain(connection=dbConn, userID=userID, owner=drainOwner, leaseSeconds=serverConfig.MAILBOX_DRAIN_LEASE)
+
+def releaseMailbox(userID: str):
+    with dmaftServerDB.borrowDB() as dbConn:
+        return dmaftServerDB.releaseMailboxDrain(connection=dbConn, userID=userID, owner=drainOwner)
+
 #Send out delayed messages given a connected client's ID.
 #This ONLY works if the user is online and associated with an active websocket.
-def sendOldMessages(userID: str):
+#The mailbox is read a bounded page at a time in arrival order, and each message is awaited on the user's sockets
+#(so a slow connection slows the drain down rather than piling messages up in memory).
+#Only the rows that were actually sent are deleted; if the user drops off midway, the rest stay queued for next time.
+#When the server runs as several processes the user may be connected to more than one, so a mailbox with anything in it
+#is claimed in the database first: only the claim's holder drains it, sending to the user's sockets in every process.
+#The claim is renewed for every page and given up at the end.
+#Must run on the event loop; use connectedClients.schedule() from worker threads.
+async def sendOldMessages(userID: str):
     global connectedClients
     if not connectedClients.isUserConnected(userID):
-        print("User is offline, aborting...")
+        log.debug("sendOldMessages(): User %s is offline, not draining their mailbox.", userID)
         return False
 
-    dbConn = dmaftServerDB.startDB()
+    userKey = userID.upper()
+    if userKey in drainingUsers:
+        return True
+    drainingUsers.add(userKey)
+
+    claimed = False
     try:
-        if not dmaftServerDB.doesUserExist(connection=dbConn, userID=userID):
-            print("tlsServer.sendOldMessages(): User", userID, "does not exist!")
+        #Most drains find nothing (every token PING starts one), and those don't need a claim.
+        page = await workers.runBlocking(readMailboxPage, userID, 0)
+        if page is None:
+            log.error("sendOldMessages(): Failed to read the mailbox for user %s.", userID)
             return False
-    except:
-        print("tlsServer.sendOldMessages(): Failed to validate the given user ID!")
-        return False
-    
-    oldMessages = dmaftServerDB.getMsgsForUser(connection=dbConn, userID=userID)
-    if oldMessages is None:
-        print("tlsServer.sendOldMessages(): Failed to get a list of old messages for user", userID, "!")
-        return False
-    
-    if len(oldMessages) == 0:
-        print("tlsServer.sendOldMessages(): Found no new messages for user", userID, "stopping...")
-        return True
-    
-    for message in oldMessages:
-        print("Old message found:", message)
-        msgData = message[5] #the zeroth index is the row ID in the internal database. First real column starts at index 1.
-        print("Attempting to send message", msgData, "to user",userID)
-        connectedClients.sendMsgToUser(userID, msgData)
-
-    dmaftServerDB.deleteAllMsgsForUser(connection=dbConn, userID=userID)
-    dmaftServerDB.closeDB(dbConn)
-    return True
+        if len(page) == 0:
+            return True
+
+        afterRowID = 0
+        while True:
+            claimed = await workers.runBlocking(claimMailbox, userID)
+            if claimed is None:
+                log.error("sendOldMessages(): Failed to claim the mailbox for user %s.", userID)
+                return False
+            if not claimed:
+                log.debug("sendOldMessages(): Another worker is draining the mailbox for user %s.", userID)
+                return True
+
+            #Read again under the claim: the rows read before it may have been sent by the claim's last holder since.
+            page = await workers.runBlocking(readMailboxPage, userID, afterRowID)
+            if page is None:
+                log.error("sendOldMessages(): Failed to read the mailbox for user %s.", userID)
+                return False
+
+            if len(page) == 0:
+                return True
+
+            flushedRowIDs = []
+            stillConnected = True
+            for message in page:
+                msgData = message[5] #the zeroth index is the row ID in the internal database. First real column starts at index 1.
+                mailbox = {'ConversationId':message[1], 'ExpireTime':message[3]}
+                if not await connectedClients.deliverToUserEverywhere(userID, msgData, mailbox):
+                    stillConnected = False
+                    break
+                flushedRowIDs.append(message[0])
+
+            if len(flushedRowIDs) > 0:
+                await workers.runBlocking(deleteMailboxRows, flushedRowIDs)
+
+            if not stillConnected:
+                log.info("sendOldMessages(): User %s disconnected mid-drain; leaving the remaining messages queued.", userID)
+                return False
+            afterRowID = page[-1][0]
+    finally:
+        drainingUsers.discard(userKey)
+        if claimed:
+            try:
+                await workers.runBlocking(releaseMailbox, userID)
+            except Exception as e:
+                log.warning("sendOldMessages(): Failed to release the mailbox for user %s; the claim will lapse: %s", userID, e)
         
 
 
+#CLUSTER
+#With CLUSTER_CONFIG set, each user belongs to one node of the cluster (see clusterLink.py): their registration,
+#tokens, profile and mailbox live in that node's database, and their clients talk to that node only.
+#Conversations are copied to every node that owns one of their members, so membership checks stay local.
+#Without a cluster every user is local and these helpers do nothing extra.
+
+#Splits the users into {nodeName: users} for other nodes and a list of this node's own users.
+def splitUsersByNode(userIDs: list[str]):
+    if clusterLink.activeCluster is None:
+        return {}, list(userIDs)
+    return clusterLink.activeCluster.splitByOwner(userIDs)
+
+#Sends each node its request and waits for them all. Returns {nodeName: reply or ClusterError}.
+def callNodes(requests: dict):
+    if len(requests) == 0:
+        return {}
+    return clusterLink.activeCluster.callManyFromThread(requests)
+
+#Returns a WrongNode error if the request names a user that another node of the cluster owns, and None otherwise.
+#Their tokens are only valid on that node, so the client is told where to reconnect instead.
+def getWrongNodeError(clientRequest: dict):
+    cluster = clusterLink.activeCluster
+    userID = clientRequest.get('UserId')
+    if cluster is None or type(userID) != str or userID == '' or cluster.ownsUser(userID):
+        return None
+    error = makeError(clientRequest=cleanAuthData(clientRequest), errorCode='WrongNode', reason='This user is served by another node. Please reconnect to the given URL.')
+    error['NodeUrl'] = cluster.getNodeUrl(cluster.getOwner(userID))
+    return error
+
+#Returns the (UserID, UserName, ProfileVersion) rows for the users, asking the other nodes for theirs.
+#Returns None if any lookup failed.
+def getProfileSummariesAnywhere(userIDs: list[str]):
+    remote, localIDs = splitUsersByNode(userIDs)
+    summaries = []
+    if len(localIDs) > 0:
+        with dmaftServerDB.borrowDB() as dbConn:
+            summaries = dmaftServerDB.getProfileSummaries(connection=dbConn, userIDs=localIDs)
+        if summaries is None:
+            return None
+        summaries = list(summaries)
+    for nodeName, result in callNodes({nodeName: {'Type':'PROFILESUMMARIES', 'Users':users} for nodeName, users in remote.items()}).items():
+        if isinstance(result, Exception):
+            log.error("getProfileSummariesAnywhere(): %s", result)
+            return None
+        summaries += [tuple(row) for row in result]
+    return summaries
+
+#Tells the other nodes that own any of the members about a conversation change, and waits until they've applied it.
+def notifyMemberNodes(request: dict, memberIDs: list[str]):
+    remote, localIDs = splitUsersByNode(memberIDs)
+    for nodeName, result in callNodes({nodeName: request for nodeName in remote}).items():
+        if isinstance(result, Exception):
+            log.error("notifyMemberNodes(): Node %s missed %s for conversation %s: %s", nodeName, request['Type'], request['ConversationId'], result)
+
+#Stores a message in the mailbox of each recipient that missed it.
+#Recipients owned by other nodes are handed to those nodes, which try their own connections first.
+def queueUndelivered(recipientIDs: list[str], conversationID: str, msgDict: dict, expireTime: int):
+    remote, localIDs = splitUsersByNode(recipientIDs)
+    requests = {nodeName: {'Type':'DELIVER', 'Users':users, 'ConversationId':conversationID, 'Message':msgDict, 'ExpireTime':expireTime} for nodeName, users in remote.items()}
+    for nodeName, result in callNodes(requests).items():
+        if isinstance(result, Exception):
+            log.error("queueUndelivered(): Lost a message for %d users on node %s: %s", len(requests[nodeName]['Users']), nodeName, result)
+    if len(localIDs) > 0:
+        with dmaftServerDB.borrowDB() as dbConn:
+            dmaftServerDB.addToMailboxBatch(connection=dbConn, conversationID=conversationID, recipientIDs=localIDs, msgDict=msgDict, expireTime=expireTime)
+
+#connectedClients.onUndelivered: a broadcast frame was queued for these users but every one of their sockets dropped it
+#(closed, or disconnected as a slow reader) before sending it. Runs on the event loop, so the mailbox write goes to a worker.
+def queueDropped(userIDs: list[str], msgDict: dict, mailbox: dict):
+    async def store():
+        try:
+            await workers.runBlocking(queueUndelivered, userIDs, mailbox['ConversationId'], msgDict, mailbox['ExpireTime'])
+        except Exception as e:
+            log.error("queueDropped(): Lost a message for %d users: %s", len(userIDs), e)
+    connectedClients.schedule(store())
+
+connectedClients.onUndelivered = queueDropped
+
+
+#Requests from the other nodes. Each runs on the cluster's own threads and only involves users this node owns.
+def handleClusterDeliver(request: dict):
+    #Only the sender's node checked and recorded the attachment, so its members here need the access row before they get the message.
+    blobRef = request['Message'].get('BlobRef') if type(request['Message']) == dict else None
+    if type(blobRef) == dict:
+        with dmaftServerDB.borrowDB() as dbConn:
+            if not dmaftServerDB.addBlobToConversation(connection=dbConn, sha256=blobRef['Sha256'], conversationID=request['ConversationId']):
+                raise RuntimeError("tlsServer.handleClusterDeliver(): Failed to share the attachment with the conversation.")
+    remainingUsers = connectedClients.broadcastToUsers(request['Users'], request['Message'], mailbox={'ConversationId':request['ConversationId'], 'ExpireTime':request['ExpireTime']})
+    if len(remainingUsers) > 0:
+        with dmaftServerDB.borrowDB() as dbConn:
+            dmaftServerDB.addToMailboxBatch(connection=dbConn, conversationID=request['ConversationId'], recipientIDs=remainingUsers, msgDict=request['Message'], expireTime=request['ExpireTime'])
+    return len(request['Users']) - len(remainingUsers)
+
+def handleClusterProfileSummaries(request: dict):
+    with dmaftServerDB.borrowDB() as dbConn:
+        summaries = dmaftServerDB.getProfileSummaries(connection=dbConn, userIDs=request['Users'])
+    if summaries is None:
+        raise RuntimeError("tlsServer.handleClusterProfileSummaries(): Failed to read the profile summaries.")
+    return [list(row) for row in summaries]
+
+def handleClusterConversationCreated(request: dict):
+    with dmaftServerDB.borrowDB() as dbConn:
+        dmaftServerDB.storeConversation(connection=dbConn, conversationID=request['ConversationId'], userIDs=request['Members'])
+    connectedClients.addTopic(request['ConversationId'], request['Members'])
+    return True
+
+def handleClusterConversationLeft(request: dict):
+    with dmaftServerDB.borrowDB() as dbConn:
+        remainingUsers = dmaftServerDB.removeUserFromConversation(connection=dbConn, conversationID=request['ConversationId'], userID=request['UserId'])
+    if remainingUsers is None:
+        raise RuntimeError("tlsServer.handleClusterConversationLeft(): Failed to remove the user from the conversation.")
+    connectedClients.removeTopicMember(request['ConversationId'], request['UserId'])
+    return True
+
+def handleClusterGetProfiles(request: dict):
+    found = lookUpProfiles(request['Users'])
+    if found is None:
+        raise RuntimeError("tlsServer.handleClusterGetProfiles(): Failed to look up the profiles.")
+    return found
+
+def handleClusterSearchUsers(request: dict):
+    try:
+        results, nextCursor = searchUsersLocally(request['SearchBy'], request['SearchTerm'], request['Limit'], request['Cursor'])
+    except ValueError:
+        return {'BadCursor':True}
+    return {'Results':results, 'NextCursor':nextCursor}
+
+clusterHandlers = {
+    'DELIVER':handleClusterDeliver,
+    'PROFILESUMMARIES':handleClusterProfileSummaries,
+    'CONVERSATIONCREATED':handleClusterConversationCreated,
+    'CONVERSATIONLEFT':handleClusterConversationLeft,
+    'GETPROFILES':handleClusterGetProfiles,
+    'SEARCHUSERS':handleClusterSearchUsers,
+}
+
+
 #Message handlers
 def handlePingMsg(clientRequest: dict, websocket: websockets.asyncio.server.ServerConnection):
     global connectedClients
@@ -104,11 +330,13 @@ def handlePingMsg(clientRequest: dict, websocket: websockets.asyncio.server.Serv
             result = handleAuth.validateClientToken(clientRequest)
             authSuccessful = not ('ErrorType' in result.keys())
             if authSuccessful:
-                connectedClients.setUserOnSocket(websocket, result['UserId'])
+                #Subscribe the socket to all of the user's conversations so messages to them are routed without the database.
+                with dmaftServerDB.borrowDB() as dbConn:
+                    conversations = dmaftServerDB.getConversationMembersForUser(connection=dbConn, userID=result['UserId'])
+                connectedClients.setUserOnSocket(websocket, result['UserId'], conversations)
                 #Deliver all old messages too
-                print("User ", result['UserId'], "successfully ping authed; attempting to send old messages...")
-                sendOldMessages(result['UserId'])
-                print("Old messages for", result['UserId'], "should now be sent!")
+                log.info("User %s successfully ping authed; draining their mailbox.", result['UserId'])
+                connectedClients.schedule(sendOldMessages(result['UserId']))
 
 
     clientRequest['Successful'] = True
@@ -118,6 +346,99 @@ def handlePingMsg(clientRequest: dict, websocket: websockets.asyncio.server.Serv
     return clientRequest
 
 
+#Answers a token PING on a socket that is already bound to that user (a keep-alive) without a worker thread, if the
+#token is in the cache: the socket's subscriptions are already live, so only the token needs checking.
+#Returns the reply, or None if the request has to go through handlePingMsg on a worker thread.
+def handleBoundPing(clientRequest: dict, websocket: websockets.asyncio.server.ServerConnection):
+    authKeys = ['TokenId', 'TokenSecret', 'UserId']
+    if type(clientRequest) != dict or str(clientRequest.get('Command')).upper() != 'PING' or any(type(clientRequest.get(key)) != str for key in authKeys):
+        return None
+    client = connectedClients.getClientFromSocket(websocket)
+    if len(client) == 0 or str(client[0]['UserId']).upper() != clientRequest['UserId'].upper():
+        return None
+    try:
+        tokenSecret = base64.b64decode(clientRequest['TokenSecret'])
+    except (binascii.Error, ValueError):
+        return None
+    cacheHit, authorizedUser = dmaftServerDB.validateCachedToken(tokenID=clientRequest['TokenId'], tokenSecret=tokenSecret)
+    if not cacheHit or str(authorizedUser).upper() != clientRequest['UserId'].upper():
+        return None #Errors are left to validateClientToken.
+    connectedClients.schedule(sendOldMessages(clientRequest['UserId']))
+    clientRequest = cleanAuthData(clientRequest)
+    clientRequest['Successful'] = True
+    clientRequest['ServerTimestamp'] = time.time()
+    clientRequest['AuthSuccessful'] = True
+    return clientRequest
+
+
+#Searches this node's users. Returns (list of {'UserId', 'UserName'}, next cursor or None).
+#Raises ValueError if the cursor is invalid, and RuntimeError if the database couldn't be searched.
+def searchUsersLocally(searchBy: str, searchTerm: str, limit: int, cursor: str):
+    nextCursor = None
+    with dmaftServerDB.borrowDB() as dbConn:
+        if searchBy == 'USERNAME':
+            page = dmaftServerDB.searchUsersByNamePage(connection=dbConn, userName=searchTerm, limit=limit, cursor=cursor)
+            if page is None:
+                raise RuntimeError("tlsServer.searchUsersLocally(): The search failed.")
+            results, nextCursor = page
+        else:
+            results = dmaftServerDB.searchUserByID(connection=dbConn, userID=searchTerm)
+            if results is None:
+                raise RuntimeError("tlsServer.searchUsersLocally(): The search failed.")
+
+    userlist = []
+    try:
+        for record in results:
+            userlist.append({'UserId':record[0], 'UserName':record[1]})
+    except:
+        pass
+    return userlist, nextCursor
+
+
+def searchUsersOnNode(nodeName: str, searchBy: str, searchTerm: str, limit: int, cursor: str):
+    if nodeName == clusterLink.activeCluster.nodeName:
+        return searchUsersLocally(searchBy, searchTerm, limit, cursor)
+    reply = clusterLink.activeCluster.callFromThread(nodeName, {'Type':'SEARCHUSERS', 'SearchBy':searchBy, 'SearchTerm':searchTerm, 'Limit':limit, 'Cursor':cursor})
+    if reply.get('BadCursor'):
+        raise ValueError("tlsServer.searchUsersOnNode(): Node " + nodeName + " rejected the cursor.")
+    return reply['Results'], reply['NextCursor']
+
+
+#Name searches in a cluster go through the nodes one after another, in name order, filling each page from as many
+#nodes as it takes. The cursor holds the node the search got up to and that node's own cursor.
+def searchUsersAcrossNodes(searchTerm: str, limit: int, cursor: str):
+    cluster = clusterLink.activeCluster
+    nodeNames = sorted(cluster.config.nodes.keys())
+    if limit is None or limit > serverConfig.SEARCH_MAX_LIMIT:
+        limit = serverConfig.SEARCH_MAX_LIMIT if limit is not None else serverConfig.SEARCH_DEFAULT_LIMIT
+    remaining = max(1, limit)
+
+    nodeIndex, nodeCursor = 0, None
+    if cursor not in [None, '']:
+        try:
+            nodeIndex, nodeCursor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            nodeIndex = int(nodeIndex)
+        except Exception as e:
+            raise ValueError("tlsServer.searchUsersAcrossNodes(): Invalid cursor.") from e
+        if nodeIndex < 0 or nodeIndex >= len(nodeNames):
+            raise ValueError("tlsServer.searchUsersAcrossNodes(): Invalid cursor.")
+
+    userlist = []
+    while nodeIndex < len(nodeNames):
+        results, nodeCursor = searchUsersOnNode(nodeNames[nodeIndex], 'USERNAME', searchTerm, remaining, nodeCursor)
+        userlist += results
+        remaining -= len(results)
+        if nodeCursor is not None:
+            break
+        nodeIndex += 1
+        if remaining <= 0:
+            break
+
+    if nodeIndex >= len(nodeNames):
+        return userlist, None
+    return userlist, base64.urlsafe_b64encode(json.dumps([nodeIndex, nodeCursor]).encode('utf-8')).decode('ascii')
+
+
 #IMPORTANT: These methods assume the client is already authenticated!
 #Handle a request to search the list of users.
 #To preserve user privacy, only UserIDs and UserNames are returned by the database.
@@ -140,30 +461,35 @@ def handleSearchUsersMsg(clientRequest: dict):
     if not clientRequest['SearchBy'].upper() in ['USERID', 'USERNAME']:
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Invalid SearchBy key; must specify UserId or UserName.')
 
+    #Optional paging keys for name searches.
+    pagingChecks = [
+        type(clientRequest.get('Limit', 0)) == int,
+        type(clientRequest.get('Cursor', '')) in [str, type(None)],
+        len(clientRequest['SearchTerm']) <= serverConfig.USERNAME_MAX_LENGTH,
+    ]
+
+    if False in pagingChecks:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Limit must be an integer, Cursor must be a string from a previous search, and SearchTerm can be at most ' + str(serverConfig.USERNAME_MAX_LENGTH) + ' characters.')
+
     #Search the list of users and return the results.
-    dbConn = dmaftServerDB.startDB()
+    searchBy = clientRequest['SearchBy'].upper()
     try:
-        if clientRequest['SearchBy'].upper() == 'USERNAME':
-            results = dmaftServerDB.searchUsersByName(connection=dbConn, userName=clientRequest['SearchTerm'])
+        if clusterLink.activeCluster is None:
+            userlist, nextCursor = searchUsersLocally(searchBy, clientRequest['SearchTerm'], clientRequest.get('Limit'), clientRequest.get('Cursor'))
+        elif searchBy == 'USERNAME':
+            userlist, nextCursor = searchUsersAcrossNodes(clientRequest['SearchTerm'], clientRequest.get('Limit'), clientRequest.get('Cursor'))
         else:
-            results = dmaftServerDB.searchUserByID(connection=dbConn, userID=clientRequest['SearchTerm'])
+            userlist, nextCursor = searchUsersOnNode(clusterLink.activeCluster.getOwner(clientRequest['SearchTerm']), searchBy, clientRequest['SearchTerm'], None, None)
+    except ValueError:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='The Cursor is invalid. Start the search again without one.')
     except Exception as e:
-        print("Exception when trying to search:\n", e, '\n')
-        print(traceback.format_exc())
+        log.exception("handleSearchUsersMsg(): Exception when trying to search.")
         return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='Failed to execute the requested search. Please try again.')
-    finally:
-        dbConn.close()
-
-    userlist = []
-    try:
-        for record in results:
-            userlist.append({'UserId':record[0], 'UserName':record[1]})
-    except:
-        pass
 
     clientRequest['Successful'] = True
     clientRequest['ServerTimestamp'] = int(time.time())
     clientRequest['Results'] = userlist
+    clientRequest['NextCursor'] = nextCursor
     return clientRequest
 
 
@@ -173,7 +499,6 @@ def handleNewConvoRequest(clientRequest: dict):
     if not expectedKeys.issubset(keys):
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One or more required JSON keys are missing from the request.')
 
-    print("Type of key RecipientIds is:", type(clientRequest['RecipientIds']))
     sanityChecks = [
         type(clientRequest['Command']) == str,
         type(clientRequest['UserId']) == str,
@@ -185,7 +510,7 @@ def handleNewConvoRequest(clientRequest: dict):
     #Parse the recipient list and ensure that each recipient is a valid UserID.
     #Remove all duplicates too.
     recipients = clientRequest['RecipientIds']
-    print("Trying to create a new conversation with recipients:", recipients)
+    log.debug("handleNewConvoRequest(): Creating a conversation with recipients %s", recipients)
     if type(recipients) != list:
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='The Recipient key must specify a list of UserID strings to add to the conversation.')
 
@@ -203,42 +528,46 @@ def handleNewConvoRequest(clientRequest: dict):
         return makeError(clientRequest=clientRequest, errorCode='NoRecipientsSpecified', reason='At least one User ID must be specified in the recipient list other than yours!')
 
     #We have at least one recipient.
-    #Validate them all before continuing.
-    dbConn = dmaftServerDB.startDB()
-    try:
-        for recipient in recipients:
-            if not dmaftServerDB.doesUserExist(connection=dbConn, userID=recipient):
-                dmaftServerDB.closeDB(dbConn)
-                return makeError(clientRequest=clientRequest, errorCode='InvalidRecipientId', reason='Recipient ID ' + recipient + ' is not a registered user.')
-    except:
-        dmaftServerDB.closeDB(dbConn)
+    #Validate them all before continuing, fetching the names we'll need for the notification at the same time.
+    summaries = getProfileSummariesAnywhere(recipients + [sender])
+    if summaries is None:
         return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to validate the provided list of recipient IDs. Please try again.')
+    summaries = {row[0].upper(): row for row in summaries}
+    for recipient in recipients:
+        if recipient not in summaries:
+            return makeError(clientRequest=clientRequest, errorCode='InvalidRecipientId', reason='Recipient ID ' + recipient + ' is not a registered user.')
 
     #The provided recipients are valid.
     #Add the sender to the member list and create the conversation.
+    #In a cluster, members registered on other nodes were checked with their nodes above, not in this database.
     recipients.append(sender)
-    try:
-        conversationID = dmaftServerDB.createNewConversation(connection=dbConn, userIDs=recipients)
-        if conversationID is None:
-            dmaftServerDB.closeDB(dbConn)
-            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to create the requested conversation. Please try again.')
-    except:
-        #The only error that this method will throw is a ValueError, and only if one of the recipients doesn't exist.
-        return makeError(clientRequest=clientRequest, errorCode='InvalidRecipientId', reason='The database detected that one of the provided User IDs is invalid.')
+    with dmaftServerDB.borrowDB() as dbConn:
+        try:
+            conversationID = dmaftServerDB.createNewConversation(connection=dbConn, userIDs=recipients, checkUsers=clusterLink.activeCluster is None)
+            if conversationID is None:
+                return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to create the requested conversation. Please try again.')
+        except:
+            #The only error that this method will throw is a ValueError, and only if one of the recipients doesn't exist.
+            return makeError(clientRequest=clientRequest, errorCode='InvalidRecipientId', reason='The database detected that one of the provided User IDs is invalid.')
+
+    #Members' own nodes need the conversation before anything is sent to it.
+    notifyMemberNodes({'Type':'CONVERSATIONCREATED', 'ConversationId':conversationID, 'Members':recipients}, recipients)
 
     #The conversation was successfully created.
-    #Get all profile data before notifying everyone.
+    #Only names and profile versions go out with the notification; clients fetch full profiles (pictures included)
+    #with GETPROFILES, and only for the versions they don't already have.
     recipientsData = []
     for member in recipients:
-        result = dmaftServerDB.searchUserByID(connection=dbConn, userID=member)[0]
-        data = {
+        result = summaries.get(member)
+        if result is None:
+            continue
+        recipientsData.append({
             'UserId':result[0],
             'UserName':result[1],
-            'Status':result[2],
-            'Bio':result[3],
-            'ProfilePic':result[4],
-        }
-        recipientsData.append(data)
+            'ProfileVersion':result[2],
+        })
+
+    connectedClients.addTopic(conversationID, recipients)
 
     #Notify everyone.
     newConversationData = {
@@ -249,16 +578,12 @@ def handleNewConvoRequest(clientRequest: dict):
         'MemberData':recipientsData,
         'ConversationId':conversationID
     }
-    newConversationMsg = json.dumps(newConversationData)
-    print("Recipients that should receive a broadcast message:", recipients)
-    remainingUsers = connectedClients.broadcastToUsers(recipients, newConversationMsg)
-
-    #If any recipients missed the notification, store it in the mailbox to send to them later.
+    #If any recipients miss the notification, store it in the mailbox to send to them later.
     #Mark the conversation as SYSTEM so that we know it isn't a user-sent message.
+    mailbox = {'ConversationId':'SYSTEM', 'ExpireTime':int(time.time()) + 1209600} #Give it two weeks to send out
+    remainingUsers = connectedClients.broadcastToUsers(recipients, newConversationData, mailbox=mailbox)
     if len(remainingUsers) > 0:
-        dbConn = dmaftServerDB.startDB()
-        for user in remainingUsers:
-            dmaftServerDB.addToMailbox(connection=dbConn, conversationID='SYSTEM', recipientID=user, msgDict=newConversationMsg, expireTime=(int(time.time()) + 1209600)) #Give it two weeks to send out
+        queueUndelivered(remainingUsers, mailbox['ConversationId'], newConversationData, mailbox['ExpireTime'])
 
     clientRequest['Successful'] = True
     clientRequest['ServerTimestamp'] = int(time.time())
@@ -284,21 +609,19 @@ def handleLeaveConvoRequest(clientRequest: dict):
 
 
     #Remove the user from the conversation
-    dbConn = dmaftServerDB.startDB()
     try:
-        remainingUsers = dmaftServerDB.removeUserFromConversation(
-            connection=dbConn, 
-            conversationID=clientRequest['ConversationId'],
-            userID=clientRequest['UserId'],
-            )
+        with dmaftServerDB.borrowDB() as dbConn:
+            remainingUsers = dmaftServerDB.removeUserFromConversation(
+                connection=dbConn, 
+                conversationID=clientRequest['ConversationId'],
+                userID=clientRequest['UserId'],
+                )
         if remainingUsers is None:
-            dmaftServerDB.closeDB(dbConn)
             return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to remove the user from the specified conversation.')
     except:
-        dmaftServerDB.closeDB(dbConn)
         return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to remove the user from the specified conversation. The server database may be corrupt.')
-
-    dmaftServerDB.closeDB(dbConn)
+    connectedClients.removeTopicMember(clientRequest['ConversationId'], clientRequest['UserId'])
+    notifyMemberNodes({'Type':'CONVERSATIONLEFT', 'ConversationId':clientRequest['ConversationId'], 'UserId':clientRequest['UserId']}, remainingUsers)
 
     #Now notify everyone else about the change.
     convoChangeData = {
@@ -307,15 +630,12 @@ def handleLeaveConvoRequest(clientRequest: dict):
         'ConversationId':clientRequest['ConversationId'],
         'ServerTimestamp': int(time.time())
     }
-    convoChangeMsg = json.dumps(convoChangeData)
-    offlineUsers = connectedClients.broadcastToUsers(remainingUsers, convoChangeMsg)
-
-    #If any recipients missed the notification, store it in the mailbox to send to them later.
+    #If any recipients miss the notification, store it in the mailbox to send to them later.
     #Mark the conversation as SYSTEM so that we know it isn't a user-sent message.
+    mailbox = {'ConversationId':'SYSTEM', 'ExpireTime':int(time.time()) + 1209600} #Give it two weeks to send out
+    offlineUsers = connectedClients.broadcastToUsers(remainingUsers, convoChangeData, mailbox=mailbox)
     if len(offlineUsers) > 0:
-        dbConn = dmaftServerDB.startDB()
-        for user in offlineUsers:
-            dmaftServerDB.addToMailbox(connection=dbConn, conversationID='SYSTEM', recipientID=user, msgDict=convoChangeMsg, expireTime=(int(time.time()) + 1209600)) #Give it two weeks to send out
+        queueUndelivered(offlineUsers, mailbox['ConversationId'], convoChangeData, mailbox['ExpireTime'])
 
     clientRequest['Successful'] = True
     clientRequest['ServerTimestamp'] = int(time.time())
@@ -342,23 +662,26 @@ def handleSendMessageRequest(clientRequest: dict):
     if clientRequest['MessageType'] not in ['Text', 'Image', 'Video', 'File']:
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Invalid value given for MsgType. Must be one of: Text, Image, Video, File.')
 
-    #Validate the Conversation ID and get the list of recipients
-    dbConn = dmaftServerDB.startDB()
-    sqlResult = dmaftServerDB.getConversationByID(connection = dbConn, conversationID=clientRequest['ConversationId'])
-    dmaftServerDB.closeDB(dbConn)
-
-    if sqlResult is None:
-        return makeError(clientRequest=clientRequest, errorCode='InvalidConversationId', reason='Invalid conversation ID provided in send message request.')
-
-    if len(sqlResult) > 1:
-        return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to validate the conversation ID.')
-
-    conversationID, participantJSON = sqlResult[0]
-    participants = json.loads(participantJSON)
-    if clientRequest['UserId'].upper() in participants:
-        participants.remove(clientRequest['UserId'])
-
-    #Construct and send the message notification
+    #Attachments can be uploaded separately (UPLOADBLOB) and referenced here, so the message itself stays small.
+    if 'BlobRef' in clientRequest:
+        if clientRequest['MessageType'] not in codec.binaryMessageTypes:
+            return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Only Image, Video and File messages can carry a BlobRef.')
+        if not blobStore.isValidBlobRef(clientRequest['BlobRef']):
+            return makeError(clientRequest=clientRequest, errorCode='InvalidBlobRef', reason='The referenced attachment has not been uploaded.')
+        #Only attachments the sender could download themselves can be passed on, so knowing a hash isn't enough.
+        try:
+            with dmaftServerDB.borrowDB() as dbConn:
+                canRead = dmaftServerDB.canUserReadBlob(connection=dbConn, sha256=clientRequest['BlobRef']['Sha256'], userID=clientRequest['UserId'])
+        except RuntimeError as e:
+            log.error("handleSendMessageRequest(): Failed to check access to an attachment: %s", e)
+            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to check the attachment. Please try again.')
+        if not canRead:
+            return makeError(clientRequest=clientRequest, errorCode='PermissionDenied', reason='Only attachments you uploaded or received can be sent.')
+
+    #Image/Video/File data is handled as raw bytes from here on; JSON clients still send and receive it as base64.
+    codec.unpackMessageData(clientRequest)
+
+    #Construct the message notification
     userMsgData = {
         'Command':'INCOMINGMESSAGE',
         'OriginalReceiptTimestamp':int(time.time()),
@@ -368,18 +691,248 @@ def handleSendMessageRequest(clientRequest: dict):
         'MessageData':clientRequest['MessageData'],
         'MessageId':clientRequest['MessageId']
     }
+    if 'BlobRef' in clientRequest:
+        userMsgData['BlobRef'] = blobStore.makeBlobRef(clientRequest['BlobRef']['Sha256'], clientRequest['BlobRef']['Size'])
+
+    #If any member is online the conversation has a live topic with its member list, and the message goes straight to its sockets.
+    #Only otherwise do we need the database to validate the conversation and list the recipients.
+    senderKey = clientRequest['UserId'].upper()
+    members = connectedClients.getTopicMembers(clientRequest['ConversationId'])
+    if members is None:
+        try:
+            with dmaftServerDB.borrowDB() as dbConn:
+                if not dmaftServerDB.doesConversationExist(connection=dbConn, conversationID=clientRequest['ConversationId']):
+                    return makeError(clientRequest=clientRequest, errorCode='InvalidConversationId', reason='Invalid conversation ID provided in send message request.')
+                participants = dmaftServerDB.getConversationMembers(connection=dbConn, conversationID=clientRequest['ConversationId'])
+        except:
+            participants = None
 
-    userMsgJSON = json.dumps(userMsgData)
-    remainingUsers = connectedClients.broadcastToUsers(participants, userMsgJSON)
+        if participants is None:
+            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Failed to validate the conversation ID.')
+        members = set(participants)
+    else:
+        #A topic can miss a change another worker made while the link between them was down, so it only routes the message;
+        #the database decides whether the sender may post.
+        try:
+            with dmaftServerDB.borrowDB() as dbConn:
+                isMember = dmaftServerDB.isUserInConversation(connection=dbConn, conversationID=clientRequest['ConversationId'], userID=senderKey)
+            if isMember:
+                members.add(senderKey)
+            else:
+                members.discard(senderKey)
+        except RuntimeError as e:
+            log.error("handleSendMessageRequest(): Failed to check the sender's membership: %s", e)
+            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to validate the conversation ID. Please try again.')
+
+    if senderKey not in members:
+        return makeError(clientRequest=clientRequest, errorCode='PermissionDenied', reason='You are not a member of this conversation.')
+
+    #The conversation's members may download the attachment from now on.
+    if 'BlobRef' in userMsgData:
+        with dmaftServerDB.borrowDB() as dbConn:
+            recorded = dmaftServerDB.addBlobToConversation(connection=dbConn, sha256=userMsgData['BlobRef']['Sha256'], conversationID=clientRequest['ConversationId'])
+        if not recorded:
+            return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to share the attachment with the conversation. Please try again.')
+
+    #Recipients that miss it are mailboxed, here or (if their socket drops it after it was queued) by queueDropped.
+    mailbox = {'ConversationId':clientRequest['ConversationId'], 'ExpireTime':int(time.time()) + 604800} #Give it one week to send out
+    remainingUsers = connectedClients.broadcastToTopic(clientRequest['ConversationId'], userMsgData, excludeUserID=clientRequest['UserId'], mailbox=mailbox)
+    if remainingUsers is None:
+        members.discard(senderKey)
+        remainingUsers = connectedClients.broadcastToUsers(list(members), userMsgData, mailbox=mailbox)
 
     #If any recipients missed the notification, store it in the mailbox to send to them later.
     if len(remainingUsers) > 0:
-        dbConn = dmaftServerDB.startDB()
-        for user in remainingUsers:
-            dmaftServerDB.addToMailbox(connection=dbConn, conversationID=clientRequest['ConversationId'], recipientID=user, msgDict=userMsgData, expireTime=(int(time.time()) + 604800)) #Give it one week to send out
+        queueUndelivered(remainingUsers, mailbox['ConversationId'], userMsgData, mailbox['ExpireTime'])
+
+    clientRequest['Successful'] = True
+    clientRequest['ServerTimestamp'] = int(time.time())
+    return clientRequest
 
+
+#Returns the full profiles for a batch of users.
+#Users is a list of {'UserId':..., 'ProfileVersion':...}, where ProfileVersion (optional) is the version the client already has;
+#those users come back in Unchanged instead of Profiles if their profile hasn't changed since.
+def handleGetProfilesRequest(clientRequest: dict):
+    keys = set(clientRequest.keys())
+    expectedKeys = {'Command','Users'}
+    if not expectedKeys.issubset(keys):
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One or more required JSON keys are missing from the request.')
+
+    users = clientRequest['Users']
+    if type(users) != list or False in [type(user) == dict and type(user.get('UserId')) == str and type(user.get('ProfileVersion', 0)) == int for user in users]:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Users must be a list of {UserId, ProfileVersion} objects.')
+
+    if len(users) > serverConfig.GETPROFILES_MAX_USERS:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='At most ' + str(serverConfig.GETPROFILES_MAX_USERS) + ' profiles can be requested at once.')
+
+    knownVersions = {user['UserId'].upper(): user.get('ProfileVersion') for user in users}
+    remote, localIDs = splitUsersByNode(list(knownVersions.keys()))
+    found = lookUpProfiles({userID: knownVersions[userID] for userID in localIDs})
+    for nodeName, result in callNodes({nodeName: {'Type':'GETPROFILES', 'Users':{userID: knownVersions[userID] for userID in userIDs}} for nodeName, userIDs in remote.items()}).items():
+        if isinstance(result, Exception):
+            log.error("handleGetProfilesRequest(): %s", result)
+            found = None
+        elif found is not None:
+            for key in found:
+                found[key] += result[key]
+
+    if found is None:
+        return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason='Failed to look up the requested profiles. Please try again.')
+
+    clientRequest['Successful'] = True
+    clientRequest['ServerTimestamp'] = int(time.time())
+    clientRequest.update(found)
+    del clientRequest['Users']
+    return clientRequest
+
+
+#Reads this node's profiles for {upper-cased UserID: ProfileVersion the client has (or None)}.
+#Returns {'Profiles', 'Unchanged', 'Missing'} as GETPROFILES replies with them, or None if the lookup failed.
+def lookUpProfiles(knownVersions: dict):
+    if len(knownVersions) == 0:
+        return {'Profiles':[], 'Unchanged':[], 'Missing':[]}
+    try:
+        with dmaftServerDB.borrowDB() as dbConn:
+            #Check the versions first so unchanged profile pictures are never even read.
+            summaries = dmaftServerDB.getProfileSummaries(connection=dbConn, userIDs=list(knownVersions.keys()))
+            if summaries is None:
+                return None
+            unchanged = [row[0] for row in summaries if knownVersions.get(row[0].upper()) == row[2]]
+            changed = [row[0] for row in summaries if knownVersions.get(row[0].upper()) != row[2]]
+            results = dmaftServerDB.getProfiles(connection=dbConn, userIDs=changed) if len(changed) > 0 else []
+    except Exception as e:
+        log.error("lookUpProfiles(): Failed to read profiles: %s", e)
+        results = None
+
+    if results is None:
+        return None
+
+    found = set(row[0].upper() for row in summaries)
+    return {
+        'Profiles':[
+            {'UserId':row[0], 'UserName':row[1], 'Status':row[2], 'Bio':row[3], 'ProfilePic':row[4], 'ProfileVersion':row[5]}
+            for row in results
+        ],
+        'Unchanged':unchanged,
+        'Missing':[userID for userID in knownVersions if userID not in found],
+    }
+
+
+#Chunk data arrives as raw bytes from binary codecs and as base64 from JSON.
+def decodeChunkData(chunkData):
+    if isinstance(chunkData, bytes):
+        return chunkData
+    if type(chunkData) != str:
+        return None
+    try:
+        return base64.b64decode(chunkData, validate=True)
+    except ValueError:
+        return None
+
+
+#Accepts one chunk of an attachment upload.
+#Send Offset 0 with empty ChunkData to find out where to resume; the reply's NextOffset is always the next byte the server wants.
+#The reply carries a BlobRef once the whole attachment has arrived, and the user is recorded as its owner.
+#Only a user who has uploaded it in full before gets the BlobRef straight away; everyone else sends the bytes, even if they're stored.
+def handleUploadBlobRequest(clientRequest: dict):
+    keys = set(clientRequest.keys())
+    expectedKeys = {'Command','UserId','Sha256','Size','Offset','ChunkData'}
+    if not expectedKeys.issubset(keys):
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One or more required JSON keys are missing from the request.')
+
+    chunk = decodeChunkData(clientRequest['ChunkData'])
+    sanityChecks = [
+        type(clientRequest['Sha256']) == str,
+        type(clientRequest['Size']) == int,
+        type(clientRequest['Offset']) == int,
+        chunk is not None,
+    ]
+
+    if False in sanityChecks:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One of the JSON keys is malformed or missing a required value.')
+
+    #Don't echo the chunk back.
+    del clientRequest['ChunkData']
+    sha256 = clientRequest['Sha256'].lower()
+    try:
+        owned = False
+        if blobStore.getBlobSize(sha256) == clientRequest['Size']:
+            with dmaftServerDB.borrowDB() as dbConn:
+                owned = dmaftServerDB.isBlobOwner(connection=dbConn, sha256=sha256, userID=clientRequest['UserId'])
+        nextOffset, blobRef = blobStore.appendChunk(
+            userID=clientRequest['UserId'],
+            sha256=sha256,
+            size=clientRequest['Size'],
+            offset=clientRequest['Offset'],
+            chunk=chunk,
+            owned=owned,
+            )
+    except blobStore.BlobError as e:
+        serverReply = makeError(clientRequest=clientRequest, errorCode=e.errorCode, reason=e.reason)
+        if e.nextOffset is not None:
+            serverReply['NextOffset'] = e.nextOffset
+        return serverReply
+    except (OSError, RuntimeError) as e:
+        log.error("handleUploadBlobRequest(): Failed to write the upload: %s", e)
+        return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to store the attachment chunk. Please try again.')
+
+    if blobRef is not None and not owned:
+        with dmaftServerDB.borrowDB() as dbConn:
+            if not dmaftServerDB.addBlobOwner(connection=dbConn, sha256=sha256, userID=clientRequest['UserId']):
+                return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to store the attachment. Please upload it again.')
+
+    clientRequest['Successful'] = True
+    clientRequest['ServerTimestamp'] = int(time.time())
+    clientRequest['NextOffset'] = nextOffset
+    clientRequest['Complete'] = blobRef is not None
+    if blobRef is not None:
+        clientRequest['BlobRef'] = blobRef
+    return clientRequest
+
+
+#Returns one chunk of a stored attachment. Length is optional and capped at BLOB_CHUNK_BYTES.
+#Only the user who uploaded it and the members of conversations it was sent to can download it.
+def handleDownloadBlobRequest(clientRequest: dict):
+    keys = set(clientRequest.keys())
+    expectedKeys = {'Command','UserId','Sha256','Offset'}
+    if not expectedKeys.issubset(keys):
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One or more required JSON keys are missing from the request.')
+
+    sanityChecks = [
+        type(clientRequest['Sha256']) == str,
+        type(clientRequest['Offset']) == int,
+        type(clientRequest.get('Length', 0)) == int,
+    ]
+
+    if False in sanityChecks:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One of the JSON keys is malformed or missing a required value.')
+
+    sha256 = clientRequest['Sha256'].lower()
+    try:
+        with dmaftServerDB.borrowDB() as dbConn:
+            canRead = dmaftServerDB.canUserReadBlob(connection=dbConn, sha256=sha256, userID=clientRequest['UserId'])
+    except RuntimeError as e:
+        log.error("handleDownloadBlobRequest(): Failed to check access to the attachment: %s", e)
+        return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to read the attachment. Please try again.')
+    if not canRead:
+        return makeError(clientRequest=clientRequest, errorCode='PermissionDenied', reason='You do not have access to this attachment.')
+
+    try:
+        chunk = blobStore.readChunk(sha256=sha256, offset=clientRequest['Offset'], length=clientRequest.get('Length'))
+    except blobStore.BlobError as e:
+        return makeError(clientRequest=clientRequest, errorCode=e.errorCode, reason=e.reason)
+    except OSError as e:
+        log.error("handleDownloadBlobRequest(): Failed to read the attachment: %s", e)
+        return makeError(clientRequest=clientRequest, errorCode='ServerInternalError', retry=True, reason='Failed to read the attachment. Please try again.')
+
+    size = blobStore.getBlobSize(sha256)
     clientRequest['Successful'] = True
     clientRequest['ServerTimestamp'] = int(time.time())
+    clientRequest['Size'] = size
+    clientRequest['ChunkData'] = chunk
+    clientRequest['NextOffset'] = clientRequest['Offset'] + len(chunk)
+    clientRequest['Final'] = clientRequest['NextOffset'] >= size
     return clientRequest
 
 
@@ -417,19 +970,21 @@ def handleUpdateProfileRequest(clientRequest: dict):
     if False in pSanityChecks:
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='One or more inner keys inside the NewProfile key are malformed or missing a value')
 
+    if len(clientRequest['NewProfile']['UserName']) > serverConfig.USERNAME_MAX_LENGTH:
+        return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='UserName can be at most ' + str(serverConfig.USERNAME_MAX_LENGTH) + ' characters.')
+
     #Technically, we could decode the user's profile photo and then upload it to the DB.
     #However, since we don't NEED to see the raw value server-side, might as well store it in B64 to make it easier for delivery.
 
-    dbConn = dmaftServerDB.startDB()
-    result = dmaftServerDB.updateUserProfileData(
-        connection=dbConn,
-        userID=clientRequest['UserId'],
-        userName=clientRequest['NewProfile']['UserName'],
-        userBio=clientRequest['NewProfile']['UserBio'],
-        userStatus=clientRequest['NewProfile']['UserStatus'],
-        userPic=clientRequest['NewProfile']['UserProfilePic'],
-        )
-    dmaftServerDB.closeDB(dbConn)
+    with dmaftServerDB.borrowDB() as dbConn:
+        result = dmaftServerDB.updateUserProfileData(
+            connection=dbConn,
+            userID=clientRequest['UserId'],
+            userName=clientRequest['NewProfile']['UserName'],
+            userBio=clientRequest['NewProfile']['UserBio'],
+            userStatus=clientRequest['NewProfile']['UserStatus'],
+            userPic=clientRequest['NewProfile']['UserProfilePic'],
+            )
 
     if not result:
         return makeError(clientRequest=clientRequest, retry=True, errorCode='ServerInternalError', reason="Failed to update user profile data for user " + clientRequest['UserId'] + ". Please try again.")
@@ -441,28 +996,39 @@ def handleUpdateProfileRequest(clientRequest: dict):
     return clientRequest
 
 
+#Admin only: returns the server's metrics in the Prometheus text format.
+def handleMetricsRequest(clientRequest: dict):
+    if str(clientRequest.get('UserId')).upper() not in adminUserIDs:
+        return makeError(clientRequest=clientRequest, errorCode='PermissionDenied', reason='Only server administrators can read metrics.')
+
+    clientRequest['Successful'] = True
+    clientRequest['ServerTimestamp'] = int(time.time())
+    clientRequest['Metrics'] = metrics.renderPrometheus()
+    return clientRequest
+
+
 #Main dispatch function for all received requests.
 #These first few do NOT require valid tokens.
 def handleRequest(clientRequest, websocket: websockets.asyncio.server.ServerConnection):
-    #print("Received command from client:\n", clientRequest)
     command = str(clientRequest['Command']).upper()
+    wrongNodeError = getWrongNodeError(clientRequest)
+    if wrongNodeError is not None:
+        return wrongNodeError
+
     if command == 'PING':
         return handlePingMsg(clientRequest, websocket)
         
     #This needs to be renamed to a different command.
     #"CONNECT" is reserved for one client wanting to connect to another client.
     elif command == 'CONNECT':
-        print("Detected CONNECT request.")
         return handleAuth.handleConnectRequest(clientRequest)
     
     elif command == 'AUTHENTICATE':
-        print("Detected AUTHENTICATE request.")
         return handleAuth.handleChallengeResponse(clientRequest)
 
     else:
         #Validate the client's token.
         clientRequest = handleAuth.validateClientToken(clientRequest)
-        print("Data received from handleAuth.validateClientToken():\n", clientRequest)
         
         try:
             if 'ErrorType' in clientRequest.keys():
@@ -485,64 +1051,198 @@ def handleRequest(clientRequest, websocket: websockets.asyncio.server.ServerConn
         
         elif command == 'LEAVECONVERSATION':
             return handleLeaveConvoRequest(clientRequest)
+
+        elif command == 'GETPROFILES':
+            return handleGetProfilesRequest(clientRequest)
+
+        elif command == 'UPLOADBLOB':
+            return handleUploadBlobRequest(clientRequest)
+
+        elif command == 'DOWNLOADBLOB':
+            return handleDownloadBlobRequest(clientRequest)
+
+        elif command == 'METRICS':
+            return handleMetricsRequest(clientRequest)
             
 
         return makeError(clientRequest=clientRequest, errorCode='BadRequest', reason='Invalid command received from client.')
 
 
+#Logins wait on signature checks and synced writes, so they get their own threads (see workers.py).
+loginCommands = {'CONNECT', 'AUTHENTICATE'}
+
+
+#Plain PINGs (no token to check) never block, so they're answered directly on the event loop.
+def isInlineRequest(clientRequest):
+    if type(clientRequest) != dict:
+        return False
+    if str(clientRequest.get('Command')).upper() != 'PING':
+        return False
+    return not ({'TokenId','TokenSecret','UserId'} & set(clientRequest.keys()))
+
+
+#Runs handleRequest for one client request.
+#Anything that may query SQLite or do crypto runs on the worker thread pool so the event loop stays free for other sockets.
+#Each socket only has one request in flight at a time (listen awaits this), so its replies stay in order.
+async def dispatchRequest(clientRequest, websocket: websockets.asyncio.server.ServerConnection):
+    command = getMetricsCommand(clientRequest)
+    start = time.perf_counter()
+    try:
+        if isInlineRequest(clientRequest):
+            serverReply = handleRequest(clientRequest, websocket)
+        else:
+            serverReply = handleBoundPing(clientRequest, websocket)
+            if serverReply is None:
+                runner = workers.runLogin if command in loginCommands else workers.runBlocking
+                serverReply = await runner(handleRequest, clientRequest, websocket)
+    finally:
+        requestSeconds.observe(time.perf_counter() - start, command)
+
+    if type(serverReply) == dict and 'ErrorType' in serverReply:
+        requestErrors.inc(command, str(serverReply['ErrorType']))
+    return serverReply
+
+
+def getMetricsCommand(clientRequest):
+    if type(clientRequest) != dict:
+        return 'OTHER'
+    command = str(clientRequest.get('Command')).upper()
+    return command if command in knownCommands else 'OTHER'
+
+
+#Cached mailbox size for the gauges; counting it means scanning the mailbox, so it's refreshed every METRICS_MAILBOX_REFRESH seconds at most.
+_mailboxStats = {'Stats':None, 'Expires':0}
+
+def getCachedMailboxStats():
+    if time.monotonic() >= _mailboxStats['Expires']:
+        with dmaftServerDB.borrowDB() as dbConn:
+            _mailboxStats['Stats'] = dmaftServerDB.getMailboxStats(connection=dbConn)
+        _mailboxStats['Expires'] = time.monotonic() + serverConfig.METRICS_MAILBOX_REFRESH
+    if _mailboxStats['Stats'] is None:
+        raise RuntimeError("tlsServer.getCachedMailboxStats(): Failed to read the mailbox size.")
+    return _mailboxStats['Stats']
+
+
+#Gauges read the live state of this module's connection list, so they're registered by the running server only.
+def registerGauges():
+    metrics.gauge('dmaft_connected_sockets', 'Open websocket connections.', callback=lambda: connectedClients.getStats()['Sockets'])
+    metrics.gauge('dmaft_authenticated_users', 'Users with at least one authenticated socket.', callback=lambda: connectedClients.getStats()['Users'])
+    metrics.gauge('dmaft_live_topics', 'Conversations with at least one member online.', callback=lambda: connectedClients.getStats()['Topics'])
+    metrics.gauge('dmaft_outbox_queued_frames', 'Frames waiting in socket outboxes to be sent.', callback=lambda: connectedClients.getStats()['QueuedFrames'])
+    metrics.gauge('dmaft_mailbox_messages', 'Messages queued for offline recipients.', callback=lambda: getCachedMailboxStats()['Messages'])
+    metrics.gauge('dmaft_mailbox_bytes', 'Bytes of message data queued for offline recipients.', callback=lambda: getCachedMailboxStats()['Bytes'])
+
+
+#Clients can switch codecs by sending a 'Codecs' preference list with a PING or CONNECT (see codec.py).
+#Adds the chosen codec's name to the reply and returns the codec, or returns None if no switch was asked for.
+def negotiateCodec(clientRequest, serverReply):
+    if type(clientRequest) != dict or type(serverReply) != dict or 'Codecs' not in clientRequest:
+        return None
+    if str(clientRequest.get('Command')).upper() not in ['PING', 'CONNECT'] or 'ErrorType' in serverReply:
+        return None
+    negotiated = codec.negotiate(clientRequest['Codecs'])
+    serverReply['Codec'] = negotiated.name
+    return negotiated
+
+
+#Sends a reply in the codec negotiated on the socket.
+async def sendReply(websocket: websockets.asyncio.server.ServerConnection, serverReply):
+    socketCodec = connectedClients.getCodecForSocket(websocket)
+    await websocket.send(codec.encodeFrame(serverReply, socketCodec), text=socketCodec.isText)
+
+
 async def listen(websocket: websockets.asyncio.server.ServerConnection):
     global connectedClients
     try:
-        print(type(websocket))
-        i = 0
-        print("Running the listen function now!")
         async for message in websocket:
             if (connectedClients.getClientFromSocket(websocket) == []):
                 connectedClients.addSocket(websocket)
-                print("Added websocket with ID", websocket.id)
+                log.info("Added websocket with ID %s", websocket.id)
 
-            i += 1
-            print('Count:', i)
-            print("Received message!")
-            print(message)
             try:
-                clientRequest = json.loads(message)
+                clientRequest = codec.decodeFrame(message, connectedClients.getCodecForSocket(websocket))
             except:
-                serverReply = makeError(clientRequest={}, errorCode='NonJSONRequest', reason='This server only accepts JSON requests.')
-                await websocket.send(json.dumps(serverReply))
+                log.debug("listen(): Undecodable %d-byte frame on websocket ID %s", len(message), websocket.id)
+                requestErrors.inc('OTHER', 'NonJSONRequest')
+                serverReply = makeError(clientRequest={}, errorCode='NonJSONRequest', reason='This server only accepts JSON requests, or binary requests in the negotiated codec.')
+                await sendReply(websocket, serverReply)
                 continue
+
+            if serverLog.debugSampled(log, 'frames'):
+                log.debug("Received %d-byte frame on websocket ID %s: %s", len(message), websocket.id, clientRequest)
             
             try:
-                serverReply = handleRequest(clientRequest, websocket)
-                print("Sending to client:", serverReply)
-                await websocket.send(json.dumps(serverReply))
-                print("Successfully processed request.\n")
+                serverReply = await dispatchRequest(clientRequest, websocket)
+                negotiated = negotiateCodec(clientRequest, serverReply)
+                if serverLog.debugSampled(log, 'replies'):
+                    log.debug("Sending to websocket ID %s: %s", websocket.id, serverReply)
+                await sendReply(websocket, serverReply)
+                if negotiated is not None:
+                    connectedClients.setCodecOnSocket(websocket, negotiated)
 
             except Exception as e:
-                print("ERROR: handleRequest threw an exception.")
-                print("Exception Info:")
-                print(e, '\n')
-                print(traceback.format_exc())
+                log.exception("listen(): handleRequest threw an exception.")
+                requestErrors.inc(getMetricsCommand(clientRequest), 'ServerInternalError')
                 serverReply = makeError(clientRequest=clientRequest, errorCode='ServerInternalError', reason='Server failed to process the request.')
-                await websocket.send(json.dumps(serverReply))
+                await sendReply(websocket, serverReply)
 
     except websockets.exceptions.ConnectionClosed as closed:
-        print("Websocket ID", websocket.id, "disconnected:", closed)
-        connectedClients.deleteSocket(websocket)
-        print("Removed this websocket from the list of active clients.")
+        log.info("Websocket ID %s disconnected: %s", websocket.id, closed)
 
     except Exception as e:
-        print('Exception raised when trying to send message on websocket ID', websocket.id, ':', websocket, e)
+        log.warning("Exception raised when trying to send message on websocket ID %s: %s", websocket.id, e)
+
+    finally:
+        #A clean close ends the loop above without raising, so make sure the socket is always dropped.
+        #Otherwise its user would still look online and messages would be "delivered" to a dead socket.
         connectedClients.deleteSocket(websocket)
-        print("Removed this websocket from the list of active clients.")
 
 
-async def main():
+#Runs the server in this process.
+#workerID, workerCount and peerDir are given when this is one of several worker processes sharing the port (see supervisor.py).
+async def main(*, workerID: int = None, workerCount: int = 1, peerDir: str = None):
+    isWorker = workerID is not None
+    serverLog.startLogging(label='worker ' + str(workerID) if isWorker else None)
     ip = getIPAddress()
-    async with websockets.asyncio.server.serve(listen, 'localhost', 8765, ssl=ssl_context) as server:
-        print(type(server))
-        print("Started server websocket, listening...")
-        await server.serve_forever()
+    workers.startWorkers()
+    registerGauges()
+    metricsPort = serverConfig.METRICS_PORT
+    if isWorker and metricsPort != 0:
+        metricsPort += workerID
+    metricsServer = metrics.startHTTPServer(serverConfig.METRICS_HOST, metricsPort)
+    #One sweeper is enough for the shared database; more would only take turns holding its write lock.
+    sweeperTask = asyncio.create_task(sweeper.runSweeper()) if not workerID else None
+
+    peers = None
+    if isWorker:
+        peers = peerLink.PeerLink(connectedClients, workerID=workerID, workerCount=workerCount, socketDir=peerDir)
+        connectedClients.peers = peers
+        dmaftServerDB.tokenCache.peers = peers
+        await peers.start()
+        #The supervisor stops workers with SIGTERM; cancelling main runs the cleanup below.
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    cluster = None
+    if serverConfig.CLUSTER_CONFIG != '':
+        config = clusterLink.loadClusterConfig(serverConfig.CLUSTER_CONFIG)
+        cluster = clusterLink.ClusterLink(config, clusterHandlers)
+        await cluster.start(reusePort=isWorker)
+    try:
+        async with websockets.asyncio.server.serve(listen, serverConfig.SERVER_HOST, serverConfig.SERVER_PORT, ssl=ssl_context, reuse_port=isWorker) as server:
+            log.info("Started server websocket, listening...")
+            await server.serve_forever()
+    finally:
+        if sweeperTask is not None:
+            sweeperTask.cancel()
+        if peers is not None:
+            connectedClients.peers = None
+            dmaftServerDB.tokenCache.peers = None
+            await peers.stop()
+        if cluster is not None:
+            await cluster.stop()
+        metrics.stopHTTPServer(metricsServer)
+        workers.stopWorkers()
+        serverLog.stopLogging()
 
 def makeError(*, clientRequest: dict, retry: bool = False, errorCode, reason: str):
     jsonMsg = {
@@ -558,7 +1258,7 @@ def makeError(*, clientRequest: dict, retry: bool = False, errorCode, reason: st
         jsonMsg['Command'] = clientRequest['Command']
     except:
         pass
-    return json.dumps(jsonMsg)
+    return jsonMsg
 
 #Strips out the UserId and token info from a given clientRequest.
 def cleanAuthData(clientRequest: dict):
@@ -585,4 +1285,7 @@ def makeBadAuthError(*, clientRequest: dict):
     return makeError(clientRequest=clientRequest, errorCode='InvalidToken', reason='The required token for this operation is missing or invalid. Please request a new challenge.')
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if serverConfig.SERVER_WORKERS > 1:
+        supervisor.runSupervisor(serverConfig.SERVER_WORKERS)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,90 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+
+import crypto
+import metrics
+import serverConfig
+
+#Worker pools for blocking request work.
+#SQLite queries and hashing run on a bounded thread pool so the event loop keeps serving other websockets.
+#RSA signature checks go to a separate process pool so a burst of AUTHENTICATE requests can't hog the GIL.
+#Logins (CONNECT, AUTHENTICATE) run on their own smaller thread pool, so a burst of them waiting on signature checks and
+#synced writes can't take every worker thread from token PINGs and messages (loadTest.py --scenario auth-storm).
+#If the pools haven't been started (scripts, benchmarks), everything simply runs inline.
+
+cryptoSeconds = metrics.histogram('dmaft_crypto_seconds', 'Time spent on RSA operations, including any wait for a worker process.', ('operation',))
+
+_threadPool = None
+_loginPool = None
+_processPool = None
+
+
+#loginThreads=0 runs logins on the main thread pool like everything else.
+def startWorkers(*, threads: int = None, loginThreads: int = None, processes: int = None):
+    global _threadPool, _loginPool, _processPool
+    stopWorkers()
+
+    threads = serverConfig.WORKER_THREADS if threads is None else threads
+    loginThreads = serverConfig.LOGIN_WORKER_THREADS if loginThreads is None else loginThreads
+    processes = serverConfig.WORKER_PROCESSES if processes is None else processes
+    if threads < 1:
+        raise ValueError("workers.startWorkers(): At least one worker thread is required!")
+
+    _threadPool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='dmaft-worker')
+    if loginThreads > 0:
+        _loginPool = concurrent.futures.ThreadPoolExecutor(max_workers=loginThreads, thread_name_prefix='dmaft-login')
+    if processes > 0:
+        #Don't fork: the server already has threads running by the time the first process is started.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        _processPool = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+def stopWorkers():
+    global _threadPool, _loginPool, _processPool
+    if _threadPool is not None:
+        _threadPool.shutdown(wait=False, cancel_futures=True)
+        _threadPool = None
+    if _loginPool is not None:
+        _loginPool.shutdown(wait=False, cancel_futures=True)
+        _loginPool = None
+    if _processPool is not None:
+        _processPool.shutdown(wait=False, cancel_futures=True)
+        _processPool = None
+
+
+#Awaits func(*args, **kwargs) on the worker thread pool.
+async def runBlocking(func, *args, **kwargs):
+    call = functools.partial(func, *args, **kwargs)
+    if _threadPool is None:
+        return call()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_threadPool, call)
+
+
+#Awaits func(*args, **kwargs) on the login thread pool, or the worker thread pool if there isn't one.
+async def runLogin(func, *args, **kwargs):
+    if _loginPool is None:
+        return await runBlocking(func, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_loginPool, functools.partial(func, *args, **kwargs))
+
+
+#Verifies an RSA PKCS#1 v1.5 / SHA-256 signature, using the process pool if one is running.
+#Meant to be called from a worker thread; it blocks until the result is ready.
+#Returns True if the signature is valid and False if not.
+def verifySignature(*, publicKeyBytes: bytes, signature: bytes, data: bytes):
+    with cryptoSeconds.time('verifySignature'):
+        return _verifySignature(publicKeyBytes, signature, data)
+
+
+def _verifySignature(publicKeyBytes: bytes, signature: bytes, data: bytes):
+    if _processPool is None:
+        return crypto.verifyRSASignatureFromBytes(publicKeyBytes, signature, data)
+    try:
+        return _processPool.submit(crypto.verifyRSASignatureFromBytes, publicKeyBytes, signature, data).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        #A worker died. Don't fail the login over it.
+        return crypto.verifyRSASignatureFromBytes(publicKeyBytes, signature, data)